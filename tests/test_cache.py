@@ -1,7 +1,11 @@
+import json
 from pathlib import Path
 from datetime import datetime, timedelta
 from user_sync.cache.base import CacheBase
+from user_sync.cache.ldap import LdapCache
+from user_sync.cache.okta import OktaCache
 from user_sync.cache.sign import SignCache
+from user_sync.cache.umapi import UmapiCache
 from sign_client.model import DetailedUserInfo, GroupInfo, UserGroupInfo, SettingsInfo
 
 
@@ -210,3 +214,106 @@ def test_table_rebuild(tmp_path):
     cache = SignCache(store_path, 'primary')
     assert cache.should_refresh
     assert cache.get_version() == SignCache.VERSION
+
+
+def test_umapi_cache_users(tmp_path):
+    """Ensure each org gets its own UMAPI snapshot, and users survive a round trip"""
+    store_path: Path = tmp_path / 'cache' / 'umapi'
+    cache = UmapiCache(store_path, 'primary')
+    assert (store_path / 'primary' / UmapiCache.db_filename).exists()
+    assert cache.should_refresh
+    user = {'email': 'user@example.com', 'username': 'user@example.com', 'domain': 'example.com',
+            'type': 'federatedID', 'groups': ['Group A']}
+    cache.cache_users([('federatedID,user@example.com,', user)])
+    cache.refresh_done()
+    cache.update_user_refresh_status('federatedID,user@example.com,', needs_refresh=True)
+
+    cache = UmapiCache(store_path, 'primary')
+    assert not cache.should_refresh
+    assert cache.get_users() == [user]
+    assert cache.get_users_to_refresh() == [('federatedID,user@example.com,', user)]
+    assert UmapiCache(store_path, 'secondary').should_refresh
+
+
+def test_ldap_cache_group_dns(tmp_path):
+    """Ensure group DNs are kept per search base, and expire after their TTL"""
+    store_path: Path = tmp_path / 'cache' / 'ldap'
+    cache = LdapCache(store_path)
+    assert (store_path / LdapCache.db_filename).exists()
+    cache.cache_group_dns('dc=example,dc=com', [('(cn=Group A)', 'cn=Group A,dc=example,dc=com')])
+
+    cache = LdapCache(store_path)
+    assert cache.get_group_dns('dc=example,dc=com') == {'(cn=Group A)': 'cn=Group A,dc=example,dc=com'}
+    assert cache.get_group_dns('dc=example,dc=org') == {}
+    cache = LdapCache(store_path, group_dn_ttl=-1)
+    cache.cache_group_dns('dc=example,dc=com', [('(cn=Group A)', 'cn=Group A,dc=example,dc=com')])
+    assert cache.get_group_dns('dc=example,dc=com') == {}
+
+
+def test_ldap_cache_group_members(tmp_path):
+    """Ensure the group graph is kept per member attribute, and expires after its TTL"""
+    store_path: Path = tmp_path / 'cache' / 'ldap'
+    cache = LdapCache(store_path, group_members_ttl=3600)
+    cache.cache_group_members('member', [('CN=Group A,dc=example,dc=com', ['cn=user1,dc=example,dc=com'], '10'),
+                                         ('cn=user1,dc=example,dc=com', [], '11')])
+    cache = LdapCache(store_path, group_members_ttl=3600)
+    assert cache.get_group_members('member') == {
+        'cn=group a,dc=example,dc=com': (['cn=user1,dc=example,dc=com'], '10'),
+        'cn=user1,dc=example,dc=com': ([], '11')}
+    assert cache.get_group_members('uniqueMember') == {}
+    cache = LdapCache(store_path, group_members_ttl=-1)
+    cache.cache_group_members('member', [('cn=Group A,dc=example,dc=com', [], '12')])
+    assert cache.get_group_members('member') == {'cn=user1,dc=example,dc=com': ([], '11')}
+
+    # the entries that changed are removed along with setting the mark they were checked against
+    assert cache.get_group_members_mark('member') is None
+    cache.set_group_members_mark('member', '100', ['CN=User1,dc=example,dc=com'])
+    assert cache.get_group_members_mark('member') == '100'
+    assert cache.get_group_members_mark('uniqueMember') is None
+    assert cache.get_group_members('member') == {}
+
+
+def test_ldap_cache_users(tmp_path):
+    """Ensure cached users are only kept once set_user_meta commits them"""
+    store_path: Path = tmp_path / 'cache' / 'ldap'
+    cache = LdapCache(store_path)
+    assert cache.get_user_meta() is None
+    now = datetime.now()
+    cache.clear_users()
+    cache.add_users([('id1', 'cn=user1,dc=example,dc=com', {'mail': ['user1@example.com']}),
+                     ('id2', 'cn=user2,dc=example,dc=com', {'mail': ['user2@example.com']})])
+    cache.set_user_meta('search', '1000', now)
+
+    cache = LdapCache(store_path)
+    assert cache.get_user_meta() == ('search', '1000', now)
+    cache.add_users([('id1', 'cn=user1,ou=moved,dc=example,dc=com', {'mail': ['user1@example.com']})])
+    cache.remove_users(['id2'])
+    cache.discard_user_changes()
+    assert [dn for dn, _ in cache.iter_users()] == ['cn=user1,dc=example,dc=com', 'cn=user2,dc=example,dc=com']
+    cache.add_users([('id1', 'cn=user1,ou=moved,dc=example,dc=com', {'mail': ['user1@example.com']})])
+    cache.remove_users(['id2'])
+    cache.set_user_meta('search', '1010', now)
+    assert list(cache.iter_users()) == [('cn=user1,ou=moved,dc=example,dc=com', {'mail': ['user1@example.com']})]
+
+
+def test_ldap_cache_user_values(tmp_path):
+    """Ensure binary and timestamp values are kept as JSON, and come back as they went in"""
+    cache = LdapCache(tmp_path)
+    record = {'objectGUID': [b'\x01\xff"'], 'whenChanged': [datetime(2026, 1, 2, 3, 4, 5)], 'uSNChanged': [1000],
+              'mail': 'user1@example.com', 'description': [None]}
+    cache.clear_users()
+    cache.add_users([('id1', 'cn=user1,dc=example,dc=com', record)])
+    cache.set_user_meta('search', '1000', datetime.now())
+    stored, = cache.db_conn.execute("select cast(record as text) from users").fetchone()
+    assert json.loads(stored)['objectGUID'] == [{'$bytes': 'Af8i'}]
+    assert list(LdapCache(tmp_path).iter_users()) == [('cn=user1,dc=example,dc=com', record)]
+
+
+def test_okta_cache_group_ids(tmp_path):
+    cache = OktaCache(tmp_path)
+    assert cache.should_refresh
+    cache.cache_group_ids([('Group A', 'id-a'), ('Group B', 'id-b')])
+    cache.remove_group_id('Group B')
+    assert OktaCache(tmp_path).get_group_ids() == {'Group A': 'id-a'}
+    OktaCache(tmp_path, group_id_ttl=-1).cache_group_ids([('Group A', 'id-a')])
+    assert OktaCache(tmp_path).get_group_ids() == {}
@@ -125,6 +125,45 @@ def test_extension_load(modify_root_config, monkeypatch, test_resources, default
         assert 'after_mapping_hook' in options and options['after_mapping_hook'] is not None
 
 
+def test_extension_hook_processes(modify_root_config, modify_config, monkeypatch, test_resources, default_args,
+                                  cleanup):
+    """Test that a hook which keeps state across users can't be run in several processes"""
+    with monkeypatch.context() as m:
+        m.setattr(flags, 'get_flag', lambda *a: True)
+
+        modify_root_config(['directory_users', 'extension'], test_resources['extension'])
+        modify_config('extension', ['after_mapping_hook_processes'], 2)
+        options = UMAPIConfigLoader(default_args).get_engine_options()
+        assert options['after_mapping_hook_processes'] == 2
+
+        modify_config('extension', ['after_mapping_hook'], "hook_storage = hook_storage or set()\n")
+        with pytest.raises(AssertionException):
+            UMAPIConfigLoader(default_args).get_engine_options()
+
+
+def test_extension_hook_style(modify_root_config, modify_config, monkeypatch, test_resources, default_args,
+                              cleanup):
+    """Test that the style of the hook is set explicitly, and checked"""
+    with monkeypatch.context() as m:
+        m.setattr(flags, 'get_flag', lambda *a: True)
+
+        modify_root_config(['directory_users', 'extension'], test_resources['extension'])
+        options = UMAPIConfigLoader(default_args).get_engine_options()
+        assert options['after_mapping_hook_is_function'] is False
+
+        modify_config('extension', ['after_mapping_hook_style'], 'function')
+        with pytest.raises(AssertionException):
+            UMAPIConfigLoader(default_args).get_engine_options()
+
+        modify_config('extension', ['after_mapping_hook'], "def after_mapping(user, groups):\n    pass\n")
+        options = UMAPIConfigLoader(default_args).get_engine_options()
+        assert options['after_mapping_hook_is_function'] is True
+
+        modify_config('extension', ['after_mapping_hook_style'], 'lambda')
+        with pytest.raises(AssertionException):
+            UMAPIConfigLoader(default_args).get_engine_options()
+
+
 def test_extension_flag(modify_root_config, monkeypatch, test_resources, default_args, cleanup):
     """Test that extension flag will prevent after-map hook from running"""
     with monkeypatch.context() as m:
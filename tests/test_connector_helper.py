@@ -0,0 +1,41 @@
+import pickle
+
+from user_sync.connector.helper import create_blank_user, DirectoryUser
+
+
+def test_directory_user():
+    user = create_blank_user()
+    assert user == {
+        "identity_type": None,
+        "username": None,
+        "domain": None,
+        "firstname": None,
+        "lastname": None,
+        "email": None,
+        "groups": [],
+        "country": None,
+    }
+    assert 'source_attributes' not in user
+    assert user.get('source_attributes') is None
+
+    domain = ''.join(['example', '.com'])
+    user['domain'] = domain
+    user['groups'] = [''.join(['Group', ' 1'])]
+    user['source_attributes'] = {'email': 'user@example.com'}
+    user['sign_group'] = {'group': 'Group 1'}
+    other = create_blank_user()
+    other['domain'] = 'example.com'
+    other['groups'] = ['Group 1']
+    assert user['domain'] is other['domain']
+    assert user['groups'][0] is other['groups'][0]
+    assert user['sign_group'] == {'group': 'Group 1'}
+    assert len(user) == 10
+
+    copied = user.copy()
+    assert isinstance(copied, DirectoryUser)
+    copied['username'] = 'user'
+    assert user['username'] is None
+
+    del user['sign_group']
+    assert 'sign_group' not in user
+    assert pickle.loads(pickle.dumps(user)) == user
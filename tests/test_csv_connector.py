@@ -0,0 +1,105 @@
+import functools
+import multiprocessing
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import mock
+import pytest
+
+from user_sync.connector.directory_csv import CSVDirectoryConnector, CSVSourceAttributes
+from user_sync.helper import CSVAdapter
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    def _csv_file(text, name='users.csv'):
+        path = tmp_path / name
+        path.write_text(text, encoding='utf8')
+        return str(path)
+
+    return _csv_file
+
+
+def test_read_csv_columns(csv_file):
+    file_path = csv_file('email,country,extra,email\n'
+                         'old@example.com,us,"a,b",user1@example.com\n'
+                         '\n'
+                         'user2@example.com,"line 1\nline 2"\n')
+    rows = list(CSVAdapter.read_csv_columns(file_path, ['email', 'country', 'groups']))
+    # the last email column is used, short rows get None, and columns not in the file are None
+    assert rows == [('user1@example.com', 'us', None), (None, 'line 1\nline 2', None)]
+    assert list(CSVAdapter.read_csv_columns(csv_file('', name='empty.csv'), ['email'])) == []
+
+
+def test_read_users(csv_file):
+    file_path = csv_file('firstname,lastname,email,country,groups,type,username,domain,department\n'
+                         'One,User,user1@example.com,us,"Group A,Group B",,,,Sales\n'
+                         'Two,User,user2@example.com,,,federatedID,user2,example.net,\n'
+                         ',,not an email,,,,,,\n'
+                         'Uno,User,user1@example.com,gb,Group C,,user1,,Marketing\n')
+    connector = CSVDirectoryConnector({'file_path': file_path})
+    users = list(connector.load_users_and_groups([], ['department'], False))
+    assert [(user['email'], user['firstname'], user['country'], user['groups'], user['username'], user['domain'])
+            for user in users] == [
+        ('user1@example.com', 'Uno', 'GB', ['Group A', 'Group B', 'Group C'], 'user1', 'example.com'),
+        ('user2@example.com', 'Two', None, [], 'user2', 'example.net'),
+    ]
+    source_attributes = users[0]['source_attributes']
+    assert isinstance(source_attributes, CSVSourceAttributes)
+    assert source_attributes.attributes is None
+    assert pickle.loads(pickle.dumps(source_attributes))['department'] == 'Marketing'
+    assert source_attributes['department'] == 'Marketing'
+    assert source_attributes['type'] is None
+    assert dict(users[1]['source_attributes']) == {
+        'email': 'user2@example.com', 'firstname': 'Two', 'lastname': 'User', 'country': None, 'groups': None,
+        'type': 'federatedID', 'username': 'user2', 'domain': 'example.net', 'department': None}
+
+
+def test_find_csv_chunks(csv_file):
+    text = 'email,groups\n' + 'a@example.com,"x\ny"\n' * 3 + 'b@example.com,"say ""hi""\n"\n'
+    file_path = csv_file(text)
+    chunks = CSVAdapter.find_csv_chunks(file_path, 5)
+    row_starts = [13, 33, 53, 73]
+    assert chunks == list(zip(row_starts, row_starts[1:] + [len(text)]))
+    assert CSVAdapter.find_csv_chunks(file_path, 40) == [(13, 73), (73, len(text))]
+    assert CSVAdapter.find_csv_chunks(csv_file('email\n"a@example.com\n', name='odd.csv'), 1) is None
+
+
+def test_find_csv_chunks_across_buffers(csv_file, monkeypatch):
+    rows = ['email,groups\n'] + ['user%d@example.com,"G%d,\nG%d"\n' % (i, i, i % 7) for i in range(1500)]
+    text = ''.join(rows)
+    file_path = csv_file(text)
+    monkeypatch.setattr(CSVAdapter, 'read_buffer_size', 1000)
+    chunks = CSVAdapter.find_csv_chunks(file_path, 100)
+    # each chunk ends at the first row boundary past its target size, wherever the buffers end
+    assert chunks[0][0] == len(rows[0]) and chunks[-1][1] == len(text)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(chunks, chunks[1:]))
+    longest_row = max(len(row) for row in rows)
+    assert all(100 <= end - start < 100 + longest_row for start, end in chunks[:-1])
+
+
+@pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+def test_read_users_in_chunks(csv_file, start_method):
+    rows = ['email,firstname,country,groups,type,username,domain,department']
+    for i in range(200):
+        email = 'user%d@example.com' % (i * 7 % 23)
+        rows.append(','.join([email if i % 31 else 'invalid', 'First%d' % i if i % 3 else '',
+                              'us' if i % 5 else '', '"G%d,\nG%d"' % (i % 4, i % 3) if i % 2 else '',
+                              'bad' if i % 17 == 0 else '', 'name%d' % i if i % 11 == 0 else '',
+                              'example.net' if i % 13 == 0 else '', '"D,%d"' % i]))
+    file_path = csv_file('\n'.join(rows) + '\n')
+    assert len(CSVAdapter.find_csv_chunks(file_path, 500)) > 3
+    loaded = []
+    for processes in (1, 3):
+        connector = CSVDirectoryConnector({'file_path': file_path, 'parse_processes': processes,
+                                           'parse_chunk_size': 500})
+        # spawned workers are started as they are on Windows and macOS, without a copy of this process
+        executor = functools.partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context(start_method))
+        with mock.patch('user_sync.connector.directory_csv.ProcessPoolExecutor', executor), \
+                mock.patch.object(connector, 'read_users_in_chunks', wraps=connector.read_users_in_chunks) as chunked:
+            users = connector.read_users(file_path, ['department'])
+        assert chunked.call_count == (processes > 1)
+        loaded.append([(email, dict(user.items(), source_attributes=dict(user['source_attributes'])))
+                       for email, user in users.items()])
+    assert loaded[0] == loaded[1]
+    assert len(loaded[0]) == 22
@@ -0,0 +1,387 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+import mock
+import pytest
+
+from user_sync.connector.directory_ldap import LDAPDirectoryConnector, LDAPValueFormatter
+from user_sync.config.common import DictConfig
+from user_sync.cache.ldap import LdapCache
+from user_sync.error import AssertionException
+
+
+@pytest.fixture
+def ldap_connector():
+    def _ldap_connector(**options):
+        """
+        Make a connector without connecting to a server: searches are answered by mocking iter_search_result
+        """
+        options.setdefault('host', 'ldap://ldap.example.com')
+        options.setdefault('base_dn', 'dc=example,dc=com')
+        connector = LDAPDirectoryConnector.__new__(LDAPDirectoryConnector)
+        connector.options = LDAPDirectoryConnector.get_options(DictConfig('ldap configuration', options))
+        connector.logger = logging.getLogger('ldap')
+        connector.user_identity_type = 'federatedID'
+        for name in ('identity_type', 'email', 'username', 'domain', 'given_name', 'surname', 'country_code'):
+            option = 'user_%s_format' % name
+            setattr(connector, option.replace('_format', '_formatter'), LDAPValueFormatter(connector.options[option]))
+        connector.user_by_dn = {}
+        connector.user_attribute_names_cache = {}
+        connector.member_dns_by_dn = None
+        connector.nested_member_dns_by_dn = {}
+        connector.nested_group_strategy = None
+        connector.additional_group_filters = None
+        connector.ldap_cache = None
+        connector.connection = mock.MagicMock()
+        connector.connection_pool = None
+        connector.search_executor = None
+        connector.iter_search_result = mock.MagicMock()
+        connector.find_ldap_group_dn = mock.MagicMock(return_value=None)
+        return connector
+
+    return _ldap_connector
+
+
+def test_find_ldap_group_dns(ldap_connector):
+    connector = ldap_connector(group_filter_format='(&(objectClass=group)(cn={group}))', group_lookup_batch_size=2)
+    results = {
+        '(|(&(objectClass=group)(cn=Group A))(&(objectClass=group)(cn=Group B)))': [
+            ['cn=group a,dc=example,dc=com', {'cn': ['group a']}],
+            ['cn=Group B,dc=example,dc=com', {'cn': 'Group B'}],
+        ],
+        '(|(&(objectClass=group)(cn=Group C))(&(objectClass=group)(cn=Group D)))': [
+            ['cn=Group C,dc=example,dc=com', {'cn': ['Group C']}],
+        ],
+    }
+    connector.iter_search_result.side_effect = lambda base_dn, scope, filter_string, attributes: results[filter_string]
+    group_dns = connector.find_ldap_group_dns(['Group A', 'Group B', 'Group C', 'Group D'])
+    assert group_dns == {'Group A': 'cn=group a,dc=example,dc=com', 'Group B': 'cn=Group B,dc=example,dc=com',
+                         'Group C': 'cn=Group C,dc=example,dc=com', 'Group D': None}
+    assert connector.iter_search_result.call_count == 2
+    # groups that the batches don't find are looked up on their own
+    connector.find_ldap_group_dn.assert_called_once_with('Group D')
+
+    results['(|(&(objectClass=group)(cn=Group A))(&(objectClass=group)(cn=Group B)))'].append(
+        ['cn=Group A,ou=other,dc=example,dc=com', {'cn': ['Group A']}])
+    with pytest.raises(AssertionException):
+        connector.find_ldap_group_dns(['Group A', 'Group B'])
+
+
+def test_map_searches_connection_pool(ldap_connector):
+    connector = ldap_connector(connection_pool={'size': 5, 'max_connections_per_server': 2,
+                                                'hosts': ['ldap://ldap2.example.com']})
+    connector.connect = mock.MagicMock(side_effect=lambda host: mock.MagicMock(host=host))
+    connector.open_connection_pool(connector.options['connection_pool'])
+    # two servers with two connections each
+    assert connector.connection_pool.qsize() == 4
+    assert [c[0][0] for c in connector.connect.call_args_list] == ['ldap://ldap2.example.com',
+                                                                   'ldap://ldap.example.com',
+                                                                   'ldap://ldap2.example.com']
+    try:
+        used_connections = set()
+
+        def search(connection, item):
+            used_connections.add(connection)
+            return item * 2
+
+        assert list(connector.map_searches(search, list(range(20)))) == [i * 2 for i in range(20)]
+        assert used_connections <= set(connector.connection_pool.queue)
+        assert connector.connection_pool.qsize() == 4
+    finally:
+        connector.search_executor.shutdown()
+
+    with pytest.raises(AssertionException):
+        ldap_connector(connection_pool={'size': 0})
+
+
+def test_scan_group_membership(ldap_connector):
+    connector = ldap_connector(scan_group_membership=True)
+    connector.find_ldap_group_dns = mock.MagicMock(return_value={
+        'Group A': 'CN=Group A,dc=example,dc=com', 'Group B': 'cn=Group B,dc=example,dc=com', 'Group C': None})
+
+    def user_record(name, *group_dns):
+        return ['cn=%s,dc=example,dc=com' % name,
+                {'mail': ['%s@example.com' % name], 'givenName': [name], 'sn': ['Last'], 'c': ['us'],
+                 'memberOf': list(group_dns)}]
+
+    connector.iter_search_result.return_value = [
+        user_record('user1', 'cn=group a,dc=example,dc=com', 'cn=Other,dc=example,dc=com'),
+        user_record('user2', 'cn=Group A,dc=example,dc=com', 'cn=Group B,dc=example,dc=com'),
+        user_record('user3'),
+    ]
+    users = list(connector.load_users_and_groups(['Group A', 'Group B', 'Group C'], [], True))
+    assert [user['groups'] for user in users] == [['Group A'], ['Group A', 'Group B'], []]
+    # the directory is read once, with the member attribute
+    connector.iter_search_result.assert_called_once()
+    assert 'memberOf' in connector.iter_search_result.call_args[0][3]
+
+    users = list(connector.iter_users_and_groups(['Group A', 'Group B', 'Group C'], [], True))
+    assert [user['email'] for user in users] == ['user1@example.com', 'user2@example.com', 'user3@example.com']
+    assert users[1]['groups'] == ['Group A', 'Group B']
+
+
+def test_scan_group_membership_options(ldap_connector):
+    ldap_connector(scan_group_membership=True, group_member_filter_format='(memberOf={group_dn})')
+    with pytest.raises(AssertionException, match='group_member_filter_format'):
+        ldap_connector(scan_group_membership=True,
+                       group_member_filter_format='(memberOf:1.2.840.113556.1.4.1941:={group_dn})')
+    with pytest.raises(AssertionException, match="'two_steps_lookup', 'nested_group', 'nested_group_strategy'"):
+        ldap_connector(scan_group_membership=True,
+                       two_steps_lookup={'group_member_attribute_name': 'member', 'nested_group': True,
+                                         'nested_group_strategy': 'in_chain'})
+
+
+def test_two_steps_member_lookup_batches(ldap_connector):
+    connector = ldap_connector(two_steps_lookup={'group_member_attribute_name': 'member',
+                                                 'member_lookup_batch_size': 2})
+    connector.find_ldap_group_dns = mock.MagicMock(return_value={
+        'Group A': 'cn=Group A,dc=example,dc=com', 'Group B': 'cn=Group B,dc=example,dc=com'})
+    members = {
+        'cn=Group A,dc=example,dc=com': ['cn=user1,dc=example,dc=com', 'cn=user2,dc=example,dc=com',
+                                         'cn=user3,dc=example,dc=com'],
+        'cn=Group B,dc=example,dc=com': ['CN=user2,dc=example,dc=com', 'cn=user4,dc=example,dc=com'],
+    }
+    connector.iter_group_member_dns = mock.MagicMock(side_effect=lambda group_dn, attribute: members[group_dn])
+
+    def user_record(name):
+        return ['cn=%s,dc=example,dc=com' % name,
+                {'mail': ['%s@example.com' % name], 'givenName': [name], 'sn': ['Last'], 'c': ['us']}]
+
+    def search(base_dn, scope, filter_string, attributes, connection=None):
+        return [user_record(name) for name in ('user1', 'user2', 'user3', 'user4')
+                if '(distinguishedName=cn=%s,dc=example,dc=com)' % name in filter_string]
+
+    connector.iter_search_result.side_effect = search
+    users = {user['email']: user['groups'] for user in connector.load_users_and_groups(['Group A', 'Group B'], [],
+                                                                                       False)}
+    assert users == {'user1@example.com': ['Group A'], 'user2@example.com': ['Group A', 'Group B'],
+                     'user3@example.com': ['Group A'], 'user4@example.com': ['Group B']}
+    # user2 is in both groups, but is only looked up once
+    assert connector.iter_search_result.call_count == 2
+    assert all(call[0][0] == 'dc=example,dc=com' for call in connector.iter_search_result.call_args_list)
+
+    connector.iter_search_result.reset_mock()
+    users = {user['email']: user['groups'] for user in connector.iter_users_and_groups(['Group A', 'Group B'], [],
+                                                                                       False)}
+    assert users['user2@example.com'] == ['Group A', 'Group B']
+    assert len(users) == 4
+    assert connector.iter_search_result.call_count == 2
+
+
+def test_nested_group_member_dns(ldap_connector):
+    connector = ldap_connector(two_steps_lookup={'group_member_attribute_name': 'member', 'nested_group': True})
+    graph = {
+        'cn=a,dc=x': ['cn=b,dc=x', 'cn=c,dc=x', 'cn=u1,dc=x'],
+        'cn=b,dc=x': ['cn=shared,dc=x', 'cn=u2,dc=x'],
+        'cn=c,dc=x': ['CN=Shared,dc=x', 'cn=d,dc=x'],
+        'cn=d,dc=x': ['cn=c,dc=x', 'cn=u3,dc=x'],
+        'cn=shared,dc=x': ['cn=u4,dc=x', 'cn=u2,dc=x'],
+    }
+    searched_dns = []
+
+    def search(search_base, search_filter, search_scope, attributes):
+        searched_dns.append(search_base)
+        entry = mock.MagicMock()
+        entry.entry_attributes_as_dict = {'member': graph.get(search_base.lower(), [])}
+        connector.connection.entries = [entry]
+
+    connector.connection.search.side_effect = search
+    assert list(connector.iter_group_member_dns('cn=a,dc=x', 'member')) == [
+        'cn=u4,dc=x', 'cn=u2,dc=x', 'cn=shared,dc=x', 'cn=b,dc=x', 'cn=u3,dc=x', 'cn=d,dc=x', 'cn=c,dc=x', 'cn=u1,dc=x']
+    # each entry is searched once, even the group shared by b and c, and the cycle between c and d ends
+    assert sorted(dn.lower() for dn in searched_dns) == sorted(
+        ['cn=a,dc=x', 'cn=b,dc=x', 'cn=c,dc=x', 'cn=d,dc=x', 'cn=shared,dc=x',
+         'cn=u1,dc=x', 'cn=u2,dc=x', 'cn=u3,dc=x', 'cn=u4,dc=x'])
+    assert 'cn=c,dc=x' not in connector.nested_member_dns_by_dn
+    assert set(connector.iter_group_member_dns('cn=d,dc=x', 'member')) == {
+        'cn=c,dc=x', 'CN=Shared,dc=x', 'cn=u4,dc=x', 'cn=u2,dc=x', 'cn=u3,dc=x'}
+    assert len(searched_dns) == 9
+
+
+def test_nested_group_strategy(ldap_connector):
+    options = {'two_steps_lookup': {'group_member_attribute_name': 'member', 'nested_group': True,
+                                    'nested_group_strategy': 'in_chain'}}
+
+    def root_dse(*capabilities):
+        entry = mock.MagicMock()
+        entry.entry_attributes_as_dict = {'supportedCapabilities': list(capabilities)}
+        return [entry]
+
+    connector = ldap_connector(**options)
+    connector.connection.entries = root_dse('1.2.840.113556.1.4.800', '1.2.840.113556.1.4.1670')
+    connector.select_nested_group_strategy()
+    assert connector.nested_group_strategy == 'in_chain'
+    assert not connector.options['two_steps_enabled']
+    assert connector.format_group_user_filter('cn=Group A,dc=example,dc=com').startswith(
+        '(&(memberOf:1.2.840.113556.1.4.1941:=cn=Group A,dc=example,dc=com)')
+
+    # not Active Directory: the groups are expanded by the client
+    connector = ldap_connector(**options)
+    connector.connection.entries = root_dse()
+    connector.select_nested_group_strategy()
+    assert connector.nested_group_strategy == 'client'
+    assert connector.options['two_steps_enabled']
+
+    options['two_steps_lookup']['nested_group_strategy'] = 'server'
+    with pytest.raises(AssertionException):
+        ldap_connector(**options)
+
+
+def test_value_formatter():
+    record = {'givenName': ['Jane'], 'SN': ['Doe'], 'mail': 'jane@example.com', 'c': []}
+    index = LDAPValueFormatter.index_record(record)
+    assert LDAPValueFormatter('{mail}').generate_value(record, index) == ('jane@example.com', 'mail')
+    assert LDAPValueFormatter('{givenname} {sn}').generate_value(record, index) == ('Jane Doe', 'sn')
+    assert LDAPValueFormatter('{givenName}.{sn}').generate_value(record) == (None, 'sn')
+    assert LDAPValueFormatter('{c}').generate_value(record, index) == (None, 'c')
+    assert LDAPValueFormatter('{mail!r}').generate_value(record, index) == ("'jane@example.com'", 'mail')
+    assert LDAPValueFormatter(None).generate_value(record, index) == (None, None)
+
+
+def test_iter_prefetched():
+    records = [('cn=user%d,dc=example,dc=com' % i, {'mail': ['user%d@example.com' % i]}) for i in range(25)]
+    assert list(LDAPDirectoryConnector.iter_prefetched(iter(records), 4, 2)) == records
+
+    def failing_search():
+        yield records[0]
+        raise ValueError('connection lost')
+
+    with pytest.raises(ValueError):
+        list(LDAPDirectoryConnector.iter_prefetched(failing_search(), 4, 2))
+
+    # the reader stops when the caller stops early
+    read = []
+
+    def search():
+        for record in records:
+            read.append(record)
+            yield record
+
+    prefetched = LDAPDirectoryConnector.iter_prefetched(search(), 1, 1)
+    assert next(prefetched) == records[0]
+    prefetched.close()
+    assert len(read) < len(records)
+
+
+def test_get_cn_from_dn_cache():
+    LDAPDirectoryConnector.get_cn_from_dn.cache_clear()
+    for _ in range(3):
+        assert LDAPDirectoryConnector.get_cn_from_dn('CN=Acrobat Users,OU=Groups,DC=example,DC=com') == 'Acrobat Users'
+    assert LDAPDirectoryConnector.get_cn_from_dn.cache_info().hits == 2
+
+
+def test_user_cache(ldap_connector, tmp_path):
+    connector = ldap_connector(all_users_filter='(objectClass=user)',
+                               cache={'path': str(tmp_path), 'users': {'full_reload_interval': 3600}})
+    connector.ldap_cache = LdapCache(tmp_path)
+    root_dse = mock.MagicMock()
+    connector.connection.entries = [root_dse]
+
+    def user_record(name, guid, ou='users'):
+        return ['cn=%s,ou=%s,dc=example,dc=com' % (name, ou),
+                {'mail': ['%s@example.com' % name], 'givenName': [name], 'sn': ['Last'], 'c': ['us'],
+                 'objectGUID': guid}]
+
+    results = {'(objectClass=user)': [user_record('user1', '{1}'), user_record('user2', '{2}')]}
+    connector.iter_search_result.side_effect = lambda base_dn, scope, filter_string, attributes: \
+        results[filter_string]
+    root_dse.entry_attributes_as_dict = {'highestCommittedUSN': [1000]}
+    users = list(connector.iter_users_and_groups([], [], True))
+    assert [user['email'] for user in users] == ['user1@example.com', 'user2@example.com']
+    assert 'objectGUID' in connector.iter_search_result.call_args[0][3]
+
+    # only the changes since the last read are read: user1 is moved, user2 is disabled and user3 is new
+    connector.user_by_dn = {}
+    results['(&(objectClass=user)(uSNChanged>=1001))'] = [user_record('user1', '{1}', 'moved'),
+                                                         user_record('user3', '{3}')]
+    results['(&(!(objectClass=user))(uSNChanged>=1001))'] = [['cn=user2,ou=users,dc=example,dc=com',
+                                                              {'objectGUID': '{2}'}]]
+    root_dse.entry_attributes_as_dict = {'highestCommittedUSN': [1020]}
+    connector.iter_search_result.reset_mock()
+    users = list(connector.iter_users_and_groups([], [], True))
+    assert sorted(user['email'] for user in users) == ['user1@example.com', 'user3@example.com']
+    assert connector.iter_search_result.call_count == 2
+    assert connector.ldap_cache.get_user_meta()[1] == '1020'
+
+    # a change to the search reads all users again
+    connector.options['all_users_filter'] = '(objectClass=person)'
+    results['(objectClass=person)'] = [user_record('user4', '{4}')]
+    users = list(connector.iter_users_and_groups([], [], True))
+    assert [user['email'] for user in users] == ['user4@example.com']
+
+
+def test_group_members_cache(ldap_connector, tmp_path):
+    def make_connector():
+        connector = ldap_connector(two_steps_lookup={'group_member_attribute_name': 'member', 'nested_group': True},
+                                   cache={'path': str(tmp_path), 'group_members_ttl': 3600})
+        connector.ldap_cache = LdapCache(tmp_path, group_members_ttl=3600)
+        connector.read_server_attribute = mock.MagicMock(return_value=usn[0])
+
+        def search(search_base, search_filter, search_scope, attributes):
+            searched_dns.append(search_base)
+            assert attributes == ['member', 'uSNChanged']
+            entry = mock.MagicMock()
+            entry.entry_attributes_as_dict = {'member': graph.get(search_base, []), 'uSNChanged': stamps[search_base]}
+            connector.connection.entries = [entry]
+
+        connector.connection.search.side_effect = search
+        return connector
+
+    graph = {'cn=a,dc=x': ['cn=b,dc=x', 'cn=u1,dc=x'], 'cn=b,dc=x': ['cn=u2,dc=x']}
+    stamps = {'cn=a,dc=x': 10, 'cn=b,dc=x': 11, 'cn=u1,dc=x': 12, 'cn=u2,dc=x': 13, 'cn=u3,dc=x': 14}
+    usn = ['100']
+    searched_dns = []
+    connector = make_connector()
+    assert list(connector.iter_group_member_dns('cn=a,dc=x', 'member')) == [
+        'cn=u2,dc=x', 'cn=b,dc=x', 'cn=u1,dc=x']
+    assert len(searched_dns) == 4
+    connector.iter_search_result.assert_not_called()
+
+    # b gained a member since; a is found as well, but its stamp hasn't moved, so only b is searched again
+    graph['cn=b,dc=x'] = ['cn=u2,dc=x', 'cn=u3,dc=x']
+    stamps['cn=b,dc=x'] = 105
+    usn[0] = '200'
+    searched_dns = []
+    connector = make_connector()
+    connector.iter_search_result.return_value = [['cn=a,dc=x', {'uSNChanged': 10}],
+                                                 ['cn=b,dc=x', {'uSNChanged': [105]}]]
+    assert list(connector.iter_group_member_dns('cn=a,dc=x', 'member')) == [
+        'cn=u2,dc=x', 'cn=u3,dc=x', 'cn=b,dc=x', 'cn=u1,dc=x']
+    assert searched_dns == ['cn=b,dc=x', 'cn=u3,dc=x']
+    assert connector.iter_search_result.call_args[0][2] == '(uSNChanged>=101)'
+    assert connector.ldap_cache.get_group_members_mark('member') == '200'
+
+    # the next run finds nothing changed
+    searched_dns = []
+    connector = make_connector()
+    connector.iter_search_result.return_value = []
+    assert len(list(connector.iter_group_member_dns('cn=a,dc=x', 'member'))) == 4
+    assert searched_dns == []
+    assert connector.iter_search_result.call_args[0][2] == '(uSNChanged>=201)'
+
+
+def test_change_high_water_mark(ldap_connector):
+    connector = ldap_connector()
+    entries_by_dn = {}
+
+    def search(search_base, search_filter, search_scope, attributes):
+        entry = mock.MagicMock()
+        entry.entry_attributes_as_dict = entries_by_dn.get(search_base, {})
+        connector.connection.entries = [entry]
+    connector.connection.search.side_effect = search
+
+    # the mark is the server's time (never the local clock), less the overlap
+    entries_by_dn[''] = {'currentTime': ['20260102030405.0Z']}
+    assert connector.get_change_high_water_mark('modifyTimestamp') == '20260102025905Z'
+    entries_by_dn[''] = {'currentTime': [datetime(2026, 1, 2, 4, 4, 5, tzinfo=timezone(timedelta(hours=1)))]}
+    assert connector.get_change_high_water_mark('modifyTimestamp') == '20260102025905Z'
+    entries_by_dn[''] = {'highestCommittedUSN': ['1000']}
+    assert connector.get_change_high_water_mark('uSNChanged') == '1000'
+    entries_by_dn['cn=Current,cn=Time,cn=Monitor'] = {'monitorTimestamp': ['20260102040405+0100']}
+    assert connector.get_change_high_water_mark('modifyTimestamp') == '20260102025905Z'
+    del entries_by_dn['cn=Current,cn=Time,cn=Monitor']
+    with pytest.raises(AssertionException):
+        connector.get_change_high_water_mark('modifyTimestamp')
+    entries_by_dn[''] = {}
+    with pytest.raises(AssertionException):
+        connector.get_change_high_water_mark('uSNChanged')
@@ -0,0 +1,152 @@
+import logging
+import threading
+
+import mock
+import pytest
+
+from okta.framework.OktaError import OktaError
+
+from user_sync.cache.okta import OktaCache
+from user_sync.connector.directory_okta import OktaDirectoryConnector, OKTAValueFormatter, OktaRateLimit
+from user_sync.error import AssertionException
+
+
+@pytest.fixture
+def okta_connector():
+    def _okta_connector(**options):
+        """
+        Make a connector without connecting to Okta: group members are answered by mocking the groups client
+        """
+        connector = OktaDirectoryConnector.__new__(OktaDirectoryConnector)
+        connector.options = dict({'all_users_filter': 'user.status == "ACTIVE"', 'group_filter_format': '{group}',
+                                  'group_fetch_workers': 1, 'list_all_groups': False}, **options)
+        connector.logger = logging.getLogger('okta')
+        connector.user_identity_type = 'federatedID'
+        formats = {'identity_type': None, 'email': '{email}', 'username': None, 'domain': None,
+                   'given_name': '{firstName}', 'surname': '{lastName}', 'country_code': '{countryCode}'}
+        for name, string_format in formats.items():
+            setattr(connector, 'user_%s_formatter' % name, OKTAValueFormatter(string_format))
+        connector.user_by_uid = {}
+        connector.converted_user_by_id = {}
+        connector.group_member_count = 0
+        connector.member_count_lock = threading.Lock()
+        connector.users_filter = OktaDirectoryConnector.compile_users_filter(connector.options['all_users_filter'])
+        connector.okta_cache = None
+        connector.cached_group_names = set()
+        connector.refreshed_group_ids = []
+        connector.groups_client = mock.MagicMock()
+        connector.find_group = mock.MagicMock(side_effect=lambda group: mock.MagicMock(id=group))
+        return connector
+
+    return _okta_connector
+
+
+def okta_user(uid, status='ACTIVE'):
+    profile = mock.MagicMock(spec=['login', 'email', 'firstName', 'lastName', 'countryCode'],
+                             login=uid, email='%s@example.com' % uid, firstName=uid, lastName='Last',
+                             countryCode='us')
+    return mock.MagicMock(id=uid, status=status, profile=profile)
+
+
+def test_load_users_and_groups_workers(okta_connector):
+    members = {
+        'Group A': [okta_user('user1'), okta_user('user2'), okta_user('user3', 'SUSPENDED')],
+        'Group B': [okta_user('user2'), okta_user('user4')],
+        'Group C': [okta_user('user4'), okta_user('user1')],
+    }
+    loaded = []
+    for workers in (1, 3):
+        connector = okta_connector(group_fetch_workers=workers)
+        connector.groups_client.get_group_all_users.side_effect = lambda gid, attr_dict: members[gid]
+        users = connector.load_users_and_groups(['Group A', 'Group B', 'Group C'], [], False)
+        loaded.append([(user['uid'], user['email'], user['groups']) for user in users])
+    assert loaded[0] == loaded[1] == [
+        ('user1', 'user1@example.com', ['Group A', 'Group C']),
+        ('user2', 'user2@example.com', ['Group A', 'Group B']),
+        ('user4', 'user4@example.com', ['Group B', 'Group C']),
+    ]
+    assert connector.group_member_count == 7
+    assert len(connector.user_by_uid) == 3
+
+
+def test_convert_user_once(okta_connector):
+    connector = okta_connector()
+    members = {'Group A': [okta_user('user1'), okta_user('user2', 'SUSPENDED')],
+               'Group B': [okta_user('user1'), okta_user('user2', 'SUSPENDED')]}
+    connector.groups_client.get_group_all_users.side_effect = lambda gid, attr_dict: members[gid]
+    with mock.patch.object(connector, 'convert_user', wraps=connector.convert_user) as convert_user:
+        users = list(connector.load_users_and_groups(['Group A', 'Group B'], [], False))
+    assert convert_user.call_count == 1
+    assert [user['groups'] for user in users] == [['Group A', 'Group B']]
+    assert connector.group_member_count == 4
+
+
+def test_rate_limit():
+    rate_limit = OktaRateLimit(2)
+    with mock.patch('time.sleep') as sleep, mock.patch('time.time', return_value=1000.0):
+        rate_limit.wait()
+        rate_limit.update({'X-Rate-Limit-Remaining': '4', 'X-Rate-Limit-Reset': '1030'})
+        # an older window's headers don't count
+        rate_limit.update({'X-Rate-Limit-Remaining': '50', 'X-Rate-Limit-Reset': '970'})
+        rate_limit.wait()
+        rate_limit.wait()
+        sleep.assert_not_called()
+        # the requests left are down to the reserve, so the next waits for the window to reset
+        rate_limit.wait()
+        sleep.assert_called_once_with(30.0)
+        rate_limit.update({})
+        assert rate_limit.remaining == 1
+
+
+def test_filter_users(okta_connector):
+    connector = okta_connector(all_users_filter='user.status == "ACTIVE" and len(user.profile.login) > 3')
+    users = [okta_user('user1'), okta_user('user2', 'SUSPENDED'), okta_user('u3')]
+    selected = connector.filter_users(iter(users), connector.options['all_users_filter'])
+    assert next(selected) is users[0]
+    assert list(selected) == []
+    assert list(connector.filter_users(users, 'user.status != "ACTIVE"')) == [users[1]]
+    with pytest.raises(AssertionException):
+        list(connector.filter_users(users, 'user.profile.missing.name'))
+    with pytest.raises(AssertionException):
+        OktaDirectoryConnector.compile_users_filter('user.status ==')
+
+
+def test_list_all_groups(okta_connector, tmp_path):
+    connector = okta_connector(list_all_groups=True)
+    connector.okta_cache = OktaCache(tmp_path)
+    pages = [mock.MagicMock(next_url='next'), mock.MagicMock()]
+    pages[0].response.json.return_value = [{'id': 'id-a', 'profile': {'name': 'Group A'}}]
+    pages[0].is_last_page.return_value = False
+    pages[1].response.json.return_value = [{'id': 'id-b', 'profile': {'name': 'Group B'}}]
+    pages[1].is_last_page.return_value = True
+    connector.groups_client.get_paged_groups.side_effect = pages
+    members = {'id-a': [okta_user('user1')], 'id-b': [okta_user('user1'), okta_user('user2')]}
+    connector.groups_client.get_group_all_users.side_effect = lambda gid, attr_dict: members[gid]
+    users = list(connector.load_users_and_groups(['Group A', 'Group B', 'Group C'], [], False))
+    assert [(user['uid'], user['groups']) for user in users] == [('user1', ['Group A', 'Group B']),
+                                                                 ('user2', ['Group B'])]
+    connector.find_group.assert_not_called()
+    assert connector.groups_client.get_paged_groups.call_count == 2
+    assert connector.okta_cache.get_group_ids() == {'Group A': 'id-a', 'Group B': 'id-b'}
+
+
+def test_cached_group_id_refresh(okta_connector, tmp_path):
+    connector = okta_connector()
+    connector.okta_cache = OktaCache(tmp_path)
+    connector.okta_cache.cache_group_ids([('Group A', 'old-a'), ('Group B', 'id-b')])
+    members = {'new-a': [okta_user('user1')], 'id-b': [okta_user('user2')]}
+
+    def get_group_all_users(gid, attr_dict):
+        if gid not in members:
+            raise OktaError({'errorSummary': 'Not found: Resource not found: %s (UserGroup)' % gid})
+        return members[gid]
+    connector.groups_client.get_group_all_users.side_effect = get_group_all_users
+    connector.find_group = mock.MagicMock(side_effect=lambda group: mock.MagicMock(id='new-a'))
+    users = list(connector.load_users_and_groups(['Group A', 'Group B'], [], False))
+    assert [(user['uid'], user['groups']) for user in users] == [('user1', ['Group A']), ('user2', ['Group B'])]
+    connector.find_group.assert_called_once_with('Group A')
+    assert connector.okta_cache.get_group_ids() == {'Group A': 'new-a', 'Group B': 'id-b'}
+    # a stale id is looked up again only once
+    members.pop('new-a')
+    with pytest.raises(AssertionException):
+        list(connector.load_users_and_groups(['Group A'], [], False))
@@ -0,0 +1,61 @@
+import logging
+import threading
+
+import umapi_client
+from mock import MagicMock
+
+from user_sync.connector.connector_umapi import ActionManager
+
+
+class MockConnection:
+    """Stands in for a umapi_client.Connection: records the batches it sends, and the sync signals sent with them"""
+
+    def __init__(self, batches, lock, failing_batch=None):
+        self.batches = batches
+        self.lock = lock
+        self.failing_batch = failing_batch
+        self.throttle_actions = 3
+        self.sync_started = False
+        self.sync_ended = False
+        self.action_queue = []
+        self.local_status = {}
+        self.session = MagicMock()
+
+    def execute_multiple(self, actions, immediate=True):
+        with self.lock:
+            signal = 'start' if self.sync_started else 'end' if self.sync_ended else None
+            self.sync_started = self.sync_ended = False
+            self.batches.append(([a.name for a in actions], signal))
+        if self.failing_batch is not None and self.failing_batch in [a.name for a in actions]:
+            raise umapi_client.BatchError([Exception('bad batch')], 0, len(actions), 0)
+        return 0, len(actions), len(actions)
+
+
+def test_batched_action_manager():
+    batches = []
+    connection = MockConnection(batches, threading.Lock(), failing_batch='a4')
+    action_manager = ActionManager(connection, 'org', logging.getLogger('test'), max_in_flight=2)
+    results = {}
+
+    def add_action(name):
+        action = MagicMock()
+        action.name = name
+        action.execution_errors.return_value = []
+        action.wire_dict.return_value = {'requestID': name}
+        action_manager.add_action(action, lambda r: results.update({name: r['is_success']}))
+
+    connection.sync_started = True
+    for i in range(8):
+        add_action('a%d' % i)
+    connection.sync_ended = True
+    add_action('a8')
+    while action_manager.has_work():
+        action_manager.flush()
+
+    # the first batch carries the start signal; the rest after the end signal is sent last, with it
+    assert batches[0] == (['a0', 'a1', 'a2'], 'start')
+    assert batches[-1] == (['a6', 'a7', 'a8'], 'end')
+    assert sorted(batches[1:-1]) == [(['a3', 'a4', 'a5'], None)]
+    # callbacks and error counts work as for unbatched actions
+    assert results == {'a%d' % i: i not in (3, 4, 5) for i in range(9)}
+    assert action_manager.get_statistics() == (9, 3)
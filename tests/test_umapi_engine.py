@@ -1,5 +1,9 @@
 import csv
+import functools
+import logging
+import multiprocessing
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 import mock
 import pytest
@@ -7,8 +11,11 @@ import yaml
 from mock import MagicMock
 
 from tests.util import compare_iter
+from user_sync.connector.directory_csv import CSVSourceAttributes
 from user_sync.connector.connector_umapi import Commands
 from user_sync.engine.common import AdobeGroup
+from user_sync.config.user_sync import UMAPIConfigLoader
+from user_sync.engine.hook_pool import find_shared_state
 from user_sync.engine.umapi import UmapiTargetInfo, UmapiConnectors, RuleProcessor
 
 
@@ -55,7 +62,7 @@ class MockUmapiConnector(MagicMock):
         self.commands_sent = None
         self.users = {}
 
-    def send_commands(self, commands):
+    def send_commands(self, commands, callback=None):
         self.commands_sent = commands
 
     def get_action_manager(self):
@@ -336,6 +343,159 @@ def test_read_desired_user_groups_basic(rule_processor, mock_dir_user):
     assert ('console group' in rp.umapi_info_by_name[None].desired_groups_by_user_key[user_key])
     assert user_key in rp.filtered_directory_user_by_user_key
 
+def test_read_desired_user_groups_function_hook(mock_dir_user):
+    hook_text = """
+def after_mapping(user, groups):
+    user['country'] = 'GB'
+    if 'Group B' in user['groups']:
+        groups.add('Group Hook')
+"""
+    after_mapping_hook = UMAPIConfigLoader.compile_after_mapping_hook(hook_text, is_function=True)
+    rp = RuleProcessor({'after_mapping_hook': after_mapping_hook, 'after_mapping_hook_is_function': True})
+    mock_dir_user['groups'] = ['Group A', 'Group B']
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = [mock_dir_user]
+    AdobeGroup.create('Group Hook')
+    rp.read_desired_user_groups({'Group A': [AdobeGroup.create('Console Group')]}, directory_connector)
+
+    user_key = rp.get_directory_user_key(mock_dir_user)
+    assert rp.filtered_directory_user_by_user_key[user_key]['country'] == 'GB'
+    assert rp.umapi_info_by_name[None].get_desired_groups(user_key) == {'console group', 'group hook'}
+    assert rp.after_mapping_hook_count == 1
+
+
+def test_read_desired_user_groups_hook_source_attributes(mock_dir_user):
+    hook_text = """
+source_attributes['c'] = source_attributes['c'].lower()
+target_attributes['country'] = source_attributes['c']
+"""
+    after_mapping_hook = UMAPIConfigLoader.compile_after_mapping_hook(hook_text)
+    rp = RuleProcessor({'after_mapping_hook': after_mapping_hook})
+    mock_dir_user['groups'] = ['Group A']
+    mock_dir_user['source_attributes'] = source_attributes = CSVSourceAttributes(('c',), ('GB',))
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = [mock_dir_user]
+    rp.read_desired_user_groups({'Group A': [AdobeGroup.create('Console Group')]}, directory_connector)
+
+    user_key = rp.get_directory_user_key(mock_dir_user)
+    assert rp.filtered_directory_user_by_user_key[user_key]['country'] == 'gb'
+    # the hook's writes to source_attributes don't reach the directory user
+    assert rp.filtered_directory_user_by_user_key[user_key]['source_attributes'] is source_attributes
+    assert source_attributes['c'] == 'GB'
+
+
+def test_read_desired_user_groups_function_hook_spawn(get_mock_user, caplog):
+    hook_text = """
+def after_mapping(user, groups):
+    user['groups'].append('Group Hook')
+    user['department'] = user['source_attributes']['dept']
+    logger.warning('department %(department)s', user)
+    del user['source_attributes']
+    groups.add('Group Hook')
+"""
+    after_mapping_hook = UMAPIConfigLoader.compile_after_mapping_hook(hook_text, is_function=True)
+    rp = RuleProcessor({'after_mapping_hook': after_mapping_hook, 'after_mapping_hook_is_function': True,
+                        'after_mapping_hook_processes': 2, 'after_mapping_hook_chunk_size': 2})
+    users = []
+    for i in range(3):
+        user = get_mock_user('user%d' % i)
+        user['groups'] = ['Group A']
+        user['source_attributes'] = {'dept': 'D%d' % i}
+        users.append(user)
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = users
+    AdobeGroup.create('Group Hook')
+    # the workers are started as they are on Windows and macOS, without a copy of this process
+    spawn_executor = functools.partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('spawn'))
+    with mock.patch('user_sync.engine.hook_pool.ProcessPoolExecutor', spawn_executor):
+        rp.read_desired_user_groups({'Group A': [AdobeGroup.create('Console Group')]}, directory_connector)
+
+    assert rp.after_mapping_hook_count == 3
+    assert [r.getMessage() for r in caplog.records if r.name == 'processor' and r.levelno == logging.WARNING] == \
+        ['department D%d' % i for i in range(3)]
+    for i, user in enumerate(users):
+        user_key = rp.get_directory_user_key(user)
+        # every change the hook made to the user in its worker is made to the user
+        assert rp.filtered_directory_user_by_user_key[user_key] is user
+        assert user['groups'] == ['Group A', 'Group Hook']
+        assert user['department'] == 'D%d' % i
+        assert 'source_attributes' not in user
+        assert rp.umapi_info_by_name[None].get_desired_groups(user_key) == {'console group', 'group hook'}
+
+
+def test_find_shared_state():
+    def shared_state(hook_text, is_function=False):
+        return find_shared_state(UMAPIConfigLoader.compile_after_mapping_hook(hook_text, is_function), is_function)
+
+    assert shared_state("bc = source_attributes.get('bc')\nif bc:\n    target_attributes['country'] = bc[:2]\n") == []
+    assert shared_state("hook_storage = hook_storage or {}\n") == ['hook_storage']
+    assert shared_state("count = count + 1 if 'count' in dir() else 1\n") == ["variable 'count' from the user before"]
+    assert shared_state("def after_mapping(user, groups):\n    user['country'] = len(hook_storage)\n",
+                        is_function=True) == ['hook_storage']
+    assert shared_state("count = 0\ndef after_mapping(user, groups):\n    global count\n    count += 1\n",
+                        is_function=True) == ["global variable 'count'"]
+    assert shared_state("lookup = {'a': 'b'}\ndef after_mapping(user, groups):\n"
+                        "    user['country'] = lookup.get(user['country'])\n", is_function=True) == []
+
+
+def test_read_desired_user_groups_hook_processes(get_mock_user, caplog):
+    hook_text = """
+target_attributes['country'] = source_attributes['c']
+logger.debug('not logged')
+logger.info('country %s', target_attributes['country'])
+if 'Group B' in source_groups:
+    target_groups.add('Group Hook')
+"""
+    caplog.set_level(logging.INFO, logger='processor')
+    after_mapping_hook = UMAPIConfigLoader.compile_after_mapping_hook(hook_text)
+    rp = RuleProcessor({'after_mapping_hook': after_mapping_hook, 'after_mapping_hook_processes': 2,
+                        'after_mapping_hook_chunk_size': 2})
+    users = []
+    for i in range(5):
+        user = get_mock_user('user%d' % i)
+        user['groups'] = ['Group A', 'Group B'] if i % 2 else ['Group A']
+        user['source_attributes'] = {'c': 'C%d' % i}
+        users.append(user)
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = users
+    AdobeGroup.create('Group Hook')
+    rp.read_desired_user_groups({'Group A': [AdobeGroup.create('Console Group')]}, directory_connector)
+
+    assert rp.after_mapping_hook_count == 5
+    # the messages the hook logged in the workers are logged here, in user order
+    assert [r.getMessage() for r in caplog.records if r.name == 'processor' and 'country' in r.getMessage()] == \
+        ['country C%d' % i for i in range(5)]
+    assert 'not logged' not in caplog.text
+    user_keys = [rp.get_directory_user_key(user) for user in users]
+    assert list(rp.umapi_info_by_name[None].get_desired_groups_by_user_key()) == user_keys
+    for i, user_key in enumerate(user_keys):
+        assert rp.filtered_directory_user_by_user_key[user_key]['country'] == 'C%d' % i
+        expected_groups = {'console group', 'group hook'} if i % 2 else {'console group'}
+        assert rp.umapi_info_by_name[None].get_desired_groups(user_key) == expected_groups
+
+
+def test_read_desired_user_groups_additional_groups(get_mock_user):
+    rp = RuleProcessor({'additional_groups': [
+        {'source': re.compile(r'ACL-(.+)'), 'target': AdobeGroup.create(r'ACL-Grp-(\1)', index=False)}]})
+    users = []
+    for i in range(3):
+        user = get_mock_user('user%d' % i)
+        user['groups'] = []
+        user['member_groups'] = ['ACL-Photoshop', 'Other'] if i else ['ACL-Photoshop', 'ACL-Acrobat']
+        users.append(user)
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = users
+    with mock.patch.object(rp, 'resolve_additional_groups', wraps=rp.resolve_additional_groups) as resolve:
+        rp.read_desired_user_groups({}, directory_connector)
+    # each member group is matched against the rules only once
+    assert sorted(call[0][0] for call in resolve.call_args_list) == ['ACL-Acrobat', 'ACL-Photoshop', 'Other']
+    umapi_info = rp.umapi_info_by_name[None]
+    assert umapi_info.get_desired_groups(rp.get_directory_user_key(users[0])) == {'acl-grp-(photoshop)',
+                                                                                  'acl-grp-(acrobat)'}
+    assert umapi_info.get_desired_groups(rp.get_directory_user_key(users[2])) == {'acl-grp-(photoshop)'}
+    assert umapi_info.get_additional_group_map()['acl-grp-(photoshop)'] == ['ACL-Photoshop']
+
+
 @mock.patch('user_sync.helper.CSVAdapter.read_csv_rows')
 def test_read_stray_key_map(csv_reader, rule_processor):
     csv_mock_data = [
@@ -496,3 +656,198 @@ class TestUmapiTargetInfo():
             mock_desired_groups.return_value = None
             umapi_target_info.add_desired_group_for('user_key', 'group_name')
             assert umapi_target_info.desired_groups_by_user_key['user_key'] == {'group_name'}
+
+    def test_group_sets(self):
+        umapi_target_info = UmapiTargetInfo("")
+        umapi_target_info.add_mapped_group("Group A")
+        umapi_target_info.add_mapped_group("Group B")
+        umapi_target_info.add_desired_group_for('user_key', 'Group A')
+        umapi_target_info.add_desired_group_for('user_key', 'Group C')
+        desired_groups = umapi_target_info.get_desired_groups('user_key')
+        current_groups = umapi_target_info.get_group_set(['GROUP B', 'Group D'])
+        mapped_groups = umapi_target_info.get_mapped_groups()
+        assert desired_groups - current_groups == {'group a', 'group c'}
+        assert (current_groups - desired_groups) & mapped_groups == {'group b'}
+        assert current_groups & {'group d', 'group e'} == {'group d'}
+        assert not desired_groups & current_groups
+        assert len(current_groups | desired_groups) == 4
+
+
+def test_sync_umapi_users_concurrent_fetch(rule_processor, get_mock_user, mock_umapi_connectors):
+    rp = rule_processor
+    rp.options['process_groups'] = True
+    rp.options['exclude_unmapped_users'] = False
+    rp.exclude_identity_types = ['adobeID']
+
+    directory_users = [get_mock_user('user1', groups=['Group A']),
+                       get_mock_user('user2', groups=['Group A'], identity_type='adobeID')]
+    for directory_user in directory_users:
+        user_key = rp.get_directory_user_key(directory_user)
+        rp.directory_user_by_user_key[user_key] = rp.filtered_directory_user_by_user_key[user_key] = directory_user
+        rp.get_umapi_info(None).add_desired_group_for(user_key, None)
+        rp.get_umapi_info('secondary').add_mapped_group('Group A')
+        rp.get_umapi_info('secondary').add_desired_group_for(user_key, 'Group A')
+
+    def sync(request_concurrency):
+        rp.options['request_concurrency'] = request_concurrency
+        rp.included_user_keys = set()
+        for umapi_info in rp.umapi_info_by_name.values():
+            umapi_info.umapi_user_by_user_key = {}
+        connectors = mock_umapi_connectors('secondary')
+        for connector in connectors.connectors:
+            connector.uses_business_id = False
+            connector.users = [get_mock_user('user1', is_umapi_user=True),
+                               get_mock_user('user2', is_umapi_user=True, identity_type='adobeID')]
+        primary_commands, secondary_command_lists = rp.sync_umapi_users(connectors)
+        return ([vars(c) for c in primary_commands],
+                {k: [vars(c) for c in v] for k, v in secondary_command_lists.items()})
+
+    serial = sync(1)
+    concurrent = sync(4)
+    assert serial == concurrent
+    # only the included primary user is managed in the secondary
+    assert [c['email'] for c in concurrent[1]['secondary']] == ['user1@example.com']
+    assert ('add_to_groups', {'groups': {'group a'}}) in concurrent[1]['secondary'][0]['do_list']
+
+
+def test_delta_sync_snapshot(get_mock_user, tmp_path):
+    options = {'cache_path': str(tmp_path), 'delta_sync': True, 'process_groups': True}
+
+    def sync(umapi_users):
+        rp = RuleProcessor(options)
+        directory_user = get_mock_user('user1', groups=['Group A'])
+        user_key = rp.get_directory_user_key(directory_user)
+        rp.directory_user_by_user_key[user_key] = rp.filtered_directory_user_by_user_key[user_key] = directory_user
+        umapi_info = rp.get_umapi_info(None)
+        umapi_info.add_mapped_group('Group A')
+        umapi_info.add_desired_group_for(user_key, 'Group A')
+        conn = MockUmapiConnector()
+        conn.uses_business_id = False
+        conn.users = umapi_users
+        conn.get_user = MagicMock(return_value={})
+        _, commands = rp.update_umapi_users_for_connector(umapi_info, conn)
+        return rp, conn, commands
+
+    user1 = get_mock_user('user1', is_umapi_user=True)
+    user2 = get_mock_user('user2', is_umapi_user=True)
+
+    # the first run reads everything from the umapi and saves the snapshot
+    rp, _, commands = sync([user1, user2])
+    umapi_cache = rp.get_umapi_cache(rp.get_umapi_info(None))
+    assert not umapi_cache.should_refresh
+    assert len(umapi_cache.get_users()) == 2
+    assert len(commands) == 1
+    rp.get_umapi_cache_callback(umapi_cache, commands[0])({'is_success': True})
+    user2_key = rp.get_umapi_user_key(user2)
+    umapi_cache.update_user_refresh_status(user2_key, needs_refresh=True)
+
+    # the second run works from the snapshot, which has the group added by the first run,
+    # and only re-reads the flagged user (who no longer exists)
+    rp, conn, commands = sync([])
+    assert commands == []
+    assert rp.primary_user_count == 1
+    conn.get_user.assert_called_once_with(user2['email'])
+    umapi_cache = rp.get_umapi_cache(rp.get_umapi_info(None))
+    assert [u['email'] for u in umapi_cache.get_users()] == [user1['email']]
+
+
+def test_skip_unchanged_users(get_mock_user, tmp_path):
+    options = {'cache_path': str(tmp_path), 'delta_sync': True, 'skip_unchanged_users': True,
+               'process_groups': True, 'update_user_info': True}
+
+    def sync(directory_groups, umapi_users=()):
+        rp = RuleProcessor(options)
+        umapi_info = rp.get_umapi_info(None)
+        umapi_info.add_mapped_group('Group A')
+        umapi_info.add_mapped_group('Group B')
+        for name in ('user1', 'user2'):
+            directory_user = get_mock_user(name, groups=directory_groups)
+            user_key = rp.get_directory_user_key(directory_user)
+            rp.directory_user_by_user_key[user_key] = rp.filtered_directory_user_by_user_key[user_key] = directory_user
+            umapi_info.add_desired_group_for(user_key, None)
+            for group in directory_groups:
+                umapi_info.add_desired_group_for(user_key, group)
+        conn = MockUmapiConnector()
+        conn.uses_business_id = False
+        conn.users = list(umapi_users)
+        conn.get_user = MagicMock(return_value=get_mock_user('user1', is_umapi_user=True, groups=['Group A']))
+        with mock.patch.object(RuleProcessor, 'get_user_attribute_difference', return_value={}) as difference:
+            creates, commands = rp.update_umapi_users_for_connector(umapi_info, conn)
+        return rp, rp.get_umapi_cache(umapi_info), creates, commands, difference
+
+    def finish(rp, umapi_cache, commands, is_success=True):
+        for c in commands:
+            rp.get_umapi_cache_callback(umapi_cache, c)({'is_success': is_success})
+        rp.save_user_hashes()
+
+    # the first run reads the umapi and compares everything; user1 is updated, and confirmed once that succeeds
+    umapi_users = [get_mock_user(name, is_umapi_user=True, groups=[]) for name in ('user1', 'user3')]
+    rp, umapi_cache, creates, commands, _ = sync(['Group A'], umapi_users)
+    assert len(commands) == 1
+    assert umapi_cache.get_user_hashes() == {}
+    finish(rp, umapi_cache, commands)
+    user1_key = rp.get_user_key('federatedID', 'user1@example.com', 'example.com')
+    assert list(umapi_cache.get_user_hashes()) == [user1_key]
+
+    # nothing has changed since, so user1 is skipped without being compared with its snapshot;
+    # user2 still has to be created, and user3 is still an Adobe-only user
+    rp, umapi_cache, creates, commands, difference = sync(['Group A'])
+    difference.assert_not_called()
+    assert commands == []
+    assert list(creates) == [rp.get_user_key('federatedID', 'user2@example.com', 'example.com')]
+    assert rp.primary_user_count == 2
+    finish(rp, umapi_cache, commands)
+
+    # a change in the directory brings user1 back into the comparison, but its update fails
+    rp, umapi_cache, creates, commands, difference = sync(['Group A', 'Group B'])
+    difference.assert_called_once()
+    assert len(commands) == 1
+    assert ('add_to_groups', {'groups': {'group b'}}) in commands[0].do_list
+    finish(rp, umapi_cache, commands, is_success=False)
+    assert umapi_cache.get_user_hashes() == {}
+
+    # the flagged user is read again and compared, though the directory hasn't changed
+    rp, umapi_cache, creates, commands, difference = sync(['Group A', 'Group B'])
+    assert len(commands) == 1
+    assert ('add_to_groups', {'groups': {'group b'}}) in commands[0].do_list
+    finish(rp, umapi_cache, commands)
+
+    # once confirmed, user1 is skipped again
+    rp, umapi_cache, creates, commands, difference = sync(['Group A', 'Group B'])
+    difference.assert_not_called()
+    assert commands == []
+
+
+def test_streaming_creates(rule_processor, get_mock_user, mock_umapi_connectors):
+    rp = rule_processor
+    rp.options['streaming'] = True
+    rp.options['streaming_chunk_size'] = 4
+    rp.options['exclude_unmapped_users'] = False
+    rp.logger.progress = lambda *_: None
+
+    directory_users = [get_mock_user('user%d' % i, groups=['Group A']) for i in range(12)]
+    directory_connector = MagicMock()
+    directory_connector.iter_users_and_groups.return_value = iter(directory_users)
+    rp.read_desired_user_groups({}, directory_connector)
+    directory_connector.load_users_and_groups.assert_not_called()
+    # only the attributes needed for the diff are kept
+    user_key = rp.get_directory_user_key(directory_users[0])
+    assert 'source_attributes' not in rp.directory_user_by_user_key[user_key]
+    assert rp.filtered_directory_user_by_user_key[user_key] is rp.directory_user_by_user_key[user_key]
+
+    connectors = mock_umapi_connectors()
+    conn = connectors.get_primary_connector()
+    conn.uses_business_id = False
+    conn.users = []
+    primary_commands, _ = rp.sync_umapi_users(connectors)
+    assert primary_commands == []
+    assert len(rp.pending_primary_creates) == 12
+
+    # the create commands are made as they are sent, with the end signal before the last one
+    sent = []
+    conn.send_commands = lambda commands, callback=None: sent.append(commands)
+    conn.end_sync = lambda: sent.append('end_sync')
+    rp.execute_commands(rp.iter_primary_create_commands(conn), conn, total_users=12)
+    assert [c.email for c in sent[:11]] == [u['email'] for u in directory_users[:11]]
+    assert sent[11] == 'end_sync'
+    assert sent[12].email == directory_users[11]['email']
@@ -18,6 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import logging
+import multiprocessing
 import os
 import platform
 import shutil
@@ -741,4 +742,6 @@ def certgen(randomize, key, certificate, overwrite):
 
 
 if __name__ == '__main__':
+    # worker processes of the frozen app (started by spawn on Windows and macOS) run their task, rather than the app
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,197 @@
+from ..base import CacheBase
+from .schema import ldap_group_dns as ldap_group_dns_schema
+from .schema import ldap_group_members as ldap_group_members_schema
+from .schema import ldap_group_members_meta as ldap_group_members_meta_schema
+from .schema import ldap_users as ldap_users_schema
+from .schema import ldap_user_meta as ldap_user_meta_schema
+import base64
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+class LdapCache(CacheBase):
+    """
+    Results of LDAP lookups that are worth keeping from one run to the next.  Group DNs are
+    keyed by search base and group filter, and each expires on its own once the TTL has passed.
+    The group graph is kept as the direct member DNs of each entry (empty for users), keyed by
+    the entry's lower-cased DN, with the entry's change stamp and a TTL of its own, along with
+    the high-water mark of the changes it was last checked against.  User records (as read from the directory)
+    are kept by unique id, with the high-water mark of the changes they include.
+    """
+    # increment this every time there are changes to table schema or data model
+    VERSION: int = 5
+    db_filename: str = 'ldap.db'
+
+    def __init__(self, store_path: Path, group_dn_ttl: int = 86400, group_members_ttl: int = 0) -> None:
+        self.group_dn_ttl = group_dn_ttl
+        self.group_members_ttl = group_members_ttl
+        sqlite3.register_converter("ldap_record", convert_record)
+        self.init(store_path)
+        db_path = store_path / self.db_filename
+        if not db_path.exists():
+            self.should_refresh = True
+            self.db_conn = self.get_db_conn(db_path)
+            self.db_conn.execute(ldap_group_dns_schema)
+            self.db_conn.execute(ldap_group_members_schema)
+            self.db_conn.execute(ldap_group_members_meta_schema)
+            self.db_conn.execute(ldap_users_schema)
+            self.db_conn.execute(ldap_user_meta_schema)
+            self.db_conn.commit()
+        else:
+            self.db_conn = self.get_db_conn(db_path)
+        if self.get_version() != self.VERSION:
+            self.rebuild_tables()
+            self.init_meta()
+            self.should_refresh = True
+        super().__init__()
+
+    def rebuild_tables(self):
+        self.db_conn.execute("drop table if exists group_dns")
+        self.db_conn.execute("drop table if exists group_members")
+        self.db_conn.execute("drop table if exists group_members_meta")
+        self.db_conn.execute("drop table if exists users")
+        self.db_conn.execute("drop table if exists user_meta")
+        self.db_conn.execute(ldap_group_dns_schema)
+        self.db_conn.execute(ldap_group_members_schema)
+        self.db_conn.execute(ldap_group_members_meta_schema)
+        self.db_conn.execute(ldap_users_schema)
+        self.db_conn.execute(ldap_user_meta_schema)
+        self.db_conn.commit()
+
+    def get_group_dns(self, search_base: str) -> dict[str, str]:
+        """
+        :return: the unexpired group DNs found under the search base, by group filter
+        """
+        cur = self.db_conn.cursor()
+        cur.execute("select group_filter, dn from group_dns where search_base = ? and expires > ?",
+                    (search_base, datetime.now()))
+        return dict(cur.fetchall())
+
+    def cache_group_dns(self, search_base: str, group_dns: list[tuple[str, str]]):
+        expires = datetime.now() + timedelta(seconds=self.group_dn_ttl)
+        self.db_conn.executemany("insert or replace into group_dns(search_base, group_filter, dn, expires) "
+                                 "values (?,?,?,?)",
+                                 ((search_base, group_filter, dn, expires) for group_filter, dn in group_dns))
+        self.db_conn.commit()
+
+    def get_group_members(self, member_attribute: str) -> dict[str, tuple[list[str], str]]:
+        """
+        :return: the unexpired direct member DNs of each entry, with its change stamp, by lower-cased DN
+        """
+        cur = self.db_conn.cursor()
+        cur.execute("select dn, members, stamp from group_members where member_attribute = ? and expires > ?",
+                    (member_attribute, datetime.now()))
+        return {dn: (json.loads(members), stamp) for dn, members, stamp in cur.fetchall()}
+
+    def cache_group_members(self, member_attribute: str, group_members: list[tuple[str, list[str], str]]):
+        """
+        Add or replace entries (DN, direct member DNs and change stamp) in the group graph.
+        """
+        expires = datetime.now() + timedelta(seconds=self.group_members_ttl)
+        self.db_conn.executemany("insert or replace into group_members(member_attribute, dn, members, stamp, "
+                                 "expires) values (?,?,?,?,?)",
+                                 ((member_attribute, dn.lower(), json.dumps(members), stamp, expires)
+                                  for dn, members, stamp in group_members))
+        self.db_conn.commit()
+
+    def get_group_members_mark(self, member_attribute: str) -> str:
+        """
+        :return: the high-water mark of the changes the group graph was last checked against (None if never)
+        """
+        cur = self.db_conn.cursor()
+        cur.execute("select high_water_mark from group_members_meta where member_attribute = ?",
+                    (member_attribute, ))
+        row = cur.fetchone()
+        return row[0] if row is not None else None
+
+    def set_group_members_mark(self, member_attribute: str, high_water_mark: str, changed_dns: list[str]):
+        """
+        Remove the entries that changed from the group graph, and set the mark they were checked against.
+        """
+        self.db_conn.executemany("delete from group_members where member_attribute = ? and dn = ?",
+                                 ((member_attribute, dn.lower()) for dn in changed_dns))
+        self.db_conn.execute("insert or replace into group_members_meta(member_attribute, high_water_mark) "
+                             "values (?,?)", (member_attribute, high_water_mark))
+        self.db_conn.commit()
+
+    def get_user_meta(self) -> tuple:
+        """
+        :return: the fingerprint of the search the users were read with, the high-water mark of the
+            changes they include, and the time they were last all read (None if no users are cached)
+        """
+        cur = self.db_conn.cursor()
+        cur.execute("select fingerprint, high_water_mark, last_full_load from user_meta")
+        return cur.fetchone()
+
+    def clear_users(self):
+        """
+        Remove all the cached users, in a transaction that is committed by set_user_meta.
+        """
+        self.db_conn.execute("delete from users")
+        self.db_conn.execute("delete from user_meta")
+
+    def add_users(self, users: list[tuple[str, str, dict]]):
+        """
+        Add or replace users (id, DN and record), in a transaction that is committed by set_user_meta.
+        """
+        self.db_conn.executemany("insert or replace into users(id, dn, record) values (?,?,?)",
+                                 ((user_id, dn, adapt_record(record))
+                                  for user_id, dn, record in users))
+
+    def remove_users(self, user_ids: list[str]):
+        """
+        Remove users by id, in a transaction that is committed by set_user_meta.
+        """
+        self.db_conn.executemany("delete from users where id = ?", ((user_id,) for user_id in user_ids))
+
+    def discard_user_changes(self):
+        """
+        Roll back the changes to the cached users since set_user_meta was last called.
+        """
+        self.db_conn.rollback()
+
+    def set_user_meta(self, fingerprint: str, high_water_mark: str, last_full_load: datetime):
+        self.db_conn.execute("delete from user_meta")
+        self.db_conn.execute("insert into user_meta(fingerprint, high_water_mark, last_full_load) values (?,?,?)",
+                             (fingerprint, high_water_mark, last_full_load))
+        self.db_conn.commit()
+
+    def iter_users(self):
+        """
+        :return: the DN and record of each cached user
+        """
+        cur = self.db_conn.cursor()
+        cur.execute("select dn, record from users order by rowid")
+        while True:
+            rows = cur.fetchmany(1000)
+            if not rows:
+                break
+            yield from rows
+
+
+def encode_record_value(value):
+    # binary values (such as objectGUID) and timestamps are kept as objects with a single marker key
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError("Can't cache a value of type %s" % type(value).__name__)
+
+
+def decode_record_value(obj: dict):
+    if len(obj) == 1:
+        if '$bytes' in obj:
+            return base64.b64decode(obj['$bytes'])
+        if '$datetime' in obj:
+            return datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+
+def adapt_record(record: dict) -> str:
+    return json.dumps(record, default=encode_record_value)
+
+
+def convert_record(s: bytes) -> dict:
+    return json.loads(s, object_hook=decode_record_value)
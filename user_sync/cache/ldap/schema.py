@@ -0,0 +1,43 @@
+ldap_group_dns = """
+create table if not exists group_dns (
+    search_base text not null,
+    group_filter text not null,
+    dn text not null,
+    expires timestamp not null,
+    unique (search_base, group_filter)
+);
+"""
+
+ldap_group_members = """
+create table if not exists group_members (
+    member_attribute text not null,
+    dn text not null,
+    members text not null,
+    stamp text,
+    expires timestamp not null,
+    unique (member_attribute, dn)
+);
+"""
+
+ldap_group_members_meta = """
+create table if not exists group_members_meta (
+    member_attribute text not null unique,
+    high_water_mark text not null
+);
+"""
+
+ldap_users = """
+create table if not exists users (
+    id text primary key,
+    dn text not null,
+    record ldap_record not null
+);
+"""
+
+ldap_user_meta = """
+create table if not exists user_meta (
+    fingerprint text not null,
+    high_water_mark text not null,
+    last_full_load timestamp not null
+);
+"""
@@ -0,0 +1,54 @@
+from ..base import CacheBase
+from .schema import okta_group_ids as okta_group_ids_schema
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+class OktaCache(CacheBase):
+    """
+    Results of Okta lookups that are worth keeping from one run to the next.  Group ids are keyed
+    by group name, and each expires on its own once the TTL has passed.
+    """
+    # increment this every time there are changes to table schema or data model
+    VERSION: int = 1
+    db_filename: str = 'okta.db'
+
+    def __init__(self, store_path: Path, group_id_ttl: int = 86400) -> None:
+        self.group_id_ttl = group_id_ttl
+        self.init(store_path)
+        db_path = store_path / self.db_filename
+        if not db_path.exists():
+            self.should_refresh = True
+            self.db_conn = self.get_db_conn(db_path)
+            self.db_conn.execute(okta_group_ids_schema)
+            self.db_conn.commit()
+        else:
+            self.db_conn = self.get_db_conn(db_path)
+        if self.get_version() != self.VERSION:
+            self.rebuild_tables()
+            self.init_meta()
+            self.should_refresh = True
+        super().__init__()
+
+    def rebuild_tables(self):
+        self.db_conn.execute("drop table if exists group_ids")
+        self.db_conn.execute(okta_group_ids_schema)
+        self.db_conn.commit()
+
+    def get_group_ids(self) -> dict[str, str]:
+        """
+        :return: the unexpired group ids, by group name
+        """
+        cur = self.db_conn.cursor()
+        cur.execute("select name, id from group_ids where expires > ?", (datetime.now(),))
+        return dict(cur.fetchall())
+
+    def cache_group_ids(self, group_ids: list[tuple[str, str]]):
+        expires = datetime.now() + timedelta(seconds=self.group_id_ttl)
+        self.db_conn.executemany("insert or replace into group_ids(name, id, expires) values (?,?,?)",
+                                 ((name, group_id, expires) for name, group_id in group_ids))
+        self.db_conn.commit()
+
+    def remove_group_id(self, name: str):
+        self.db_conn.execute("delete from group_ids where name = ?", (name,))
+        self.db_conn.commit()
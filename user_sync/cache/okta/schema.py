@@ -0,0 +1,7 @@
+okta_group_ids = """
+create table if not exists group_ids (
+    name text not null unique,
+    id text not null,
+    expires timestamp not null
+);
+"""
@@ -0,0 +1,113 @@
+from ..base import CacheBase
+from .schema import umapi_users as umapi_users_schema
+from .schema import umapi_user_hashes as umapi_user_hashes_schema
+from pathlib import Path
+import json
+import sqlite3
+
+
+class UmapiCache(CacheBase):
+    """
+    Snapshot of the users of a UMAPI org, keyed by user key, along with the hash of each
+    directory user as of the last time it was confirmed against the org.  Each org gets its own
+    directory under the store path so that each snapshot has its own refresh schedule.
+    """
+    # increment this every time there are changes to table schema or data model
+    VERSION: int = 2
+    db_filename: str = 'users.db'
+
+    def __init__(self, store_path: Path, org_name: str) -> None:
+        sqlite3.register_converter("umapi_user", convert_user)
+        store_path = store_path / org_name
+        self.init(store_path)
+        db_path = store_path / self.db_filename
+        if not db_path.exists():
+            self.should_refresh = True
+            self.db_conn = self.get_db_conn(db_path)
+            for s in [umapi_users_schema, umapi_user_hashes_schema]:
+                self.db_conn.execute(s)
+            self.db_conn.commit()
+        else:
+            self.db_conn = self.get_db_conn(db_path)
+        if self.get_version() != self.VERSION:
+            self.rebuild_tables()
+            self.init_meta()
+            self.should_refresh = True
+        super().__init__()
+
+    def rebuild_tables(self):
+        self.db_conn.execute("drop table if exists users")
+        self.db_conn.execute("drop table if exists user_hashes")
+        for s in [umapi_users_schema, umapi_user_hashes_schema]:
+            self.db_conn.execute(s)
+        self.db_conn.commit()
+
+    def clear_all(self):
+        self.db_conn.execute("delete from users")
+        self.db_conn.commit()
+
+    def cache_user(self, user_key: str, user: dict, needs_refresh: bool = False):
+        self.db_conn.execute("insert or replace into users(user_key, needs_refresh, user) values (?,?,?)",
+                             (user_key, int(needs_refresh), adapt_user(user)))
+        self.db_conn.commit()
+
+    def cache_users(self, users: list[tuple[str, dict]]):
+        self.db_conn.executemany("insert or replace into users(user_key, user) values (?,?)",
+                                 ((user_key, adapt_user(user)) for user_key, user in users))
+        self.db_conn.commit()
+
+    def update_user(self, user_key: str, user: dict):
+        self.db_conn.execute("update users set user = ? where user_key = ?", (adapt_user(user), user_key))
+        self.db_conn.commit()
+
+    def delete_user(self, user_key: str):
+        self.db_conn.execute("delete from users where user_key = ?", (user_key, ))
+        self.db_conn.commit()
+
+    def get_users(self) -> list[dict]:
+        cur = self.db_conn.cursor()
+        cur.execute("select user from users")
+        return [r[0] for r in cur.fetchall()]
+
+    def get_user(self, user_key: str) -> dict:
+        cur = self.db_conn.cursor()
+        cur.execute("select user from users where user_key = ?", (user_key, ))
+        row = cur.fetchone()
+        return row[0] if row is not None else None
+
+    def update_user_refresh_status(self, user_key: str, needs_refresh: bool):
+        self.db_conn.execute("update users set needs_refresh = ? where user_key = ?", (int(needs_refresh), user_key))
+        self.db_conn.commit()
+
+    def get_users_to_refresh(self) -> list[tuple[str, dict]]:
+        cur = self.db_conn.cursor()
+        cur.execute("select user_key, user from users where needs_refresh=1")
+        return cur.fetchall()
+
+    def get_user_hashes(self) -> dict[str, str]:
+        """
+        The confirmed hashes of the users whose snapshot isn't flagged for a refresh
+        """
+        cur = self.db_conn.cursor()
+        cur.execute("select h.user_key, h.hash from user_hashes h join users u on u.user_key = h.user_key "
+                    "where h.confirmed=1 and u.needs_refresh=0")
+        return dict(cur.fetchall())
+
+    def replace_user_hashes(self, user_hashes: dict[str, tuple[str, bool]]):
+        self.db_conn.execute("delete from user_hashes")
+        self.db_conn.executemany("insert or replace into user_hashes(user_key, hash, confirmed) values (?,?,?)",
+                                 ((user_key, user_hash, int(confirmed))
+                                  for user_key, (user_hash, confirmed) in user_hashes.items()))
+        self.db_conn.commit()
+
+    def refresh_done(self):
+        self.should_refresh = False
+        self.update_next_refresh()
+
+
+def adapt_user(user: dict) -> str:
+    return json.dumps(user)
+
+
+def convert_user(s: bytes) -> dict:
+    return json.loads(s)
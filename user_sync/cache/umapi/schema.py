@@ -0,0 +1,15 @@
+umapi_users = """
+create table if not exists users (
+    user_key text not null unique,
+    needs_refresh int default 0,
+    user umapi_user
+);
+"""
+
+umapi_user_hashes = """
+create table if not exists user_hashes (
+    user_key text not null unique,
+    hash text not null,
+    confirmed int default 0
+);
+"""
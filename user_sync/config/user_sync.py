@@ -18,6 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import ast
 import codecs
 import logging
 import os
@@ -32,6 +33,7 @@ import user_sync.identity_type
 from user_sync import flags
 from user_sync.engine import umapi as rules
 from user_sync.engine.common import AdobeGroup, PRIMARY_TARGET_NAME
+from user_sync.engine.hook_pool import find_shared_state
 from user_sync.error import AssertionException
 from .common import DictConfig, ConfigLoader, ConfigFileLoader, resolve_invocation_options, as_list, resolve_invocation_options, validate_max_limit_config
 
@@ -43,13 +45,15 @@ class UMAPIConfigLoader(ConfigLoader):
     # key_paths in the root configuration file that should have filename values
     # mapped to their value options.  See load_from_yaml for the option meanings.
     ROOT_CONFIG_PATH_KEYS = {'/adobe_users/connectors/umapi': (True, True, None),
+                             '/cache/path': (False, False, None),
                              '/directory_users/connectors/*': (True, False, None),
                              '/directory_users/extension': (True, False, None),
                              '/logging/file_log_directory': (False, False, "logs"),
                              }
 
     # like ROOT_CONFIG_PATH_KEYS, but for non-root configuration files
-    SUB_CONFIG_PATH_KEYS = {'/enterprise/priv_key_path': (True, False, None),
+    SUB_CONFIG_PATH_KEYS = {'/cache/path': (False, False, None),
+                            '/enterprise/priv_key_path': (True, False, None),
                             '/integration/priv_key_path': (True, False, None)}
 
     # default values for reading configuration files
@@ -384,6 +388,26 @@ class UMAPIConfigLoader(ConfigLoader):
                         raise AssertionError("No after_mapping_hook found in extension configuration")
         return options
 
+    @staticmethod
+    def compile_after_mapping_hook(after_mapping_hook_text, is_function=False):
+        """
+        Compile the hook code.  The code of a function-style hook is run once, and must define
+        a function named after_mapping, which is then called for each user.
+        :type after_mapping_hook_text: str
+        :type is_function: bool
+        :rtype: CodeType
+        """
+        try:
+            tree = ast.parse(after_mapping_hook_text, '<per-user after-mapping-hook>')
+        except SyntaxError as e:
+            raise AssertionException("Syntax error in after_mapping_hook: {}".format(e))
+        if is_function and not any(isinstance(node, ast.FunctionDef) and node.name == 'after_mapping' or
+                                   isinstance(node, ast.Name) and node.id == 'after_mapping' and
+                                   isinstance(node.ctx, ast.Store)
+                                   for node in ast.walk(tree)):
+            raise AssertionException("A function-style after_mapping_hook must define an after_mapping function")
+        return compile(tree, '<per-user after-mapping-hook>', 'exec')
+
     @staticmethod
     def as_list(value):
         if value is None:
@@ -477,6 +501,17 @@ class UMAPIConfigLoader(ConfigLoader):
         sync_options = directory_config.get_dict_config('group_sync_options', True)
         if sync_options:
             options['auto_create'] = sync_options.get_bool('auto_create', True)
+        skip_unchanged_users = directory_config.get_bool('skip_unchanged_users', True)
+        if skip_unchanged_users is not None:
+            options['skip_unchanged_users'] = skip_unchanged_users
+        streaming = directory_config.get_bool('streaming', True)
+        if streaming is not None:
+            options['streaming'] = streaming
+        streaming_chunk_size = directory_config.get_int('streaming_chunk_size', True)
+        if streaming_chunk_size is not None:
+            if streaming_chunk_size < 1:
+                raise AssertionException("'streaming_chunk_size' must be at least 1")
+            options['streaming_chunk_size'] = streaming_chunk_size
 
         # process exclusion configuration options
         adobe_config = self.main_config.get_dict_config('adobe_users', True)
@@ -519,6 +554,24 @@ class UMAPIConfigLoader(ConfigLoader):
                 exclude_groups.append(group.get_group_name())
             options['exclude_groups'] = exclude_groups
 
+        connection_config = adobe_config.get_dict_config('connection', True)
+        if connection_config is not None:
+            request_concurrency = connection_config.get_int('request_concurrency', True)
+            if request_concurrency is not None:
+                if request_concurrency < 1:
+                    raise AssertionException("'request_concurrency' must be at least 1")
+                options['request_concurrency'] = request_concurrency
+
+        # incremental sync against a local snapshot of the Adobe users
+        delta_sync = adobe_config.get_bool('delta_sync', True)
+        if delta_sync is not None:
+            options['delta_sync'] = delta_sync
+        cache_config = self.main_config.get_dict_config('cache', True)
+        if cache_config is not None:
+            cache_path = cache_config.get_string('path', True)
+            if cache_path:
+                options['cache_path'] = cache_path
+
         # get the limits
         limits_config = self.main_config.get_dict_config('limits')
         max_missing = limits_config.get_value('max_adobe_only_users', (int, str), False)
@@ -530,8 +583,26 @@ class UMAPIConfigLoader(ConfigLoader):
         if extension_config and not options['extension_enabled']:
             self.logger.warning('Extension config functionality is disabled - skipping after-map hook')
         elif extension_config:
-            after_mapping_hook_text = extension_config.get_string('after_mapping_hook')
-            options['after_mapping_hook'] = compile(after_mapping_hook_text, '<per-user after-mapping-hook>', 'exec')
+            after_mapping_hook_style = extension_config.get_string('after_mapping_hook_style', True) or 'exec'
+            if after_mapping_hook_style not in ('exec', 'function'):
+                raise AssertionException("'after_mapping_hook_style' must be 'exec' or 'function'")
+            options['after_mapping_hook_is_function'] = after_mapping_hook_style == 'function'
+            # the hook is compiled once here, rather than for every user it runs on
+            options['after_mapping_hook'] = self.compile_after_mapping_hook(
+                extension_config.get_string('after_mapping_hook'), options['after_mapping_hook_is_function'])
+            # a CPU-heavy hook can be run in several processes, on chunks of users
+            for key in ('after_mapping_hook_processes', 'after_mapping_hook_chunk_size'):
+                value = extension_config.get_int(key, True)
+                if value is not None:
+                    if value < 1:
+                        raise AssertionException("'%s' must be at least 1" % key)
+                    options[key] = value
+            if options['after_mapping_hook_processes'] > 1:
+                shared_state = find_shared_state(options['after_mapping_hook'],
+                                                 options['after_mapping_hook_is_function'])
+                if shared_state:
+                    raise AssertionException("'after_mapping_hook_processes' can't be used with a hook that keeps "
+                                             "state from one user to the next: %s" % ', '.join(shared_state))
             options['extended_attributes'].update(extension_config.get_list('extended_attributes', True))
             # declaration of extended adobe groups: this is needed for two reasons:
             # 1. it allows validation of group names, and matching them to adobe groups
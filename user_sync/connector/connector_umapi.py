@@ -18,12 +18,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import copy
 import json
 import logging
 # import helper
 import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import jwt
+import requests
 import six
 import umapi_client
 
@@ -73,8 +77,14 @@ class UmapiConnector(object):
         server_builder.set_string_value('ims_endpoint_jwt', '/ims/exchange/jwt')
         server_builder.set_int_value('timeout', 120)
         server_builder.set_int_value('retries', 3)
+        server_builder.set_int_value('batch_size', 10)
+        server_builder.set_int_value('max_in_flight', 1)
         server_builder.set_value('ssl_verify', bool, None)
         options['server'] = server_options = server_builder.get_options()
+        if not 1 <= server_options['batch_size'] <= 10:
+            raise AssertionException("%s: 'batch_size' must be between 1 and 10" % self.name)
+        if server_options['max_in_flight'] < 1:
+            raise AssertionException("%s: 'max_in_flight' must be at least 1" % self.name)
 
         enterprise_config = caller_config.get_dict_config('enterprise')
         enterprise_builder = config_common.OptionsBuilder(enterprise_config)
@@ -114,13 +124,14 @@ class UmapiConnector(object):
                     logger=self.logger,
                     timeout_seconds=float(server_options['timeout']),
                     retry_max_attempts=server_options['retries'] + 1,
-                    ssl_verify=options['ssl_cert_verify']
+                    ssl_verify=options['ssl_cert_verify'],
+                    throttle_actions=server_options['batch_size']
                 )
             except Exception as e:
                 raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
             logger.debug('%s: connection established', self.name)
             # wrap the connection in an action manager
-            self.action_manager = ActionManager(connection, org_id, logger)
+            self.action_manager = ActionManager(connection, org_id, logger, server_options['max_in_flight'])
 
     def get_users(self):
         return list(self.iter_users())
@@ -150,6 +161,17 @@ class UmapiConnector(object):
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def get_user(self, email):
+        """
+        Look up a single user by email address
+        :type email: str
+        :rtype: dict (empty if the user doesn't exist)
+        """
+        try:
+            return umapi_client.UserQuery(self.connection, email).result()
+        except umapi_client.UnavailableError as e:
+            raise AssertionException("Error contacting UMAPI server: %s" % e)
+
     def get_groups(self):
         return list(self.iter_groups())
 
@@ -295,11 +317,15 @@ class Commands(object):
 class ActionManager(object):
     next_request_id = 1
 
-    def __init__(self, connection, org_id, logger):
+    def __init__(self, connection, org_id, logger, max_in_flight=1):
         """
+        When max_in_flight is more than 1, actions are gathered into batches of the connection's
+        batch size (throttle_actions), and up to max_in_flight batches are sent at the same time.
+        Otherwise each action is handed to the connection, which sends its queue when it's full.
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type max_in_flight: int
         """
         self.action_count = 0
         self.error_count = 0
@@ -307,6 +333,11 @@ class ActionManager(object):
         self.connection = connection
         self.org_id = org_id
         self.logger = logger.getChild('action')
+        self.max_in_flight = max_in_flight
+        # batches being sent, oldest first, as (future, connection, items)
+        self.in_flight = deque()
+        self.idle_connections = []
+        self.executor = None
 
     def get_statistics(self):
         """Return the count of actions sent so far, and how many had errors."""
@@ -357,10 +388,64 @@ class ActionManager(object):
         self.items.append(item)
         self.action_count += 1
         self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
-        self._execute_action(action)
+        if self.max_in_flight > 1:
+            # once the end of the sync is signaled, the rest is sent by flush after all other batches
+            if len(self.items) >= self.connection.throttle_actions and not self.connection.sync_ended:
+                self._send_batch()
+        else:
+            self._execute_action(action)
 
     def has_work(self):
-        return len(self.items) > 0
+        return len(self.items) > 0 or len(self.in_flight) > 0
+
+    def _send_batch(self):
+        """
+        Send the oldest batch of actions on a connection of its own, waiting for the oldest batch
+        in flight to complete first if there are already max_in_flight of them.
+        """
+        batch_size = self.connection.throttle_actions
+        batch, self.items = self.items[:batch_size], self.items[batch_size:]
+        if len(self.in_flight) >= self.max_in_flight:
+            self._finish_batch()
+        connection = self.idle_connections.pop() if self.idle_connections else self._clone_connection()
+        # the start of sync signal goes with the first batch, which must complete before any other is sent
+        connection.sync_started, self.connection.sync_started = self.connection.sync_started, False
+        starts_sync = connection.sync_started
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight)
+        future = self.executor.submit(connection.execute_multiple, [item['action'] for item in batch])
+        self.in_flight.append((future, connection, batch))
+        if starts_sync:
+            self._finish_batch()
+
+    def _finish_batch(self):
+        """
+        Wait for the oldest batch in flight, and process its results on this thread
+        """
+        future, connection, batch = self.in_flight.popleft()
+        self.idle_connections.append(connection)
+        try:
+            future.result()
+        except umapi_client.BatchError as e:
+            self.process_items(batch, e)
+        except umapi_client.UnavailableError as e:
+            raise AssertionException("Error contacting UMAPI server: %s" % e)
+        else:
+            self.process_items(batch)
+
+    def _clone_connection(self):
+        """
+        Connections aren't thread-safe, so each batch in flight is sent on a copy of ours.
+        The copies share its authorization, but have their own action queue, status and http session.
+        :rtype: umapi_client.Connection
+        """
+        connection = copy.copy(self.connection)
+        connection.action_queue = []
+        connection.local_status = dict(self.connection.local_status)
+        connection.sync_started = connection.sync_ended = False
+        connection.session = requests.Session()
+        connection.session.headers.update(self.connection.session.headers)
+        return connection
 
     def _execute_action(self, action):
         """
@@ -376,8 +461,15 @@ class ActionManager(object):
             self.process_sent_items(sent)
 
     def flush(self):
+        while self.in_flight:
+            self._finish_batch()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        # in batched mode, the remaining actions haven't been given to the connection yet
+        actions = [item['action'] for item in self.items] if self.max_in_flight > 1 else []
         try:
-            _, sent, _ = self.connection.execute_queued()
+            _, sent, _ = self.connection.execute_multiple(actions)
         except umapi_client.BatchError as e:
             self.process_sent_items(e.statistics[1], e)
         except umapi_client.UnavailableError as e:
@@ -394,7 +486,15 @@ class ActionManager(object):
         """
         # update queue
         sent_items, self.items = self.items[:total_sent], self.items[total_sent:]
+        self.process_items(sent_items, batch_error)
 
+    def process_items(self, sent_items, batch_error=None):
+        """
+        Log any processing errors of sent items, and invoke their callbacks
+        :param sent_items: list of sent items (dicts with an action and a callback)
+        :param batch_error: exception for a batch-level error that affected all items, if there was one
+        :return:
+        """
         # collect sent actions, their errors, their callbacks
         details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in sent_items]
 
@@ -402,7 +502,7 @@ class ActionManager(object):
         if batch_error:
             request_ids = str([action.frame.get("requestID") for action, _, _ in details])
             self.logger.critical("Unexpected response! Sent actions %s may have failed: %s", request_ids, batch_error)
-            self.error_count += total_sent
+            self.error_count += len(sent_items)
         else:
             for action, errors, _ in details:
                 if errors:
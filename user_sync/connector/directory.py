@@ -27,3 +27,10 @@ class DirectoryConnector(object):
 
     def load_users_and_groups(self, groups, extended_attributes=None, all_users=True):
         pass
+
+    def iter_users_and_groups(self, groups, extended_attributes=None, all_users=True):
+        """
+        Yield the users one by one.  Connectors that can read their users without holding them all
+        in memory override this; by default it's the same as load_users_and_groups.
+        """
+        return iter(self.load_users_and_groups(groups, extended_attributes, all_users))
@@ -178,7 +178,7 @@ class AdobeConsoleConnector(DirectoryConnector):
 
         source_attributes['country'] = user['country'] = record['country']
 
-        user['source_attributes'] = source_attributes.copy()
+        user['source_attributes'] = source_attributes
         return user
 
     def iter_umapi_groups(self):
@@ -18,6 +18,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import functools
+import logging
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+
 import six
 import user_sync.connector.helper
 import user_sync.error
@@ -48,8 +53,14 @@ class CSVDirectoryConnector(DirectoryConnector):
         builder.set_string_value('identity_type_column_name', 'type')
         builder.set_string_value('user_identity_type', None)
         builder.set_string_value('logger_name', self.name)
+        builder.set_int_value('parse_processes', 1)
+        builder.set_int_value('parse_chunk_size', 64 * 1024 * 1024)
         builder.require_string_value('file_path')
         options = builder.get_options()
+        if options['parse_processes'] < 1:
+            raise user_sync.error.AssertionException("'parse_processes' must be at least 1")
+        if options['parse_chunk_size'] < 1:
+            raise user_sync.error.AssertionException("'parse_chunk_size' must be at least 1")
         self.options = options
         self.logger = logger = user_sync.connector.helper.create_logger(options)
         logger.debug('%s initialized with options: %s', self.name, options)
@@ -79,96 +90,78 @@ class CSVDirectoryConnector(DirectoryConnector):
         :type extended_attributes: list
         :rtype dict
         """
-        users = {}
-
         options = self.options
         logger = self.logger
 
-        recognized_column_names = []
-
-        def get_column_name(key):
-            column_name = options[key]
-            recognized_column_names.append(column_name)
-            return column_name
-
-        email_column_name = get_column_name('email_column_name')
-        first_name_column_name = get_column_name('first_name_column_name')
-        last_name_column_name = get_column_name('last_name_column_name')
-        country_column_name = get_column_name('country_column_name')
-        groups_column_name = get_column_name('groups_column_name')
-        identity_type_column_name = get_column_name('identity_type_column_name')
-        username_column_name = get_column_name('username_column_name')
-        domain_column_name = get_column_name('domain_column_name')
+        # the standard columns come first, in the order add_user_rows expects them
+        recognized_column_names = [options[key] for key in ('email_column_name', 'first_name_column_name',
+                                                            'last_name_column_name', 'country_column_name',
+                                                            'groups_column_name', 'identity_type_column_name',
+                                                            'username_column_name', 'domain_column_name')]
 
         # extended attributes appear after the standard ones (if no header row)
         recognized_column_names += extended_attributes
 
-        line_read = 0
-        rows = CSVAdapter.read_csv_rows(file_path,
-                                        recognized_column_names=recognized_column_names,
-                                        logger=logger,
-                                        encoding=self.encoding,
-                                        delimiter=options['delimiter'])
-        for row in rows:
-            line_read += 1
-            email = self.get_column_value(row, email_column_name)
-            if email is None or email.find('@') < 0:
-                logger.warning('Missing or invalid email at row: %d; skipping', line_read)
-                continue
+        # the source attributes of each user are made from these, when they are used
+        recognized_column_names = tuple(recognized_column_names)
+
+        if options['parse_processes'] > 1:
+            users = self.read_users_in_chunks(file_path, recognized_column_names)
+            if users is not None:
+                return users
 
-            user = users.get(email)
-            if user is None:
-                user = user_sync.connector.helper.create_blank_user()
-                user['email'] = email
-                users[email] = user
-
-            first_name = self.get_column_value(row, first_name_column_name)
-            if first_name is not None:
-                user['firstname'] = first_name
-            else:
-                logger.debug('No value firstname for: %s', email)
-
-            last_name = self.get_column_value(row, last_name_column_name)
-            if last_name is not None:
-                user['lastname'] = last_name
-            else:
-                logger.debug('No value lastname for: %s', email)
-
-            country = self.get_column_value(row, country_column_name)
-            if country is not None:
-                user['country'] = country.upper()
-
-            groups = self.get_column_value(row, groups_column_name)
-            if groups is not None:
-                user['groups'].extend(groups.split(','))
-
-            username = self.get_column_value(row, username_column_name)
-            if username is None:
-                username = email
-            user['username'] = username
-
-            identity_type = self.get_column_value(row, identity_type_column_name)
-            if identity_type:
-                try:
-                    user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
-                except user_sync.error.AssertionException as e:
-                    self.logger.warning('Skipping user %s: %s', username, e)
-                    del users[email]
-                    continue
-            else:
-                user['identity_type'] = self.user_identity_type
-
-            domain = self.get_column_value(row, domain_column_name)
-            if domain:
-                user['domain'] = domain
-            elif username != email:
-                user['domain'] = email[email.find('@') + 1:]
-
-            sa = {}
-            for col in recognized_column_names:
-                sa[col] = self.get_column_value(row, col)
-            user['source_attributes'] = sa
+        users = {}
+        rows = CSVAdapter.read_csv_columns(file_path,
+                                           column_names=recognized_column_names,
+                                           logger=logger,
+                                           encoding=self.encoding,
+                                           delimiter=options['delimiter'])
+        add_user_rows(users, rows, recognized_column_names, self.user_identity_type, logger)
+        return users
+
+    def read_users_in_chunks(self, file_path, column_names):
+        """
+        Read the users of a large file with several processes, each parsing a chunk of it.  The users of
+        each chunk are merged in file order, so the result is the same as reading the file in one go.
+        :type file_path: str
+        :type column_names: tuple(str)
+        :rtype dict: None if the file isn't split (it is then read in one go)
+        """
+        options = self.options
+        logger = self.logger
+        if not '"\n'.encode(self.encoding).endswith(b'"\n'):
+            logger.debug("Not splitting '%s': quotes and line breaks aren't single bytes in %s",
+                         file_path, self.encoding)
+            return None
+        chunks = CSVAdapter.find_csv_chunks(file_path, options['parse_chunk_size'])
+        if chunks is None:
+            logger.warning("Can't split '%s' into chunks, as its quotes don't balance: reading it in one process",
+                           file_path)
+            return None
+        if len(chunks) < 2:
+            return None
+        delimiter = options['delimiter']
+        if delimiter is None:
+            delimiter = CSVAdapter.guess_delimiter_from_filename(file_path)
+        header = CSVAdapter.read_csv_header(file_path, self.encoding, delimiter)
+        CSVAdapter.check_column_names(file_path, header, column_names, logger)
 
+        read_chunk = functools.partial(read_user_chunk, file_path, header=header, column_names=column_names,
+                                       encoding=self.encoding, delimiter=delimiter,
+                                       user_identity_type=self.user_identity_type,
+                                       log_level=logger.getEffectiveLevel())
+        users = {}
+        row_count = 0
+        with ProcessPoolExecutor(max_workers=min(options['parse_processes'], len(chunks))) as executor:
+            for chunk_users, replaced, chunk_row_count, records in executor.map(read_chunk, *zip(*chunks)):
+                for level, message, args in records:
+                    # rows are numbered from the start of the file
+                    if message == INVALID_EMAIL_MESSAGE:
+                        args = (args[0] + row_count,)
+                    logger.log(level, message, *args)
+                merge_chunk_users(users, chunk_users, replaced)
+                row_count += chunk_row_count
+        logger.debug('Rows read: %d, in %d chunks', row_count, len(chunks))
         return users
 
     def get_column_value(self, row, column_name):
@@ -178,3 +171,179 @@ class CSVDirectoryConnector(DirectoryConnector):
         """
         value = row.get(column_name)
         return value if value else None
+
+
+INVALID_EMAIL_MESSAGE = 'Missing or invalid email at row: %d; skipping'
+
+
+def add_user_rows(users, rows, column_names, user_identity_type, logger, replaced=None):
+    """
+    Add the users of some rows, merging the rows of each email: the last row's values are used, and the
+    groups of all the rows.  A row with an invalid identity type removes its user, rows before it included.
+    :type users: dict(str, DirectoryUser)
+    :type rows: iterator(tuple): the values of the columns of each row
+    :type column_names: tuple(str): the standard columns, then the extended attributes
+    :type user_identity_type: str
+    :type logger: logging.Logger
+    :type replaced: set(str): if given, the emails of removed users are added to it
+    :rtype int: the number of rows read
+    """
+    line_read = 0
+    for values in rows:
+        line_read += 1
+        # the standard columns come first, in the order of their names in read_users
+        email, first_name, last_name, country, groups, identity_type, username, domain = \
+            (value if value else None for value in values[:8])
+        if email is None or email.find('@') < 0:
+            logger.warning(INVALID_EMAIL_MESSAGE, line_read)
+            continue
+
+        user = users.get(email)
+        if user is None:
+            user = user_sync.connector.helper.create_blank_user()
+            user['email'] = email
+            users[email] = user
+
+        if first_name is not None:
+            user['firstname'] = first_name
+        else:
+            logger.debug('No value firstname for: %s', email)
+
+        if last_name is not None:
+            user['lastname'] = last_name
+        else:
+            logger.debug('No value lastname for: %s', email)
+
+        if country is not None:
+            user['country'] = country.upper()
+
+        if groups is not None:
+            user['groups'].extend(user_sync.connector.helper.intern_group_names(groups.split(',')))
+
+        if username is None:
+            username = email
+        user['username'] = username
+
+        if identity_type:
+            try:
+                user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
+            except user_sync.error.AssertionException as e:
+                logger.warning('Skipping user %s: %s', username, e)
+                del users[email]
+                if replaced is not None:
+                    replaced.add(email)
+                continue
+        else:
+            user['identity_type'] = user_identity_type
+
+        if domain:
+            user['domain'] = domain
+        elif username != email:
+            user['domain'] = email[email.find('@') + 1:]
+
+        user['source_attributes'] = CSVSourceAttributes(column_names, values)
+    return line_read
+
+
+class ChunkLogger:
+    """
+    Keeps the messages logged while reading a chunk in a worker process, for the main process to log
+    them in file order.
+    """
+
+    def __init__(self, level):
+        self.level = level
+        self.records = []
+
+    def log(self, level, message, *args):
+        if level >= self.level:
+            self.records.append((level, message, args))
+
+    def debug(self, message, *args):
+        self.log(logging.DEBUG, message, *args)
+
+    def warning(self, message, *args):
+        self.log(logging.WARNING, message, *args)
+
+
+def read_user_chunk(file_path, start, end, header, column_names, encoding, delimiter, user_identity_type,
+                    log_level):
+    """
+    Read the users of a chunk of a CSV file, in a worker process.
+    :return: the users, the emails of the users removed (whose rows in earlier chunks don't count), the
+    number of rows read, and the messages logged
+    :rtype (dict(str, DirectoryUser), set(str), int, list(tuple(int, str, tuple)))
+    """
+    rows = CSVAdapter.read_csv_chunk_columns(file_path, start, end, header, column_names, encoding, delimiter)
+    users = {}
+    replaced = set()
+    logger = ChunkLogger(log_level)
+    row_count = add_user_rows(users, rows, column_names, user_identity_type, logger, replaced)
+    return users, replaced, row_count, logger.records
+
+
+def merge_chunk_users(users, chunk_users, replaced):
+    """
+    Merge the users of a chunk into those of the chunks before it, as if their rows had been read in turn.
+    :type users: dict(str, DirectoryUser)
+    :type chunk_users: dict(str, DirectoryUser)
+    :type replaced: set(str): the emails of the users the chunk removed
+    """
+    for email, chunk_user in chunk_users.items():
+        user = users.get(email)
+        if user is None or email in replaced:
+            # a user removed, then added again, goes after the users added before it
+            users.pop(email, None)
+            users[email] = chunk_user
+            continue
+        for key in ('firstname', 'lastname', 'country', 'domain'):
+            if chunk_user[key] is not None:
+                user[key] = chunk_user[key]
+        user['groups'].extend(chunk_user['groups'])
+        for key in ('username', 'identity_type', 'source_attributes'):
+            user[key] = chunk_user[key]
+    for email in replaced:
+        if email not in chunk_users:
+            users.pop(email, None)
+
+
+class CSVSourceAttributes(MutableMapping):
+    """
+    The source attributes of a user read from a CSV file.  They are kept as the values of the user's
+    row, and only made into a dict (of each recognized column's value, or None) when they are first
+    used, say by an after-mapping hook.
+    """
+    __slots__ = ('column_names', 'values', 'attributes')
+
+    def __init__(self, column_names, values):
+        """
+        :type column_names: tuple(str)
+        :type values: tuple(str)
+        """
+        self.column_names = column_names
+        self.values = values
+        self.attributes = None
+
+    def get_attributes(self):
+        if self.attributes is None:
+            self.attributes = {name: value if value else None for name, value in zip(self.column_names, self.values)}
+            self.column_names = self.values = None
+        return self.attributes
+
+    def __getitem__(self, key):
+        return self.get_attributes()[key]
+
+    def __setitem__(self, key, value):
+        self.get_attributes()[key] = value
+
+    def __delitem__(self, key):
+        del self.get_attributes()[key]
+
+    def __iter__(self):
+        return iter(self.get_attributes())
+
+    def __len__(self):
+        return len(self.get_attributes())
+
+    def __repr__(self):
+        return repr(self.get_attributes())
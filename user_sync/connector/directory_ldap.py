@@ -18,10 +18,20 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import functools
+import json
+import queue
+import re
 import six
 import string
+import threading
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
 
 import ldap3
+from ldap3.utils.conv import escape_filter_chars
 
 import user_sync.connector.helper
 import user_sync.error
@@ -31,11 +41,25 @@ from user_sync.config.common import DictConfig
 from user_sync.error import AssertionException
 from user_sync.config import user_sync as config
 from user_sync.config import common as config_common
+from user_sync.cache.ldap import LdapCache
 
 import platform
 import ssl
 
 
+# ways to find the members of nested groups: searching each group in turn (client), or letting Active Directory
+# do it with its LDAP_MATCHING_RULE_IN_CHAIN rule (in_chain)
+NESTED_GROUP_STRATEGIES = ('client', 'in_chain')
+IN_CHAIN_GROUP_MEMBER_FILTER_FORMAT = '(memberOf:1.2.840.113556.1.4.1941:={group_dn})'
+ACTIVE_DIRECTORY_CAPABILITY = '1.2.840.113556.1.4.800'
+# attributes that tell which entries changed since the users (or the group graph) were cached
+CHANGE_ATTRIBUTES = ('uSNChanged', 'modifyTimestamp')
+# modifyTimestamp is set by the server's clock, so changes are read again from a little before the last read
+MODIFY_TIMESTAMP_OVERLAP_SECONDS = 300
+# the entry giving the current time of servers that don't publish it in the root DSE (OpenLDAP's monitor backend)
+MONITOR_CURRENT_TIME_DN = 'cn=Current,cn=Time,cn=Monitor'
+
+
 class LDAPDirectoryConnector(DirectoryConnector):
     name = 'ldap'
 
@@ -58,6 +82,8 @@ class LDAPDirectoryConnector(DirectoryConnector):
         self.user_given_name_formatter = LDAPValueFormatter(options['user_given_name_format'])
         self.user_surname_formatter = LDAPValueFormatter(options['user_surname_format'])
         self.user_country_code_formatter = LDAPValueFormatter(options['user_country_code_format'])
+        # the attributes read for users, by extended attributes and member attribute
+        self.user_attribute_names_cache = {}
 
         auth_method = options['authentication_method'].lower()
         auth_cred_required = ['simple', 'ntlm']
@@ -101,21 +127,147 @@ class LDAPDirectoryConnector(DirectoryConnector):
         else:
             raise AssertionException('LDAP Authentication Method is not supported: %s' % auth_method)
 
-        tls = None
-        auto_bind = ldap3.AUTO_BIND_NO_TLS
+        self.tls = None
         if options['require_tls_cert']:
-            tls = ldap3.Tls(validate=ssl.CERT_REQUIRED, version=ssl.PROTOCOL_TLSv1_2)
+            self.tls = ldap3.Tls(validate=ssl.CERT_REQUIRED, version=ssl.PROTOCOL_TLSv1_2)
+        self.connection_class = Connection
+        self.auth = auth
+        self.connection = connection = self.connect(options['host'])
+        logger.debug('Connected as %s', connection.extend.standard.who_am_i())
+
+        # in pooled mode, searches that don't depend on each other are spread over several connections
+        self.connection_pool = None
+        self.search_executor = None
+        if options['connection_pool'] is not None:
+            self.open_connection_pool(options['connection_pool'])
+        self.nested_group_strategy = None
+        self.select_nested_group_strategy()
+        self.user_by_dn = {}
+        self.additional_group_filters = None
+        # group DNs looked up in earlier runs are reused until they expire
+        self.ldap_cache = None
+        if options['cache'] is not None:
+            self.ldap_cache = LdapCache(Path(options['cache']['path']), options['cache']['group_dn_ttl'],
+                                        options['cache']['group_members_ttl'])
+        # the group graph, for two_steps_lookup: the direct and the nested member DNs of each entry, by lower-cased DN
+        self.member_dns_by_dn = None
+        self.nested_member_dns_by_dn = {}
+
+    def connect(self, host):
+        """
+        Open a connection to an LDAP server, bound with the configured authentication method.
+        :type host: str
+        :rtype ldap3.Connection
+        """
+        auto_bind = ldap3.AUTO_BIND_NO_TLS
         try:
-            server = ldap3.Server(host=options['host'], allowed_referral_hosts=True, tls=tls)
-            if server.ssl is False and tls is not None:
+            server = ldap3.Server(host=host, allowed_referral_hosts=True, tls=self.tls)
+            if server.ssl is False and self.tls is not None:
                 auto_bind = ldap3.AUTO_BIND_TLS_BEFORE_BIND
-            connection = Connection(server, auto_bind=auto_bind, read_only=True, **auth)
+            return self.connection_class(server, auto_bind=auto_bind, read_only=True, **self.auth)
         except Exception as e:
             raise AssertionException('LDAP connection failure: %s' % e)
-        self.connection = connection
-        logger.debug('Connected as %s', connection.extend.standard.who_am_i())
-        self.user_by_dn = {}
-        self.additional_group_filters = None
+
+    def select_nested_group_strategy(self):
+        """
+        With two_steps_lookup and nested_group, pick the way nested groups are expanded.  The in_chain
+        strategy has the server find all the members of a group, nested or not, with one search using
+        the in-chain matching rule in place of the two-step lookup, so it needs Active Directory.  If the
+        server isn't, the groups are expanded by the client, one search per entry.
+        """
+        options = self.options
+        if not options['two_steps_enabled'] or not options['two_steps_lookup']['nested_group']:
+            return
+        strategy = options['two_steps_lookup']['nested_group_strategy']
+        if strategy == 'in_chain' and not self.is_active_directory():
+            self.logger.warning("nested_group_strategy 'in_chain' needs Active Directory, using 'client' instead")
+            strategy = 'client'
+        if strategy == 'in_chain':
+            options['two_steps_enabled'] = False
+            options['group_member_filter_format'] = str(IN_CHAIN_GROUP_MEMBER_FILTER_FORMAT)
+        self.nested_group_strategy = strategy
+        self.logger.info("Nested groups expanded with strategy '%s'", strategy)
+
+    def is_active_directory(self):
+        """
+        :rtype bool: whether the server's root DSE lists the Active Directory capability
+        """
+        connection = self.connection
+        try:
+            connection.search(search_base='', search_filter='(objectClass=*)', search_scope=ldap3.BASE,
+                              attributes=['supportedCapabilities'])
+            result = connection.entries
+        except Exception as e:
+            self.logger.warning('Error reading the root DSE: %s', e)
+            return False
+        if not result:
+            return False
+        capabilities = LDAPValueFormatter.get_attribute_value(result[0].entry_attributes_as_dict,
+                                                              'supportedCapabilities') or []
+        return ACTIVE_DIRECTORY_CAPABILITY in capabilities
+
+    def log_nested_group_searches(self, group_count, member_count):
+        """
+        With the in_chain strategy, log the searches it saved: the client strategy would have searched each of
+        the members found (and each nested group) on its own.
+        :type group_count: int
+        :type member_count: int
+        """
+        if self.nested_group_strategy == 'in_chain':
+            self.logger.info('Nested groups expanded by the server in %d searches, saving at least %d member searches',
+                             group_count, member_count)
+
+    def open_connection_pool(self, pool_options):
+        """
+        Open the connections of the pool, spread in turn over the main host and any additional hosts,
+        with at most max_connections_per_server connections to each.
+        :type pool_options: dict
+        """
+        hosts = [self.options['host']] + pool_options['hosts']
+        size = min(pool_options['size'], len(hosts) * pool_options['max_connections_per_server'])
+        if size < pool_options['size']:
+            self.logger.warning('LDAP connection pool limited to %d connections by max_connections_per_server', size)
+        if size < 2:
+            return
+        connections = [self.connection]
+        for i in range(1, size):
+            connections.append(self.connect(hosts[i % len(hosts)]))
+        self.connection_pool = queue.Queue(size)
+        for connection in connections:
+            self.connection_pool.put(connection)
+        self.search_executor = ThreadPoolExecutor(max_workers=size)
+        self.logger.debug('Opened %d LDAP connections to %d servers', size, min(size, len(hosts)))
+
+    def map_searches(self, function, items):
+        """
+        Call function(connection, item) for each item.  In pooled mode, the calls are run in parallel,
+        each with a connection of its own from the pool.
+        :type function: callable
+        :type items: list
+        :rtype iterable: the results of the calls, in the order of the items
+        """
+        if self.connection_pool is None or len(items) < 2:
+            return (function(self.connection, item) for item in items)
+
+        return self.iter_pooled_results(function, items)
+
+    def iter_pooled_results(self, function, items):
+        def call(item):
+            connection = self.connection_pool.get()
+            try:
+                return function(connection, item)
+            finally:
+                self.connection_pool.put(connection)
+
+        # only a few calls are queued ahead of the results being used, so results don't pile up
+        max_ahead = self.connection_pool.maxsize * 2
+        futures = deque()
+        for item in items:
+            futures.append(self.search_executor.submit(call, item))
+            if len(futures) >= max_ahead:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
 
     @staticmethod
     def get_options(caller_config):
@@ -138,6 +290,11 @@ class LDAPDirectoryConnector(DirectoryConnector):
         builder.set_string_value('dynamic_group_member_attribute', None)
         builder.set_string_value('user_identity_type', None)
         builder.set_int_value('search_page_size', 200)
+        builder.set_int_value('search_queue_depth', 0)
+        builder.set_int_value('group_lookup_batch_size', 100)
+        builder.set_bool_value('scan_group_membership', False)
+        builder.set_dict_value('cache', None)
+        builder.set_dict_value('connection_pool', None)
         builder.set_string_value('logger_name', LDAPDirectoryConnector.name)
         builder.set_string_value('authentication_method', str('simple'))
         builder.set_string_value('username', None)
@@ -151,14 +308,84 @@ class LDAPDirectoryConnector(DirectoryConnector):
             ts_builder = config_common.OptionsBuilder(ts_config)
             ts_builder.require_string_value('group_member_attribute_name')
             ts_builder.set_bool_value('nested_group', False)
+            ts_builder.set_string_value('member_dn_attribute', str('distinguishedName'))
+            ts_builder.set_int_value('member_lookup_batch_size', 100)
+            ts_builder.set_string_value('nested_group_strategy', str('client'))
             options['two_steps_enabled'] = True
             options['two_steps_lookup'] = ts_builder.get_options()
+            if options['two_steps_lookup']['member_lookup_batch_size'] < 1:
+                raise AssertionException("'two_steps_lookup' 'member_lookup_batch_size' must be at least 1")
+            if options['two_steps_lookup']['nested_group_strategy'] not in NESTED_GROUP_STRATEGIES:
+                raise AssertionException("'two_steps_lookup' 'nested_group_strategy' must be one of: %s" %
+                                         ', '.join(NESTED_GROUP_STRATEGIES))
             if options['group_member_filter_format']:
                 raise AssertionException(
                     "Cannot define both 'group_member_attribute_name' and 'group_member_filter_format' in config")
         else:
             if not options['group_member_filter_format']:
                 options['group_member_filter_format'] = str('(memberOf={group_dn})')
+        if options['scan_group_membership']:
+            # the scan takes each user's groups from its member attribute, so none of these would be used
+            ignored_options = []
+            if options['two_steps_enabled']:
+                ignored_options.append('two_steps_lookup')
+                if options['two_steps_lookup']['nested_group']:
+                    ignored_options.append('nested_group')
+                if options['two_steps_lookup']['nested_group_strategy'] != 'client':
+                    ignored_options.append('nested_group_strategy')
+            elif options['group_member_filter_format'] != '(memberOf={group_dn})':
+                ignored_options.append('group_member_filter_format')
+            if ignored_options:
+                raise AssertionException("'scan_group_membership' can't be used with: %s" %
+                                         ', '.join("'%s'" % name for name in ignored_options))
+        if options['search_queue_depth'] < 0:
+            raise AssertionException("'search_queue_depth' must not be negative")
+        if options['group_lookup_batch_size'] < 1:
+            raise AssertionException("'group_lookup_batch_size' must be at least 1")
+
+        if options['connection_pool'] is not None:
+            pool_config = caller_config.get_dict_config('connection_pool', True)
+            pool_builder = config_common.OptionsBuilder(pool_config)
+            pool_builder.set_int_value('size', 4)
+            pool_builder.set_int_value('max_connections_per_server', None)
+            pool_builder.set_value('hosts', list, [])
+            pool_options = pool_builder.get_options()
+            if pool_options['size'] < 1:
+                raise AssertionException("'connection_pool' 'size' must be at least 1")
+            if pool_options['max_connections_per_server'] is None:
+                pool_options['max_connections_per_server'] = pool_options['size']
+            elif pool_options['max_connections_per_server'] < 1:
+                raise AssertionException("'connection_pool' 'max_connections_per_server' must be at least 1")
+            pool_options['hosts'] = [str(host) for host in pool_options['hosts']]
+            options['connection_pool'] = pool_options
+
+        if options['cache'] is not None:
+            cache_config = caller_config.get_dict_config('cache', True)
+            cache_builder = config_common.OptionsBuilder(cache_config)
+            cache_builder.require_string_value('path')
+            cache_builder.set_int_value('group_dn_ttl', 86400)
+            cache_builder.set_int_value('group_members_ttl', 0)
+            cache_builder.set_string_value('group_members_change_attribute', None)
+            cache_builder.set_dict_value('users', None)
+            options['cache'] = cache_builder.get_options()
+            if options['cache']['users'] is not None:
+                users_builder = config_common.OptionsBuilder(cache_config.get_dict_config('users', True))
+                users_builder.set_string_value('change_attribute', str('uSNChanged'))
+                users_builder.set_string_value('id_attribute', str('objectGUID'))
+                users_builder.set_int_value('full_reload_interval', 86400)
+                user_cache_options = users_builder.get_options()
+                if user_cache_options['change_attribute'] not in CHANGE_ATTRIBUTES:
+                    raise AssertionException("'cache' 'users' 'change_attribute' must be one of: %s" %
+                                             ', '.join(CHANGE_ATTRIBUTES))
+                options['cache']['users'] = user_cache_options
+            # the group graph is checked for changes with the same attribute as the users, unless told otherwise
+            if options['cache']['group_members_change_attribute'] is None:
+                options['cache']['group_members_change_attribute'] = (
+                    options['cache']['users']['change_attribute'] if options['cache']['users'] is not None
+                    else str('uSNChanged'))
+            if options['cache']['group_members_change_attribute'] not in CHANGE_ATTRIBUTES:
+                raise AssertionException("'cache' 'group_members_change_attribute' must be one of: %s" %
+                                         ', '.join(CHANGE_ATTRIBUTES))
         return options
 
     def load_users_and_groups(self, groups, extended_attributes, all_users):
@@ -169,10 +396,11 @@ class LDAPDirectoryConnector(DirectoryConnector):
         :rtype (bool, iterable(dict))
         """
         options = self.options
+        if all_users and options['scan_group_membership']:
+            return self.load_users_and_groups_from_scan(groups, extended_attributes)
         user = {}
         base_dn = str(options['base_dn'])
         all_users_filter = str(options['all_users_filter'])
-        group_member_filter_format = str(options['group_member_filter_format'])
         grouped_user_records = {}
         if options['two_steps_enabled']:
             group_member_attribute_name = str(options['two_steps_lookup']['group_member_attribute_name'])
@@ -185,45 +413,59 @@ class LDAPDirectoryConnector(DirectoryConnector):
                 raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
 
         # for each group that's required, do one search for the users of that group
+        found_groups = []
+        group_dn_by_group = self.find_ldap_group_dns(groups)
         for group in groups:
-            group_users = 0
-            group_dn = self.find_ldap_group_dn(group)
+            group_dn = group_dn_by_group.get(group)
             if not group_dn:
                 self.logger.warning("No group found for: %s", group)
                 continue
-            group_member_subfilter = self.format_ldap_query_string(group_member_filter_format, group_dn=group_dn)
-            if not group_member_subfilter.startswith('('):
-                group_member_subfilter = str('(') + group_member_subfilter + str(')')
-            user_subfilter = all_users_filter
-            if not user_subfilter.startswith('('):
-                user_subfilter = str('(') + user_subfilter + str(')')
-            group_user_filter = str('(&') + group_member_subfilter + user_subfilter + str(')')
-            group_users = 0
-            try:
-                if options['two_steps_enabled']:
-                    for user_dn in self.iter_group_member_dns(group_dn, group_member_attribute_name):
-                        # check to make sure user_dn are within the base_dn scope
-                        if self.is_dn_within_base_dn_scope(base_dn, user_dn):
-                            # replace base_dn with user_dn and filter with all_users_filter to do user lookup based on DN
-                            result = list(self.iter_users(user_dn, all_users_filter, extended_attributes))
-                            if result:
-                                # iter_users should only return 1 user when doing two_steps lookup.
-                                if len(result) > 1:
-                                    raise AssertionException(
-                                        "Unexpected multiple LDAP object found in 'two_steps_lookup' mode for: %s" % user_dn)
-                                else:
-                                    user = result[0][1]
-                                    user['groups'].append(group)
-                                    group_users += 1
-                                    grouped_user_records[user_dn] = user
-                else:
-                    for user_dn, user in self.iter_users(base_dn, group_user_filter, extended_attributes):
+            found_groups.append((group, group_dn))
+        user_attribute_names, user_extended_attributes = self.get_user_attribute_names(extended_attributes)
+
+        def search_group_members(connection, found_group):
+            group_user_filter = self.format_group_user_filter(found_group[1])
+            return self.search_users(connection, base_dn, group_user_filter, user_attribute_names)
+
+        try:
+            if options['two_steps_enabled']:
+                member_dns_by_group = []
+                for group, group_dn in found_groups:
+                    # check to make sure user_dn are within the base_dn scope
+                    member_dns = [user_dn for user_dn in self.iter_group_member_dns(group_dn, group_member_attribute_name)
+                                  if self.is_dn_within_base_dn_scope(base_dn, user_dn)]
+                    member_dns_by_group.append((group, member_dns))
+                # members already loaded (by the all users search, or as members of another group) aren't looked up
+                user_by_lower_dn = {dn.lower(): user for dn, user in self.user_by_dn.items()}
+                new_member_dns = {}
+                for _, member_dns in member_dns_by_group:
+                    for user_dn in member_dns:
+                        if user_dn.lower() not in user_by_lower_dn:
+                            new_member_dns.setdefault(user_dn.lower(), user_dn)
+                for records in self.iter_member_records(list(new_member_dns.values()), user_attribute_names):
+                    for user_dn, user in self.iter_users_from_records(records, user_extended_attributes):
+                        user_by_lower_dn[user_dn.lower()] = user
+                for group, member_dns in member_dns_by_group:
+                    group_users = 0
+                    for user_dn in member_dns:
+                        user = user_by_lower_dn.get(user_dn.lower())
+                        if user is not None:
+                            user['groups'].append(group)
+                            group_users += 1
+                            grouped_user_records[user_dn] = user
+                    self.logger.debug('Count of users in group "%s": %d', group, group_users)
+            else:
+                group_records = self.map_searches(search_group_members, found_groups)
+                for (group, group_dn), records in zip(found_groups, group_records):
+                    group_users = 0
+                    for user_dn, user in self.iter_users_from_records(records, user_extended_attributes):
                         user['groups'].append(group)
                         group_users += 1
                         grouped_user_records[user_dn] = user
-            except Exception as e:
-                raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
-            self.logger.debug('Count of users in group "%s": %d', group, group_users)
+                    self.logger.debug('Count of users in group "%s": %d', group, group_users)
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+        self.log_nested_group_searches(len(found_groups), len(grouped_user_records))
 
         # if all users are requested, do an additional search for all of them
         if all_users:
@@ -244,6 +486,252 @@ class LDAPDirectoryConnector(DirectoryConnector):
         self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
         return self.user_by_dn.values()
 
+    def load_users_and_groups_from_scan(self, groups, extended_attributes):
+        """
+        Read all users in a single scan, and work out their groups from their member attribute
+        (dynamic_group_member_attribute, or memberOf), rather than with one search per group.
+        This only finds direct members of the groups.
+        :type groups: list(str)
+        :type extended_attributes: list(str)
+        :rtype iterable(dict)
+        """
+        options = self.options
+        groups_by_member_dn = self.get_groups_by_member_dn(groups)
+        group_users = Counter()
+        ungrouped_users = 0
+        try:
+            for user_dn, user in self.iter_users(str(options['base_dn']), str(options['all_users_filter']),
+                                                 extended_attributes, groups_by_member_dn=groups_by_member_dn):
+                group_users.update(user['groups'])
+                if not user['groups']:
+                    ungrouped_users += 1
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+        for group in groups:
+            if group in group_users:
+                self.logger.debug('Count of users in group "%s": %d', group, group_users[group])
+        if groups:
+            self.logger.debug('Count of users in any groups: %d', len(self.user_by_dn) - ungrouped_users)
+            self.logger.debug('Count of users not in any groups: %d', ungrouped_users)
+        self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
+        return self.user_by_dn.values()
+
+    def get_groups_by_member_dn(self, groups):
+        """
+        :type groups: list(str)
+        :rtype dict(str, list(str)): the groups found, by lower-cased DN
+        """
+        groups_by_member_dn = defaultdict(list)
+        for group, group_dn in self.find_ldap_group_dns(groups).items():
+            if not group_dn:
+                self.logger.warning("No group found for: %s", group)
+                continue
+            groups_by_member_dn[group_dn.lower()].append(group)
+        return groups_by_member_dn
+
+    def get_member_attribute(self):
+        """
+        :rtype str: the user attribute that holds the DNs of the user's groups
+        """
+        return str(self.options['dynamic_group_member_attribute'] or 'memberOf')
+
+    def iter_users_and_groups(self, groups, extended_attributes, all_users):
+        """
+        Streaming counterpart of load_users_and_groups.  A first pass only collects the DNs of the members
+        of each group; a second pass reads each user once and yields it with its groups, so the users
+        are never all held in memory.
+        :type groups: list(str)
+        :type extended_attributes: list(str)
+        :type all_users: bool
+        :rtype iterable(dict)
+        """
+        options = self.options
+        base_dn = str(options['base_dn'])
+        all_users_filter = str(options['all_users_filter'])
+        if all_users and options['scan_group_membership']:
+            # the groups of each user come from its member attribute, in the single scan
+            groups_by_member_dn = self.get_groups_by_member_dn(groups)
+            user_count = 0
+            try:
+                for _, user in self.iter_users(base_dn, all_users_filter, extended_attributes, cache_users=False,
+                                               groups_by_member_dn=groups_by_member_dn):
+                    user_count += 1
+                    yield user
+            except Exception as e:
+                raise AssertionException('Unexpected LDAP failure reading users: %s' % e)
+            self.logger.debug('Total users loaded: %d', user_count)
+            return
+        two_steps_enabled = options['two_steps_enabled']
+        if two_steps_enabled:
+            group_member_attribute_name = str(options['two_steps_lookup']['group_member_attribute_name'])
+
+        # DNs are compared case-insensitively, since member attributes don't always match the entry DN's case
+        groups_by_dn = defaultdict(list)
+        group_dns = []
+        group_dn_by_group = self.find_ldap_group_dns(groups)
+        for group in groups:
+            group_dn = group_dn_by_group.get(group)
+            if not group_dn:
+                self.logger.warning("No group found for: %s", group)
+                continue
+            group_dns.append((group, group_dn))
+        user_attribute_names, user_extended_attributes = self.get_user_attribute_names(extended_attributes)
+
+        def search_member_dns(connection, found_group):
+            group_user_filter = self.format_group_user_filter(found_group[1])
+            return [dn for dn, _ in self.iter_search_result(base_dn, ldap3.SUBTREE, group_user_filter,
+                                                            ldap3.NO_ATTRIBUTES, connection)]
+
+        def search_group_members(connection, found_group):
+            group_user_filter = self.format_group_user_filter(found_group[1])
+            return self.search_users(connection, base_dn, group_user_filter, user_attribute_names)
+
+        try:
+            if two_steps_enabled:
+                member_dn_lists = ([dn for dn in self.iter_group_member_dns(group_dn, group_member_attribute_name)
+                                    if self.is_dn_within_base_dn_scope(base_dn, dn)]
+                                   for _, group_dn in group_dns)
+            else:
+                member_dn_lists = self.map_searches(search_member_dns, group_dns)
+            for (group, _), member_dns in zip(group_dns, member_dn_lists):
+                group_users = 0
+                for user_dn in member_dns:
+                    if user_dn is not None:
+                        groups_by_dn[user_dn.lower()].append(group)
+                        group_users += 1
+                self.logger.debug('Count of members in group "%s": %d', group, group_users)
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+        self.log_nested_group_searches(len(group_dns), len(groups_by_dn))
+
+        user_count = 0
+        try:
+            if all_users:
+                for user_dn, user in self.iter_users(base_dn, all_users_filter, extended_attributes,
+                                                     cache_users=False):
+                    user['groups'] = groups_by_dn.get(user_dn.lower(), [])
+                    user_count += 1
+                    yield user
+            elif two_steps_enabled:
+                for records in self.iter_member_records(list(groups_by_dn), user_attribute_names):
+                    for user_dn, user in self.iter_users_from_records(records, user_extended_attributes,
+                                                                      cache_users=False):
+                        user_groups = groups_by_dn.pop(user_dn.lower(), None)
+                        if user_groups is None:
+                            continue
+                        user['groups'] = user_groups
+                        user_count += 1
+                        yield user
+            else:
+                yielded_dns = set()
+                for (group, _), records in zip(group_dns, self.map_searches(search_group_members, group_dns)):
+                    for user_dn, user in self.iter_users_from_records(records, user_extended_attributes,
+                                                                      cache_users=False):
+                        if user_dn.lower() in yielded_dns:
+                            continue
+                        yielded_dns.add(user_dn.lower())
+                        user['groups'] = groups_by_dn.get(user_dn.lower(), [group])
+                        user_count += 1
+                        yield user
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading users: %s' % e)
+        self.logger.debug('Total users loaded: %d', user_count)
+
+    def iter_member_records(self, member_dns, user_attribute_names):
+        """
+        Read the records of the users with the given DNs, for two_steps_lookup.  The DNs are looked up
+        in batches of member_lookup_batch_size, with one search per batch on member_dn_attribute.  If a
+        batch finds none of its DNs (as happens if the directory doesn't have that attribute), its DNs
+        are looked up one at a time.
+        :type member_dns: list(str)
+        :type user_attribute_names: list(str)
+        :rtype iterable(list(tuple(str, dict))): the records found, a list per batch
+        """
+        options = self.options
+        base_dn = str(options['base_dn'])
+        all_users_filter = str(options['all_users_filter'])
+        member_dn_attribute = options['two_steps_lookup']['member_dn_attribute']
+        batch_size = options['two_steps_lookup']['member_lookup_batch_size']
+
+        def search_member(connection, user_dn):
+            # replace base_dn with user_dn and filter with all_users_filter to do user lookup based on DN
+            records = self.search_users(connection, user_dn, all_users_filter, user_attribute_names)
+            if len(records) > 1:
+                raise AssertionException(
+                    "Unexpected multiple LDAP object found in 'two_steps_lookup' mode for: %s" % user_dn)
+            return records
+
+        def search_members(connection, batch):
+            if len(batch) == 1:
+                return search_member(connection, batch[0])
+            dn_filters = ''.join('(%s=%s)' % (member_dn_attribute, escape_filter_chars(dn)) for dn in batch)
+            users_filter = '(&%s(|%s))' % (all_users_filter, dn_filters)
+            records = self.search_users(connection, base_dn, users_filter, user_attribute_names)
+            if not records:
+                records = [record for user_dn in batch for record in search_member(connection, user_dn)]
+            return records
+
+        batches = [member_dns[i:i + batch_size] for i in range(0, len(member_dns), batch_size)]
+        self.logger.debug('Looking up %d group members in %d searches', len(member_dns), len(batches))
+        return self.map_searches(search_members, batches)
+
+    def find_ldap_group_dns(self, groups):
+        """
+        Find the DNs of many groups at once: groups are looked up in batches, with one search per batch
+        whose filter ORs the filters of the groups in it.  This needs the group_filter_format to name
+        the group with a single (attribute={group}) term, so each group found can be matched to its name;
+        otherwise, and for any group a batch search doesn't find, groups are looked up one by one.
+        DNs found in earlier runs are taken from the cache, if there is one.
+        :type groups: list(str)
+        :rtype dict(str, str)
+        """
+        options = self.options
+        base_dn = str(options['base_dn'])
+        group_filter_format = str(options['group_filter_format'])
+        group_dn_by_group = {}
+        filter_by_group = {group: self.format_ldap_query_string(group_filter_format, group=group) for group in groups}
+        cached_dns = self.ldap_cache.get_group_dns(base_dn) if self.ldap_cache is not None else {}
+        for group, filter_string in filter_by_group.items():
+            if filter_string in cached_dns:
+                group_dn_by_group[group] = cached_dns[filter_string]
+        groups_to_find = [group for group in filter_by_group if group not in group_dn_by_group]
+        if groups_to_find:
+            self.logger.debug('Looking up %d groups (%d found in cache)', len(groups_to_find), len(group_dn_by_group))
+
+        name_attributes = re.findall(r'\(([^()=~<>]+)=\{group\}\)', group_filter_format)
+        if len(name_attributes) == 1 and len(groups_to_find) > 1:
+            name_attribute = str(name_attributes[0])
+            batch_size = options['group_lookup_batch_size']
+            for i in range(0, len(groups_to_find), batch_size):
+                batch = groups_to_find[i:i + batch_size]
+                groups_by_name = defaultdict(list)
+                for group in batch:
+                    groups_by_name[group.lower()].append(group)
+                filter_string = str('(|') + str('').join(filter_by_group[group] for group in batch) + str(')')
+                try:
+                    for dn, record in self.iter_search_result(base_dn, ldap3.SUBTREE, filter_string, [name_attribute]):
+                        if dn is None:
+                            continue
+                        names = LDAPValueFormatter.get_attribute_value(record, name_attribute) or []
+                        if isinstance(names, str):
+                            names = [names]
+                        for group in set(group for name in names for group in groups_by_name.get(name.lower(), [])):
+                            if group_dn_by_group.get(group, dn) != dn:
+                                raise AssertionException("Multiple LDAP groups found for: %s" % group)
+                            group_dn_by_group[group] = dn
+                except AssertionException:
+                    raise
+                except Exception as e:
+                    raise AssertionException('Unexpected LDAP failure reading group info: %s' % e)
+        for group in groups_to_find:
+            if group not in group_dn_by_group:
+                group_dn_by_group[group] = self.find_ldap_group_dn(group)
+
+        if self.ldap_cache is not None:
+            self.ldap_cache.cache_group_dns(base_dn, [(filter_by_group[group], group_dn_by_group[group])
+                                                     for group in groups_to_find if group_dn_by_group[group]])
+        return group_dn_by_group
+
     def find_ldap_group_dn(self, group):
         """
         :type group: str
@@ -268,42 +756,432 @@ class LDAPDirectoryConnector(DirectoryConnector):
                     group_dn = result[0].entry_dn
         return group_dn
 
-    def iter_group_member_dns(self, group_dn, member_attribute, searched_dns=None):
+    def iter_group_member_dns(self, group_dn, member_attribute):
         """
-        return group memberships dns from specified membership attribute in LDAP group object
-        :type group: str
+        return group memberships dns from specified membership attribute in LDAP group object.  If nested_group
+        is enabled, the members of member groups are returned too, before the group they are in.  Each DN is
+        returned only once.
+        :type group_dn: str
         :type member_attribute: str
         :rtype iterable(str)
         """
-        if searched_dns is None:
-            searched_dns = []
+        new_member_dns = []
+        if self.options['two_steps_lookup']['nested_group']:
+            member_dns, _ = self.get_nested_member_dns(group_dn, member_attribute, set(), new_member_dns)
+        else:
+            member_dns = list(self.get_member_dns(group_dn, member_attribute, new_member_dns))
+        if new_member_dns and self.ldap_cache is not None and self.ldap_cache.group_members_ttl > 0:
+            self.ldap_cache.cache_group_members(member_attribute, new_member_dns)
+        return iter(member_dns)
+
+    def get_nested_member_dns(self, group_dn, member_attribute, expanding_dns, new_member_dns):
+        """
+        Expand a group into all of its nested members, depth first.  Each entry is searched at most once
+        per run (see get_member_dns), and the expansion of each group is kept, so a group that appears
+        under several parents is only expanded once.  A group that is part of a cycle isn't kept, since
+        its expansion stops at the group being expanded further up.
+        :type group_dn: str
+        :type member_attribute: str
+        :type expanding_dns: set(str) (the lower-cased DNs of the groups being expanded further up)
+        :type new_member_dns: list (the entries searched, to be added to the cache)
+        :rtype (list(str), bool): the member DNs, and whether the expansion is complete
+        """
+        key = group_dn.lower()
+        member_dns = self.nested_member_dns_by_dn.get(key)
+        if member_dns is not None:
+            return member_dns, True
+        expanding_dns.add(key)
+        member_dns = []
+        seen_dns = set()
+        complete = True
+        for member_dn in self.get_member_dns(group_dn, member_attribute, new_member_dns):
+            member_key = member_dn.lower()
+            if member_key in expanding_dns:
+                complete = False
+                continue
+            if member_key in seen_dns:
+                continue
+            nested_member_dns, nested_complete = self.get_nested_member_dns(member_dn, member_attribute,
+                                                                            expanding_dns, new_member_dns)
+            complete = complete and nested_complete
+            for nested_member_dn in nested_member_dns:
+                if nested_member_dn.lower() not in seen_dns:
+                    seen_dns.add(nested_member_dn.lower())
+                    member_dns.append(nested_member_dn)
+            if member_key not in seen_dns:
+                seen_dns.add(member_key)
+                member_dns.append(member_dn)
+        expanding_dns.discard(key)
+        if complete:
+            self.nested_member_dns_by_dn[key] = member_dns
+        return member_dns, complete
+
+    def get_member_dns(self, dn, member_attribute, new_member_dns):
+        """
+        Read the direct member DNs of an entry (none, for users).  The result is kept for the rest of the run,
+        and if group_members_ttl is set, between runs as well, along with the entry's change stamp.
+        :type dn: str
+        :type member_attribute: str
+        :type new_member_dns: list (the entry is added to this if it's searched)
+        :rtype list(str)
+        """
+        change_attribute = None
+        if self.ldap_cache is not None and self.ldap_cache.group_members_ttl > 0:
+            change_attribute = self.options['cache']['group_members_change_attribute']
+        if self.member_dns_by_dn is None:
+            self.member_dns_by_dn = {}
+            if change_attribute is not None:
+                self.member_dns_by_dn.update(self.get_cached_member_dns(member_attribute, change_attribute))
+        key = dn.lower()
+        member_dns = self.member_dns_by_dn.get(key)
+        if member_dns is not None:
+            return member_dns
         connection = self.connection
-        nested_group_search = self.options['two_steps_lookup']['nested_group']
+        attributes = [member_attribute] if change_attribute is None else [member_attribute, change_attribute]
         try:
-            connection.search(search_base=group_dn, search_filter='(objectClass=*)', search_scope=ldap3.SUBTREE,
-                              attributes=member_attribute)
+            connection.search(search_base=dn, search_filter='(objectClass=*)', search_scope=ldap3.BASE,
+                              attributes=attributes)
             result = connection.entries
-            if result is not None:
+            member_dns = []
+            stamp = None
+            if result:
                 record = result[0].entry_attributes_as_dict
-                member_dns = LDAPValueFormatter.get_attribute_value(record, member_attribute)
-                for member_dn in member_dns or []:
-                    # if nested_group search enabled, look up DN and see if group member attribute exist in that object
-                    # This will recurse through until there is no nested group.
-                    if member_dn not in searched_dns:
-                        searched_dns.append(member_dn)
-                        if nested_group_search:
-                            nested_members = self.iter_group_member_dns(member_dn, member_attribute, searched_dns)
-                            for nested_member_dn in nested_members:
-                                yield nested_member_dn
-                        yield member_dn
+                member_dns = list(dict.fromkeys(LDAPValueFormatter.get_attribute_value(record, member_attribute) or []))
+                if change_attribute is not None:
+                    stamp = self.get_change_stamp(record, change_attribute)
+            new_member_dns.append((dn, member_dns, stamp))
         except Exception as e:
-            self.logger.warning('Error lookup %s : %s', group_dn, e)
-            pass
+            self.logger.warning('Error lookup %s : %s', dn, e)
+            member_dns = []
+        self.member_dns_by_dn[key] = member_dns
+        return member_dns
+
+    def get_cached_member_dns(self, member_attribute, change_attribute):
+        """
+        Read the group graph kept from earlier runs.  The entries under base_dn that changed since the graph
+        was last checked are found with a single search, and those whose change stamp moved since they were
+        cached are dropped, so they are searched again.  Entries outside base_dn can't be checked that way,
+        and are kept until group_members_ttl has passed.
+        :type member_attribute: str
+        :type change_attribute: str
+        :rtype dict(str, list(str)): the direct member DNs of each entry, by lower-cased DN
+        """
+        cache = self.ldap_cache
+        high_water_mark = self.get_change_high_water_mark(change_attribute)
+        cached_entries = cache.get_group_members(member_attribute)
+        previous_mark = cache.get_group_members_mark(member_attribute)
+        if previous_mark is None:
+            # there's no telling what changed since these were cached
+            changed_dns = set(cached_entries)
+        else:
+            changed_dns = set()
+            if cached_entries:
+                change_filter = self.format_change_filter(change_attribute, previous_mark)
+                try:
+                    for dn, record in self.iter_search_result(str(self.options['base_dn']), ldap3.SUBTREE,
+                                                              change_filter, [change_attribute]):
+                        if dn is None:
+                            continue
+                        entry = cached_entries.get(dn.lower())
+                        if entry is not None and entry[1] != self.get_change_stamp(record, change_attribute):
+                            changed_dns.add(dn.lower())
+                except Exception as e:
+                    raise AssertionException('Unexpected LDAP failure reading changed groups: %s' % e)
+        cache.set_group_members_mark(member_attribute, high_water_mark, list(changed_dns))
+        self.logger.debug('Group graph: %d cached entries, %d changed since they were cached',
+                          len(cached_entries), len(changed_dns))
+        return {dn: members for dn, (members, _) in cached_entries.items() if dn not in changed_dns}
+
+    @staticmethod
+    def get_change_stamp(record, change_attribute):
+        """
+        :type record: dict
+        :type change_attribute: str
+        :rtype str: the entry's change attribute, as text (None if it has none)
+        """
+        value = record.get(change_attribute)
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else None
+        return None if value is None else str(value)
 
-    def iter_users(self, base_dn, users_filter, extended_attributes):
+    def iter_users(self, base_dn, users_filter, extended_attributes, cache_users=True, groups_by_member_dn=None):
+        """
+        :type base_dn: str
+        :type users_filter: str
+        :type extended_attributes: list(str)
+        :type cache_users: bool (if False, users are neither looked up in nor added to user_by_dn)
+        :type groups_by_member_dn: dict(str, list(str)) (if given, each user's groups are those of the
+            lower-cased DNs in the user's member attribute)
+        :rtype iterable(tuple(str, dict))
+        """
+        member_attribute = self.get_member_attribute() if groups_by_member_dn is not None else None
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes,
+                                                                                  member_attribute)
         options = self.options
-        dynamic_group_member_attribute = options['dynamic_group_member_attribute']
+        if (options['cache'] is not None and options['cache']['users'] is not None and
+                base_dn == str(options['base_dn']) and users_filter == str(options['all_users_filter'])):
+            result_iter = self.iter_cached_user_records(user_attribute_names)
+        else:
+            result_iter = self.iter_user_records(base_dn, users_filter, user_attribute_names)
+        return self.iter_users_from_records(result_iter, extended_attributes, cache_users, groups_by_member_dn)
 
+    def iter_user_records(self, base_dn, users_filter, user_attribute_names):
+        """
+        :type base_dn: str
+        :type users_filter: str
+        :type user_attribute_names: list(str)
+        :rtype iterable(tuple(str, dict))
+        """
+        result_iter = self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, user_attribute_names)
+        if self.options['search_queue_depth'] > 0 and self.options['search_page_size'] > 0:
+            result_iter = self.iter_prefetched(result_iter, self.options['search_page_size'],
+                                               self.options['search_queue_depth'])
+        return result_iter
+
+    def iter_cached_user_records(self, user_attribute_names):
+        """
+        Read the records of all users through the user cache.  Once all users have been read into the
+        cache, later runs only read the entries whose change_attribute is past the cache's high-water
+        mark: those that match all_users_filter replace their cached records, and the others (such as
+        disabled users) are removed.  Entries are kept by id_attribute, so a user that is moved or renamed
+        isn't cached twice.  Users that are deleted (or moved out of base_dn) are only removed when all
+        users are read again, every full_reload_interval seconds, or whenever the search changes.
+        :type user_attribute_names: list(str)
+        :rtype iterable(tuple(str, dict))
+        """
+        options = self.options
+        user_cache_options = options['cache']['users']
+        change_attribute = user_cache_options['change_attribute']
+        id_attribute = user_cache_options['id_attribute']
+        base_dn = str(options['base_dn'])
+        users_filter = str(options['all_users_filter'])
+        if not users_filter.startswith('('):
+            users_filter = '(' + users_filter + ')'
+        attribute_names = list(user_attribute_names)
+        if id_attribute not in attribute_names:
+            attribute_names.append(id_attribute)
+        fingerprint = json.dumps([options['host'], base_dn, users_filter, sorted(attribute_names), change_attribute])
+        cache = self.ldap_cache
+        user_meta = cache.get_user_meta()
+        # full reloads are timed in UTC, so they don't shift with the local time zone or daylight saving
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        # the mark is taken before reading, so changes made while the users are read are read again next time
+        high_water_mark = self.get_change_high_water_mark(change_attribute)
+
+        if (user_meta is None or user_meta[0] != fingerprint or
+                user_meta[2] + timedelta(seconds=user_cache_options['full_reload_interval']) <= now):
+            self.logger.info('Reading all users into the user cache')
+            cache.clear_users()
+            try:
+                batch = []
+                for dn, record in self.iter_user_records(base_dn, users_filter, attribute_names):
+                    if dn is None:
+                        continue
+                    batch.append(self.get_user_cache_row(dn, record, id_attribute))
+                    if len(batch) >= 1000:
+                        cache.add_users(batch)
+                        batch = []
+                    yield dn, record
+                cache.add_users(batch)
+            except BaseException:
+                # the users read so far aren't kept, so the cache stays as it was
+                cache.discard_user_changes()
+                raise
+            cache.set_user_meta(fingerprint, high_water_mark, now)
+            return
+
+        change_filter = self.format_change_filter(change_attribute, user_meta[1])
+        changed_users = 0
+        batch = []
+        changed_filter = '(&%s%s)' % (users_filter, change_filter)
+        for dn, record in self.iter_user_records(base_dn, changed_filter, attribute_names):
+            if dn is None:
+                continue
+            batch.append(self.get_user_cache_row(dn, record, id_attribute))
+            changed_users += 1
+            if len(batch) >= 1000:
+                cache.add_users(batch)
+                batch = []
+        cache.add_users(batch)
+        removed_filter = '(&(!%s)%s)' % (users_filter, change_filter)
+        removed_ids = [self.get_user_cache_row(dn, record, id_attribute)[0]
+                       for dn, record in self.iter_search_result(base_dn, ldap3.SUBTREE, removed_filter,
+                                                                 [id_attribute])
+                       if dn is not None]
+        cache.remove_users(removed_ids)
+        cache.set_user_meta(fingerprint, high_water_mark, user_meta[2])
+        self.logger.info('User cache updated: %d users changed, %d other entries changed', changed_users,
+                         len(removed_ids))
+        yield from cache.iter_users()
+
+    @staticmethod
+    def get_user_cache_row(dn, record, id_attribute):
+        """
+        :type dn: str
+        :type record: dict
+        :type id_attribute: str
+        :rtype (str, str, dict): the user's id (its DN, if it has no id attribute), DN and record
+        """
+        index = LDAPValueFormatter.index_record(record)
+        user_id = LDAPValueFormatter.get_attribute_value(index, id_attribute.lower(), first_only=True)
+        if user_id is None:
+            user_id = dn.lower()
+        return str(user_id), dn, dict(record)
+
+    def get_change_high_water_mark(self, change_attribute):
+        """
+        The mark is always read from the server, never from the local clock: the highest USN committed
+        (Active Directory), or the server's current time less an overlap, for changes whose modifyTimestamp
+        was still being written.  The time is read from the root DSE (currentTime), or from the monitor
+        backend of servers that don't publish it there (such as OpenLDAP).
+        :type change_attribute: str
+        :rtype str: the point from which changes are to be read next time
+        """
+        if change_attribute == 'modifyTimestamp':
+            value = (self.read_server_attribute('', 'currentTime') or
+                     self.read_server_attribute(MONITOR_CURRENT_TIME_DN, 'monitorTimestamp'))
+            if value is None:
+                raise AssertionException("Can't read the server's current time for the LDAP cache (use "
+                                         "'uSNChanged' if the server is Active Directory)")
+            try:
+                start = self.parse_generalized_time(value) - timedelta(seconds=MODIFY_TIMESTAMP_OVERLAP_SECONDS)
+            except ValueError as e:
+                raise AssertionException("Can't read the server's current time for the LDAP cache: %s" % e)
+            return start.strftime('%Y%m%d%H%M%SZ')
+        try:
+            usn = self.read_server_attribute('', 'highestCommittedUSN', raise_errors=True)
+            return str(int(usn))
+        except Exception as e:
+            raise AssertionException("Can't read highestCommittedUSN for the LDAP cache (use 'modifyTimestamp' "
+                                     "if the server isn't Active Directory): %s" % e)
+
+    def read_server_attribute(self, dn, attribute_name, raise_errors=False):
+        """
+        :type dn: str (the root DSE is '')
+        :type attribute_name: str
+        :type raise_errors: bool (otherwise, an entry that can't be read gives None)
+        :rtype the first value of the attribute, or None
+        """
+        connection = self.connection
+        try:
+            connection.search(search_base=dn, search_filter='(objectClass=*)', search_scope=ldap3.BASE,
+                              attributes=[attribute_name])
+            result = connection.entries
+        except Exception as e:
+            if raise_errors:
+                raise
+            self.logger.debug('Error reading %s from %r: %s', attribute_name, dn, e)
+            return None
+        if not result:
+            return None
+        return LDAPValueFormatter.get_attribute_value(result[0].entry_attributes_as_dict, attribute_name,
+                                                      first_only=True)
+
+    @staticmethod
+    def parse_generalized_time(value):
+        """
+        :type value: datetime, str or bytes (a GeneralizedTime such as 20260102030405.0Z)
+        :rtype datetime: in UTC
+        """
+        if isinstance(value, datetime):
+            return value.astimezone(timezone.utc) if value.tzinfo else value.replace(tzinfo=timezone.utc)
+        if isinstance(value, bytes):
+            value = value.decode('ascii')
+        match = re.match(r'(\d{14})(?:[.,]\d+)?(Z|[+-]\d{4})?$', str(value).strip())
+        if match is None:
+            raise ValueError('not a GeneralizedTime: %s' % value)
+        time = datetime.strptime(match.group(1), '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc)
+        zone = match.group(2)
+        if zone and zone != 'Z':
+            offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[3:]))
+            time = time - offset if zone[0] == '+' else time + offset
+        return time
+
+    @staticmethod
+    def format_change_filter(change_attribute, high_water_mark):
+        """
+        :type change_attribute: str
+        :type high_water_mark: str (from get_change_high_water_mark)
+        :rtype str: a filter for the entries changed since the high-water mark was taken
+        """
+        if change_attribute == 'modifyTimestamp':
+            return '(modifyTimestamp>=%s)' % high_water_mark
+        return '(uSNChanged>=%d)' % (int(high_water_mark) + 1)
+
+    @staticmethod
+    def iter_prefetched(result_iter, page_size, queue_depth):
+        """
+        Read search results on a thread of their own, up to queue_depth pages ahead of the caller, so the next
+        pages are fetched from the server while the caller converts the records it has.  The reading thread
+        stops once the caller is done, so the connection is free again when this returns.
+        :type result_iter: iterable(tuple(str, dict))
+        :type page_size: int
+        :type queue_depth: int
+        :rtype iterable(tuple(str, dict))
+        """
+        pages = queue.Queue(queue_depth)
+        stopped = threading.Event()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_pages():
+            page = []
+            try:
+                for result in result_iter:
+                    page.append(result)
+                    if len(page) >= page_size:
+                        if not put((page, None)):
+                            return
+                        page = []
+                put((page, None))
+                put((None, None))
+            except Exception as e:
+                put((None, e))
+
+        reader = threading.Thread(target=read_pages, name='ldap-search-reader', daemon=True)
+        reader.start()
+        try:
+            while True:
+                page, error = pages.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    return
+                yield from page
+        finally:
+            stopped.set()
+            reader.join()
+
+    def search_users(self, connection, base_dn, users_filter, user_attribute_names):
+        """
+        Read the records of the users matching a filter, for iter_users_from_records.  This can be run
+        in a worker thread (see map_searches), so it doesn't touch the connector's state.
+        :type connection: ldap3.Connection
+        :type base_dn: str
+        :type users_filter: str
+        :type user_attribute_names: list(str)
+        :rtype list(tuple(str, dict))
+        """
+        return list(self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, user_attribute_names, connection))
+
+    def get_user_attribute_names(self, extended_attributes, member_attribute=None):
+        """
+        :type extended_attributes: list(str)
+        :type member_attribute: str (if given, the member attribute is read as well)
+        :rtype (list(str), list(str)): the attributes to read for users, and the extended attributes among them
+        """
+        cache_key = (tuple(extended_attributes or ()), member_attribute)
+        if cache_key in self.user_attribute_names_cache:
+            user_attribute_names, extended_attributes = self.user_attribute_names_cache[cache_key]
+            return list(user_attribute_names), list(extended_attributes)
+        dynamic_group_member_attribute = self.options['dynamic_group_member_attribute']
         user_attribute_names = []
         user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
         user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
@@ -314,20 +1192,38 @@ class LDAPDirectoryConnector(DirectoryConnector):
         user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
         if dynamic_group_member_attribute is not None:
             user_attribute_names.append(str(dynamic_group_member_attribute))
+        elif member_attribute is not None:
+            user_attribute_names.append(member_attribute)
 
         extended_attributes = [str(attr) for attr in extended_attributes]
         extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
         user_attribute_names.extend(extended_attributes)
+        self.user_attribute_names_cache[cache_key] = (user_attribute_names, extended_attributes)
+        return list(user_attribute_names), list(extended_attributes)
 
-        result_iter = self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, user_attribute_names)
+    def iter_users_from_records(self, result_iter, extended_attributes, cache_users=True, groups_by_member_dn=None):
+        """
+        :type result_iter: iterable(tuple(str, dict)): user DNs and records, read with get_user_attribute_names
+        :type extended_attributes: list(str) (as returned by get_user_attribute_names)
+        :type cache_users: bool
+        :type groups_by_member_dn: dict(str, list(str))
+        :rtype iterable(tuple(str, dict))
+        """
+        # attributes are read from an index of each record by lower-cased name
+        dynamic_group_member_attribute = self.options['dynamic_group_member_attribute']
+        if dynamic_group_member_attribute is not None:
+            dynamic_group_member_attribute = dynamic_group_member_attribute.lower()
+        member_attribute = self.get_member_attribute().lower() if groups_by_member_dn is not None else None
+        extended_attribute_keys = [(name, name.lower()) for name in extended_attributes or []]
         for dn, record in result_iter:
             if dn is None:
                 continue
-            if dn in self.user_by_dn:
+            if cache_users and dn in self.user_by_dn:
                 yield (dn, self.user_by_dn[dn])
                 continue
 
-            email, last_attribute_name = self.user_email_formatter.generate_value(record)
+            index = LDAPValueFormatter.index_record(record)
+            email, last_attribute_name = self.user_email_formatter.generate_value(record, index)
             email = email.strip() if email else None
             if not email:
                 if last_attribute_name is not None:
@@ -340,7 +1236,7 @@ class LDAPDirectoryConnector(DirectoryConnector):
             source_attributes['email'] = email
             user['email'] = email
 
-            identity_type, last_attribute_name = self.user_identity_type_formatter.generate_value(record)
+            identity_type, last_attribute_name = self.user_identity_type_formatter.generate_value(record, index)
             if last_attribute_name and not identity_type:
                 self.logger.warning('No identity_type attribute (%s) for user with dn: %s, defaulting to %s',
                                     last_attribute_name, dn, self.user_identity_type)
@@ -354,7 +1250,7 @@ class LDAPDirectoryConnector(DirectoryConnector):
                     self.logger.warning('Skipping user with dn %s: %s', dn, e)
                     continue
 
-            username, last_attribute_name = self.user_username_formatter.generate_value(record)
+            username, last_attribute_name = self.user_username_formatter.generate_value(record, index)
             username = username.strip() if username else None
             source_attributes['username'] = username
             if username:
@@ -365,7 +1261,7 @@ class LDAPDirectoryConnector(DirectoryConnector):
                                         last_attribute_name, dn, email)
                 user['username'] = email
 
-            domain, last_attribute_name = self.user_domain_formatter.generate_value(record)
+            domain, last_attribute_name = self.user_domain_formatter.generate_value(record, index)
             domain = domain.strip() if domain else None
             source_attributes['domain'] = domain
             if domain:
@@ -375,34 +1271,39 @@ class LDAPDirectoryConnector(DirectoryConnector):
             elif last_attribute_name:
                 self.logger.warning('No domain attribute (%s) for user with dn: %s', last_attribute_name, dn)
 
-            given_name_value, last_attribute_name = self.user_given_name_formatter.generate_value(record)
+            given_name_value, last_attribute_name = self.user_given_name_formatter.generate_value(record, index)
             source_attributes['givenName'] = given_name_value
             if given_name_value is not None:
                 user['firstname'] = given_name_value
             elif last_attribute_name:
                 self.logger.warning('No given name attribute (%s) for user with dn: %s', last_attribute_name, dn)
-            sn_value, last_attribute_name = self.user_surname_formatter.generate_value(record)
+            sn_value, last_attribute_name = self.user_surname_formatter.generate_value(record, index)
             source_attributes['sn'] = sn_value
             if sn_value is not None:
                 user['lastname'] = sn_value
             elif last_attribute_name:
                 self.logger.warning('No surname attribute (%s) for user with dn: %s', last_attribute_name, dn)
-            c_value, last_attribute_name = self.user_country_code_formatter.generate_value(record)
+            c_value, last_attribute_name = self.user_country_code_formatter.generate_value(record, index)
             source_attributes['c'] = c_value
             if c_value is not None:
                 user['country'] = c_value.upper()
 
-            user['member_groups'] = self.get_member_groups(record, dynamic_group_member_attribute) if self.additional_group_filters else []
+            user['member_groups'] = self.get_member_groups(index, dynamic_group_member_attribute) if self.additional_group_filters else []
 
-            if extended_attributes is not None:
-                for extended_attribute in extended_attributes:
-                    extended_attribute_value = LDAPValueFormatter.get_attribute_value(record, extended_attribute)
-                    source_attributes[extended_attribute] = extended_attribute_value
+            for extended_attribute, key in extended_attribute_keys:
+                source_attributes[extended_attribute] = LDAPValueFormatter.get_attribute_value(index, key)
 
-            user['source_attributes'] = source_attributes.copy()
+            user['source_attributes'] = source_attributes
+            if member_attribute is not None:
+                member_dns = LDAPValueFormatter.get_attribute_value(index, member_attribute) or []
+                if isinstance(member_dns, str):
+                    member_dns = [member_dns]
+                user['groups'] = [group for member_dn in member_dns
+                                  for group in groups_by_member_dn.get(member_dn.lower(), [])]
             if 'groups' not in user:
                 user['groups'] = []
-            self.user_by_dn[dn] = user
+            if cache_users:
+                self.user_by_dn[dn] = user
 
             yield (dn, user)
 
@@ -428,11 +1329,13 @@ class LDAPDirectoryConnector(DirectoryConnector):
         return group_names
 
     @staticmethod
+    @functools.lru_cache(maxsize=65536)
     def get_cn_from_dn(group_dn):
         """
         Take a DN and return the common name
         Returns None if no common name is found
         If common name is complex (e.g. cn=Bob Jones+email=bob.jones@example.com) then first part of CN is returned
+        The same group DNs come up for many users, so the most recent ones are kept parsed
         :param group_dn:
         :return:
         """
@@ -441,12 +1344,14 @@ class LDAPDirectoryConnector(DirectoryConnector):
             return rdn[0][3:]
         return None
 
-    def iter_search_result(self, base_dn, scope, filter_string, attributes):
+    def iter_search_result(self, base_dn, scope, filter_string, attributes, connection=None):
         """
         type: filter_string: str
         type: attributes: list(str)
+        type: connection: ldap3.Connection (the main connection, if not given)
         """
-        connection = self.connection
+        if connection is None:
+            connection = self.connection
         search_page_size = self.options['search_page_size']
         if search_page_size == 0:
             connection.search(base_dn, filter_string, scope, attributes=attributes)
@@ -533,14 +1438,21 @@ class LDAPValueFormatter(object):
         """
         The format string must be a unicode or ascii string: see notes above about being careful in Py2!
         """
+        self.single_attribute = False
         if string_format is None:
             attribute_names = []
         else:
             string_format = str(string_format)  # force unicode so attribute values are unicode
             formatter = string.Formatter()
-            attribute_names = [str(item[1]) for item in formatter.parse(string_format) if item[1]]
+            parsed_format = list(formatter.parse(string_format))
+            attribute_names = [str(item[1]) for item in parsed_format if item[1]]
+            # a format that is just one attribute, such as {mail}, gives the attribute's value as it is
+            if len(parsed_format) == 1 and attribute_names:
+                literal_text, _, format_spec, conversion = parsed_format[0]
+                self.single_attribute = not literal_text and not format_spec and conversion is None
         self.string_format = string_format
         self.attribute_names = attribute_names
+        self.attribute_keys = [name.lower() for name in attribute_names]
 
     def get_attribute_names(self):
         """
@@ -548,25 +1460,44 @@ class LDAPValueFormatter(object):
         """
         return self.attribute_names
 
-    def generate_value(self, record):
+    def generate_value(self, record, index=None):
         """
         :type record: dict
+        :type index: dict (the record's index_record, when several values are generated from the record)
         :rtype (unicode, unicode)
         """
         result = None
         attribute_name = None
         if self.string_format is not None:
+            if index is not None:
+                attributes, keys = index, self.attribute_keys
+            else:
+                attributes, keys = record, self.attribute_names
             values = {}
-            for attribute_name in self.attribute_names:
-                value = self.get_attribute_value(record, attribute_name, first_only=True)
+            value = None
+            for attribute_name, key in zip(self.attribute_names, keys):
+                value = self.get_attribute_value(attributes, key, first_only=True)
                 if value is None:
                     values = None
                     break
                 values[attribute_name] = value
             if values is not None:
-                result = self.string_format.format(**values)
+                if self.single_attribute and isinstance(value, str):
+                    result = value
+                else:
+                    result = self.string_format.format(**values)
         return result, attribute_name
 
+    @staticmethod
+    def index_record(record):
+        """
+        Index the attributes of a record by lower-cased name, so that they can be read without
+        case-insensitive lookups.
+        :type record: dict
+        :rtype dict
+        """
+        return {name.lower(): value for name, value in record.items()}
+
     @classmethod
     def get_attribute_value(cls, attributes, attribute_name, first_only=False):
         """
@@ -21,6 +21,10 @@
 import okta
 import six
 import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from okta.framework.OktaError import OktaError
 
 import user_sync.connector.helper
@@ -31,6 +35,15 @@ from user_sync.config.common import DictConfig, OptionsBuilder
 from user_sync.error import AssertionException
 from user_sync.config import user_sync as config
 from user_sync.config import common as config_common
+from user_sync.cache.okta import OktaCache
+
+
+# the builtin functions that can be used in all_users_filter
+FILTER_BUILTINS = {
+    "len": len, "int": int, "float": float, "str": str, "enumerate": enumerate, "filter": filter,
+    "getattr": getattr, "hasattr": hasattr, "list": list, "map": map, "max": max, "min": min,
+    "range": range, "sorted": sorted, "sum": sum, "tuple": tuple, "zip": zip
+}
 
 
 class OktaDirectoryConnector(DirectoryConnector):
@@ -53,11 +66,22 @@ class OktaDirectoryConnector(DirectoryConnector):
         builder.set_string_value('user_surname_format', str('{lastName}'))
         builder.set_string_value('user_country_code_format', str('{countryCode}'))
         builder.set_string_value('user_identity_type', None)
+        builder.set_int_value('group_fetch_workers', 1)
+        builder.set_bool_value('list_all_groups', False)
+        builder.set_dict_value('cache', None)
         builder.set_string_value('logger_name', self.name)
         host = builder.require_string_value('host')
         api_token = builder.require_string_value('api_token')
 
         options = builder.get_options()
+        if options['group_fetch_workers'] < 1:
+            raise AssertionException("'group_fetch_workers' must be at least 1")
+        self.users_filter = self.compile_users_filter(options['all_users_filter'])
+        if options['cache'] is not None:
+            cache_builder = config_common.OptionsBuilder(caller_config.get_dict_config('cache', True))
+            cache_builder.require_string_value('path')
+            cache_builder.set_int_value('group_id_ttl', 86400)
+            options['cache'] = cache_builder.get_options()
 
         OKTAValueFormatter.encoding = options['string_encoding']
         self.user_identity_type = user_sync.identity_type.parse_identity_type(options['user_identity_type'])
@@ -82,6 +106,16 @@ class OktaDirectoryConnector(DirectoryConnector):
             host = "https://" + host
 
         self.user_by_uid = {}
+        # the users converted in this run (None for those not selected), by Okta id, and the group members read
+        self.converted_user_by_id = {}
+        self.group_member_count = 0
+        self.member_count_lock = threading.Lock()
+        # group ids looked up in earlier runs are reused until they expire, or until they are found to be stale
+        self.okta_cache = None
+        if options['cache'] is not None:
+            self.okta_cache = OktaCache(Path(options['cache']['path']), options['cache']['group_id_ttl'])
+        self.cached_group_names = set()
+        self.refreshed_group_ids = []
 
         logger.debug('%s initialized with options: %s', self.name, options)
 
@@ -89,7 +123,9 @@ class OktaDirectoryConnector(DirectoryConnector):
 
         try:
             self.users_client = okta.UsersClient(host, api_token)
-            self.groups_client = okta.UserGroupsClient(host, api_token)
+            # each worker may need a request before the rate limit is known to be spent
+            self.rate_limit = OktaRateLimit(options['group_fetch_workers'])
+            self.groups_client = RateLimitedUserGroupsClient(host, api_token, rate_limit=self.rate_limit)
         except OktaError as e:
             raise AssertionException("Error connecting to Okta: %s" % e)
 
@@ -110,26 +146,110 @@ class OktaDirectoryConnector(DirectoryConnector):
 
         self.logger.info('Loading users...')
         self.user_by_uid = user_by_uid = {}
-
-        for group in groups:
-            total_group_members = 0
-            total_group_users = 0
-            for user in self.iter_group_members(group, all_users_filter, extended_attributes):
-                total_group_members += 1
-
-                uid = user.get('uid')
-                if user and uid:
-                    if uid not in user_by_uid:
-                        user_by_uid[uid] = user
-                    total_group_users += 1
-                    user_groups = user_by_uid[uid]['groups']
-                    if group not in user_groups:
-                        user_groups.append(group)
-
-            self.logger.debug('Group %s members: %d users: %d', group, total_group_members, total_group_users)
-
+        self.converted_user_by_id = {}
+        self.group_member_count = 0
+
+        group_ids = self.find_group_ids(groups)
+
+        # with several workers, the members of several groups are read at once, and then merged in group order
+        executor = None
+        if options['group_fetch_workers'] > 1 and len(groups) > 1:
+            executor = ThreadPoolExecutor(max_workers=options['group_fetch_workers'])
+            group_members = executor.map(
+                lambda group: list(self.iter_group_members(group, all_users_filter, extended_attributes, group_ids)),
+                groups)
+        else:
+            group_members = (self.iter_group_members(group, all_users_filter, extended_attributes, group_ids)
+                             for group in groups)
+        try:
+            for group, members in zip(groups, group_members):
+                self.add_group_members(group, members)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        if self.okta_cache is not None:
+            for name, group_id in self.refreshed_group_ids:
+                self.okta_cache.remove_group_id(name)
+                if group_id is not None:
+                    self.okta_cache.cache_group_ids([(name, group_id)])
+
+        self.logger.info('Group members read: %d, unique users: %d', self.group_member_count, len(user_by_uid))
         return user_by_uid.values()
 
+    def add_group_members(self, group, members):
+        """
+        Add the members of a group to user_by_uid, and the group to the groups of each.
+        :type group: str
+        :type members: iterable(dict)
+        """
+        user_by_uid = self.user_by_uid
+        total_group_members = 0
+        total_group_users = 0
+        for user in members:
+            total_group_members += 1
+
+            uid = user.get('uid')
+            if user and uid:
+                if uid not in user_by_uid:
+                    user_by_uid[uid] = user
+                total_group_users += 1
+                user_groups = user_by_uid[uid]['groups']
+                if group not in user_groups:
+                    user_groups.append(group)
+
+        self.logger.debug('Group %s members: %d users: %d', group, total_group_members, total_group_users)
+
+    def find_group_ids(self, groups):
+        """
+        Look up the ids of groups ahead of reading their members: from the groups cached in earlier runs,
+        and, with list_all_groups, from a single listing of all groups.  Groups not found either way are
+        left out, to be searched for on their own by iter_group_members.  The cache is only used from the
+        calling thread.
+        :type groups: list(str)
+        :rtype dict(str, str): group ids by (stripped) group name, None for groups known not to exist
+        """
+        names = [group.strip() for group in groups]
+        self.refreshed_group_ids = []
+        cached_ids = self.okta_cache.get_group_ids() if self.okta_cache is not None else {}
+        group_ids = {name: cached_ids[name] for name in names if name in cached_ids}
+        self.cached_group_names = set(group_ids)
+        if self.options['list_all_groups'] and len(group_ids) < len(set(names)):
+            listed_ids = self.list_group_ids()
+            group_ids = {name: listed_ids.get(name) for name in names}
+            self.cached_group_names = set()
+            if self.okta_cache is not None:
+                self.okta_cache.cache_group_ids(listed_ids.items())
+        elif self.okta_cache is not None:
+            # groups missing from the cache are looked up now, so the cache can be updated
+            new_ids = []
+            for name in names:
+                if name not in group_ids:
+                    result = self.find_group(name)
+                    group_ids[name] = result.id if result is not None else None
+                    if result is not None:
+                        new_ids.append((name, result.id))
+            self.okta_cache.cache_group_ids(new_ids)
+        return group_ids
+
+    def list_group_ids(self):
+        """
+        List all groups, a page at a time.
+        :rtype dict(str, str): group ids by group name
+        """
+        group_ids = {}
+        try:
+            page = self.groups_client.get_paged_groups(limit=200)
+            while True:
+                for group in page.response.json():
+                    group_ids[group['profile']['name']] = group['id']
+                if page.is_last_page():
+                    break
+                page = self.groups_client.get_paged_groups(url=page.next_url)
+        except OktaError as e:
+            raise AssertionException("Okta error listing groups: %s" % e)
+        self.logger.debug('Groups listed: %d', len(group_ids))
+        return group_ids
+
     def find_group(self, group):
         """
         :type group: str
@@ -155,11 +275,12 @@ class OktaDirectoryConnector(DirectoryConnector):
 
         return None
 
-    def iter_group_members(self, group, filter_string, extended_attributes):
+    def iter_group_members(self, group, filter_string, extended_attributes, group_ids=None):
         """
         :type group: str
         :type filter_string: str
         :type extended_attributes: list
+        :type group_ids: dict(str, str) (as returned by find_group_ids: groups not in it are searched for)
         :rtype iterator(str, str)
         """
 
@@ -174,20 +295,48 @@ class OktaDirectoryConnector(DirectoryConnector):
         extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
         user_attribute_names.extend(extended_attributes)
 
-        res_group = self.find_group(group)
-        if res_group:
+        name = group.strip()
+        if group_ids is not None and name in group_ids:
+            group_id = group_ids[name]
+        else:
+            res_group = self.find_group(group)
+            group_id = res_group.id if res_group else None
+        if group_id:
+            attr_dict = OKTAValueFormatter.get_extended_attribute_dict(user_attribute_names)
             try:
-                attr_dict = OKTAValueFormatter.get_extended_attribute_dict(user_attribute_names)
-                members = self.groups_client.get_group_all_users(res_group.id, attr_dict)
+                members = self.groups_client.get_group_all_users(group_id, attr_dict)
             except OktaError as e:
-                self.logger.warning("Unable to get_group_users")
-                raise AssertionException("Okta error querying for group users: %s" % e)
-            # Filtering users based all_users_filter query in config
-            for member in self.filter_users(members, filter_string):
-                user = self.convert_user(member, extended_attributes)
+                if name not in self.cached_group_names:
+                    self.logger.warning("Unable to get_group_users")
+                    raise AssertionException("Okta error querying for group users: %s" % e)
+                # the id was cached in an earlier run, and the group may have been replaced since
+                self.logger.debug('Cached id of group %s is stale: %s', name, e)
+                res_group = self.find_group(group)
+                self.refreshed_group_ids.append((name, res_group.id if res_group else None))
+                if not res_group:
+                    return
+                try:
+                    members = self.groups_client.get_group_all_users(res_group.id, attr_dict)
+                except OktaError as e:
+                    self.logger.warning("Unable to get_group_users")
+                    raise AssertionException("Okta error querying for group users: %s" % e)
+            # Filtering users based all_users_filter query in config.  A user in several groups is only
+            # filtered and converted once per run.
+            is_selected = self.get_user_selector(filter_string)
+            converted_user_by_id = self.converted_user_by_id
+            member_count = 0
+            for member in members:
+                member_count += 1
+                if member.id in converted_user_by_id:
+                    user = converted_user_by_id[member.id]
+                else:
+                    user = self.convert_user(member, extended_attributes) if is_selected(member) else None
+                    converted_user_by_id[member.id] = user
                 if not user:
                     continue
                 yield (user)
+            with self.member_count_lock:
+                self.group_member_count += member_count
         else:
             self.logger.warning("No group found for: %s", group)
 
@@ -263,7 +412,7 @@ class OktaDirectoryConnector(DirectoryConnector):
                 extended_attribute_value = OKTAValueFormatter.get_profile_value(record, extended_attribute)
                 source_attributes[extended_attribute] = extended_attribute_value
 
-        user['source_attributes'] = source_attributes.copy()
+        user['source_attributes'] = source_attributes
         return user
 
     def iter_search_result(self, filter_string, attributes):
@@ -285,20 +434,48 @@ class OktaDirectoryConnector(DirectoryConnector):
             raise AssertionException("Okta error querying for users: %s" % e)
         return users
 
-    def filter_users(self, users, filter_string):
-        # Allow the following builtin functions to be used in eval()
-        whitelist = {
-            "len": len, "int": int, "float": float, "str": str, "enumerate": enumerate, "filter": filter,
-            "getattr": getattr, "hasattr": hasattr, "list": list, "map": map, "max": max, "min": min,
-            "range": range, "sorted": sorted, "sum": sum, "tuple": tuple, "zip": zip
-        }
-
+    @staticmethod
+    def compile_users_filter(filter_string):
+        """
+        Compile a user predicate once, so it isn't parsed again for each user.
+        :type filter_string: str
+        :rtype code
+        """
         try:
-            return list(filter(lambda user: eval(filter_string, {"__builtins__": whitelist}, {"user": user}), users))
+            return compile(filter_string, '<all_users_filter>', 'eval')
         except SyntaxError as e:
             raise AssertionException("Invalid syntax in predicate (%s): cannot evaluate" % filter_string)
-        except Exception as e:
-            raise AssertionException("Error filtering with predicate (%s): %s" % (filter_string, e))
+
+    def filter_users(self, users, filter_string):
+        """
+        Select the users for which the predicate is true, as they are read.
+        :type users: iterable(okta.models.user.User)
+        :type filter_string: str
+        :rtype iterable(okta.models.user.User)
+        """
+        is_selected = self.get_user_selector(filter_string)
+        for user in users:
+            if is_selected(user):
+                yield user
+
+    def get_user_selector(self, filter_string):
+        """
+        :type filter_string: str
+        :rtype callable: a function that tells whether the predicate is true for a user
+        """
+        if filter_string == self.options['all_users_filter']:
+            users_filter = self.users_filter
+        else:
+            users_filter = self.compile_users_filter(filter_string)
+        filter_globals = {"__builtins__": FILTER_BUILTINS}
+
+        def is_selected(user):
+            try:
+                return eval(users_filter, filter_globals, {"user": user})
+            except Exception as e:
+                raise AssertionException("Error filtering with predicate (%s): %s" % (filter_string, e))
+
+        return is_selected
 
 
 class OKTAValueFormatter(object):
@@ -367,3 +544,68 @@ class OKTAValueFormatter(object):
                 except UnicodeError as e:
                     raise AssertionException("Encoding error in value of attribute '%s': %s" % (attribute_name, e))
         return None
+
+
+class OktaRateLimit(object):
+    """
+    Keeps track of the rate limit that Okta reports in the X-Rate-Limit-Remaining and X-Rate-Limit-Reset
+    headers of its responses, shared by all the threads making requests.  Once the requests left in the
+    current window are down to the reserve, requests wait for the window to reset.
+    """
+
+    def __init__(self, reserve):
+        """
+        :type reserve: int
+        """
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset_time = None
+
+    def wait(self):
+        """
+        Wait, if need be, before making a request.
+        """
+        with self.lock:
+            delay = 0
+            if self.remaining is not None:
+                if self.remaining <= self.reserve and self.reset_time is not None:
+                    delay = self.reset_time - time.time()
+                # count the request now, so requests made before their responses arrive are counted too
+                self.remaining -= 1
+        if delay > 0:
+            time.sleep(delay)
+            with self.lock:
+                if self.reset_time is not None and self.reset_time <= time.time():
+                    self.remaining = None
+
+    def update(self, headers):
+        """
+        :type headers: dict (the headers of a response)
+        """
+        try:
+            remaining = int(headers['X-Rate-Limit-Remaining'])
+            reset_time = int(headers['X-Rate-Limit-Reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            if self.reset_time is None or reset_time > self.reset_time:
+                self.remaining, self.reset_time = remaining, reset_time
+            elif reset_time == self.reset_time:
+                self.remaining = min(remaining, self.remaining if self.remaining is not None else remaining)
+
+
+class RateLimitedUserGroupsClient(okta.UserGroupsClient):
+    """
+    A groups client that keeps its requests within the rate limit, so several threads can use it at once.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.rate_limit = kwargs.pop('rate_limit')
+        super(RateLimitedUserGroupsClient, self).__init__(*args, **kwargs)
+
+    def get(self, url, params=None, attempts=0):
+        self.rate_limit.wait()
+        response = super(RateLimitedUserGroupsClient, self).get(url, params, attempts)
+        self.rate_limit.update(response.headers)
+        return response
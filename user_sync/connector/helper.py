@@ -19,6 +19,8 @@
 # SOFTWARE.
 
 import logging
+import sys
+from collections.abc import MutableMapping
 
 
 def create_logger(options):
@@ -29,21 +31,117 @@ def create_logger(options):
     if logger_name is None:
         logger_name = 'connector'
     return logging.getLogger(logger_name)
-     
+
+
+class DirectoryUser(MutableMapping):
+    """
+    Compact record for a user read from a directory.  The standard fields are kept in slots rather than
+    in a per-user dict, and low-cardinality values (identity type, domain, country, group names) are
+    interned so that users share a single copy of each string.  Any other key is kept in a small
+    overflow dict that is only allocated when needed.  The record behaves like the dict returned by
+    earlier versions of create_blank_user, so connectors, engines and hooks can use it unchanged.
+    """
+    FIELDS = ('identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country',
+              'member_groups', 'uid', 'source_attributes')
+    FIELD_SET = frozenset(FIELDS)
+    INTERNED_FIELDS = frozenset(['identity_type', 'domain', 'country'])
+
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self.FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.FIELD_SET:
+            if key in self.INTERNED_FIELDS:
+                value = intern_string(value)
+            elif key == 'groups':
+                intern_group_names(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self.FIELD_SET:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        """
+        :rtype DirectoryUser
+        """
+        return DirectoryUser(self.items())
+
+    def __reduce__(self):
+        # set up again through __setitem__, so the values are interned in the process that unpickles the user
+        return DirectoryUser, (dict(self.items()),)
+
+
+def intern_string(value):
+    """
+    Intern a string value so that all users holding it share one copy.  Other values are returned unchanged.
+    """
+    return sys.intern(value) if type(value) is str else value
+
+
+def intern_group_names(groups):
+    """
+    Intern the group names of a list in place.
+    :type groups: list
+    """
+    if type(groups) is list:
+        groups[:] = [intern_string(group) for group in groups]
+    return groups
+
 
 def create_blank_user():
     """
-    :rtype dict
-    """
-    user = {
-        "identity_type": None,
-        "username": None,
-        "domain": None,
-        "firstname": None,
-        "lastname": None,
-        "email": None,
-        "groups": [],
-        "country": None,
-    }
+    :rtype DirectoryUser
+    """
+    user = DirectoryUser()
+    user.identity_type = None
+    user.username = None
+    user.domain = None
+    user.firstname = None
+    user.lastname = None
+    user.email = None
+    user.groups = []
+    user.country = None
     return user
-
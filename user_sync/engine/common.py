@@ -1,3 +1,7 @@
+from collections.abc import MutableSet
+
+from user_sync.helper import normalize_string
+
 GROUP_NAME_DELIMITER = '::'
 PRIMARY_TARGET_NAME = None
 
@@ -73,3 +77,138 @@ class AdobeGroup:
     @classmethod
     def iter_groups(cls):
         return cls.index_map.values()
+
+
+class GroupRegistry:
+    """
+    Gives each normalized group name a bit, the first time the name is seen in a run, so that sets
+    of groups can be held as integer bitsets (see GroupSet) and compared with integer operations.
+    """
+
+    def __init__(self):
+        self.bit_by_name = {}
+        # group names as they come from the umapi or the directory, to skip normalizing them again
+        self.bit_by_raw_name = {}
+        self.names = []
+
+    def get_bit(self, normalized_group_name):
+        """
+        :type normalized_group_name: str
+        :rtype int
+        """
+        bit = self.bit_by_name.get(normalized_group_name)
+        if bit is None:
+            bit = self.bit_by_name[normalized_group_name] = 1 << len(self.names)
+            self.names.append(normalized_group_name)
+        return bit
+
+    def get_mask(self, group_names):
+        """
+        :type group_names: iterable(str) (not normalized)
+        :rtype int
+        """
+        mask = 0
+        if group_names is not None:
+            bit_by_raw_name = self.bit_by_raw_name
+            for group_name in group_names:
+                bit = bit_by_raw_name.get(group_name)
+                if bit is None:
+                    bit = bit_by_raw_name[group_name] = self.get_bit(normalize_string(group_name))
+                mask |= bit
+        return mask
+
+    def iter_names(self, mask):
+        """
+        :type mask: int
+        :rtype iterator(str)
+        """
+        names = self.names
+        while mask:
+            low_bit = mask & -mask
+            yield names[low_bit.bit_length() - 1]
+            mask ^= low_bit
+
+
+class GroupSet(MutableSet):
+    """
+    A set of normalized group names, held as a bitset over a GroupRegistry.  Operations between
+    sets of the same registry are integer operations; anything else falls back to the generic set methods.
+    """
+    __slots__ = ('registry', 'mask')
+
+    def __init__(self, registry, mask=0):
+        """
+        :type registry: GroupRegistry
+        :type mask: int
+        """
+        self.registry = registry
+        self.mask = mask
+
+    def _from_iterable(self, normalized_group_names):
+        result = GroupSet(self.registry)
+        for group_name in normalized_group_names:
+            result.add(group_name)
+        return result
+
+    def _get_mask(self, other):
+        if isinstance(other, GroupSet) and other.registry is self.registry:
+            return other.mask
+        return None
+
+    def __contains__(self, normalized_group_name):
+        bit = self.registry.bit_by_name.get(normalized_group_name)
+        return bit is not None and self.mask & bit != 0
+
+    def __iter__(self):
+        return self.registry.iter_names(self.mask)
+
+    def __len__(self):
+        return bin(self.mask).count('1')
+
+    def __bool__(self):
+        return self.mask != 0
+
+    def __eq__(self, other):
+        mask = self._get_mask(other)
+        if mask is None:
+            return MutableSet.__eq__(self, other)
+        return self.mask == mask
+
+    def __and__(self, other):
+        mask = self._get_mask(other)
+        if mask is None:
+            return MutableSet.__and__(self, other)
+        return GroupSet(self.registry, self.mask & mask)
+
+    __rand__ = __and__
+
+    def __or__(self, other):
+        mask = self._get_mask(other)
+        if mask is None:
+            return MutableSet.__or__(self, other)
+        return GroupSet(self.registry, self.mask | mask)
+
+    __ror__ = __or__
+
+    def __sub__(self, other):
+        mask = self._get_mask(other)
+        if mask is None:
+            return MutableSet.__sub__(self, other)
+        return GroupSet(self.registry, self.mask & ~mask)
+
+    def __repr__(self):
+        return repr(set(self))
+
+    def add(self, normalized_group_name):
+        self.mask |= self.registry.get_bit(normalized_group_name)
+
+    def discard(self, normalized_group_name):
+        bit = self.registry.bit_by_name.get(normalized_group_name)
+        if bit is not None:
+            self.mask &= ~bit
+
+    def copy(self):
+        """
+        :rtype GroupSet
+        """
+        return GroupSet(self.registry, self.mask)
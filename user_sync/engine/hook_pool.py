@@ -0,0 +1,232 @@
+import builtins
+import dis
+import logging
+import marshal
+import time
+import traceback
+import types
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+# the hook state of a worker process, set up once by init_worker
+worker_state = {}
+
+# the names an exec-style hook is given for each user
+HOOK_SCOPE_NAMES = frozenset(['source_attributes', 'source_groups', 'target_attributes', 'target_groups', 'logger',
+                              'hook_storage'])
+
+
+def find_shared_state(hook_code, is_function):
+    """
+    Find the ways a hook keeps state from one user to the next.  A hook run in worker processes would
+    only keep it across the users of each worker, so such hooks can't be run there.
+    :type hook_code: code
+    :type is_function: bool
+    :rtype list(str): a description of each kind of state found
+    """
+    found = []
+    codes = [hook_code]
+    while codes:
+        code = codes.pop()
+        if 'hook_storage' in code.co_names and 'hook_storage' not in found:
+            found.append('hook_storage')
+        for instruction in dis.get_instructions(code):
+            if instruction.opname in ('STORE_GLOBAL', 'DELETE_GLOBAL'):
+                description = "global variable '%s'" % instruction.argval
+                if description not in found:
+                    found.append(description)
+        codes.extend(const for const in code.co_consts if isinstance(const, types.CodeType))
+    if not is_function:
+        # an exec-style hook runs in the same scope for every user, so a name it reads before setting it
+        # can be left from the user before
+        stored_names = set()
+        for instruction in dis.get_instructions(hook_code):
+            name = instruction.argval
+            if instruction.opname == 'STORE_NAME':
+                stored_names.add(name)
+            elif (instruction.opname == 'LOAD_NAME' and name not in stored_names and name not in HOOK_SCOPE_NAMES
+                  and not hasattr(builtins, name)):
+                found.append("variable '%s' from the user before" % name)
+                stored_names.add(name)
+    return found
+
+
+class HookLogger:
+    """
+    The logger of a hook run in a worker process, where logging isn't set up.  It keeps the messages of
+    each user, formatted, for the main process to log them in user order.
+    """
+
+    def __init__(self, level):
+        self.level = level
+        self.records = []
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def getEffectiveLevel(self):
+        return self.level
+
+    def log(self, level, message, *args, exc_info=False, **kwargs):
+        if level < self.level:
+            return
+        # format the message here, as logging would, since its arguments may not survive pickling
+        if len(args) == 1 and isinstance(args[0], Mapping) and args[0]:
+            args = args[0]
+        text = str(message) % args if args else str(message)
+        if exc_info:
+            text += '\n' + traceback.format_exc().rstrip()
+        self.records.append((level, text))
+
+    def debug(self, message, *args, **kwargs):
+        self.log(logging.DEBUG, message, *args, **kwargs)
+
+    def info(self, message, *args, **kwargs):
+        self.log(logging.INFO, message, *args, **kwargs)
+
+    def warning(self, message, *args, **kwargs):
+        self.log(logging.WARNING, message, *args, **kwargs)
+
+    def error(self, message, *args, **kwargs):
+        self.log(logging.ERROR, message, *args, **kwargs)
+
+    def exception(self, message, *args, exc_info=True, **kwargs):
+        self.log(logging.ERROR, message, *args, exc_info=exc_info, **kwargs)
+
+    def critical(self, message, *args, **kwargs):
+        self.log(logging.CRITICAL, message, *args, **kwargs)
+
+
+def init_worker(hook_code, is_function, target_attribute_names, log_level):
+    """
+    Set up the hook scope of a worker process.  The scope is the same as the one the hook has in the
+    main process, except that hook_storage persists only across the users run in this worker, and
+    the messages the hook logs are handed back with its results.
+    :type hook_code: bytes (a marshalled code object)
+    :type is_function: bool
+    :type target_attribute_names: tuple(str)
+    :type log_level: int (the level of the processor logger in the main process)
+    """
+    code = marshal.loads(hook_code)
+    logger = HookLogger(log_level)
+    scope = {
+        'source_attributes': None,
+        'source_groups': None,
+        'target_attributes': None,
+        'target_groups': None,
+        'logger': logger,
+        'hook_storage': None,
+    }
+    function = None
+    if is_function:
+        exec(code, scope)
+        function = scope['after_mapping']
+    worker_state.update(code=code, scope=scope, function=function, target_attribute_names=target_attribute_names,
+                        logger=logger)
+
+
+def run_chunk(chunk):
+    """
+    Run the hook on a chunk of users, as read_desired_user_groups_from runs it in the main process.
+    :type chunk: list(tuple(dict, set))
+    :return: each user as the hook leaves it, with its target groups and the messages the hook logged for it,
+    in order, and the time spent in the hook
+    :rtype: (list(tuple(dict, set, list(tuple(int, str)))), float)
+    """
+    code, scope, function = worker_state['code'], worker_state['scope'], worker_state['function']
+    target_attribute_names = worker_state['target_attribute_names']
+    logger = worker_state['logger']
+    results = []
+    start_time = time.perf_counter()
+    for directory_user, target_groups in chunk:
+        logger.records = []
+        if function is not None:
+            function(directory_user, target_groups)
+        else:
+            scope['source_attributes'] = dict(directory_user['source_attributes'])
+            scope['source_groups'] = set(directory_user['groups'])
+            scope['target_attributes'] = {key: directory_user.get(key) for key in target_attribute_names}
+            scope['target_groups'] = target_groups
+            exec(code, scope)
+            directory_user.update(scope['target_attributes'])
+            target_groups = scope['target_groups']
+        results.append((directory_user, target_groups, logger.records))
+    return results, time.perf_counter() - start_time
+
+
+class AfterMappingHookPool:
+    """
+    Runs the after-mapping hook on chunks of users in a pool of worker processes.  Users are handed back
+    with the hook's results in the order they were added, so merging them is deterministic.  The hook
+    must not keep state from one user to the next (see find_shared_state).
+    """
+
+    def __init__(self, hook_code, is_function, processes, chunk_size, target_attribute_names, log_level):
+        """
+        :type hook_code: code
+        :type is_function: bool
+        :type processes: int
+        :type chunk_size: int
+        :type target_attribute_names: tuple(str)
+        :type log_level: int
+        """
+        self.chunk_size = chunk_size
+        # keep every worker busy, with a chunk waiting for each
+        self.max_in_flight = processes * 2
+        self.executor = ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                                            initargs=(marshal.dumps(hook_code), is_function, target_attribute_names,
+                                                      log_level))
+        self.chunk = []
+        self.keys = []
+        self.in_flight = deque()
+        self.hook_seconds = 0.0
+        self.hook_count = 0
+
+    def add(self, user_key, directory_user, target_groups):
+        """
+        Queue a user for the hook, and return the users whose chunks are done.
+        :type user_key: str
+        :type directory_user: dict
+        :type target_groups: set(str)
+        :rtype list(tuple(str, dict, dict, set, list)): user key, user, user as the hook left it, target groups,
+        and the messages the hook logged
+        """
+        self.chunk.append((directory_user, target_groups))
+        self.keys.append(user_key)
+        if len(self.chunk) < self.chunk_size:
+            return []
+        self.submit_chunk()
+        done = []
+        while len(self.in_flight) >= self.max_in_flight:
+            done.extend(self.finish_chunk())
+        return done
+
+    def drain(self):
+        """
+        Run the hook on the remaining users, and return all the users not returned yet.
+        :rtype list(tuple(str, dict, dict, set, list))
+        """
+        if self.chunk:
+            self.submit_chunk()
+        done = []
+        while self.in_flight:
+            done.extend(self.finish_chunk())
+        return done
+
+    def submit_chunk(self):
+        future = self.executor.submit(run_chunk, self.chunk)
+        self.in_flight.append((future, self.keys, self.chunk))
+        self.chunk = []
+        self.keys = []
+
+    def finish_chunk(self):
+        future, keys, chunk = self.in_flight.popleft()
+        results, seconds = future.result()
+        self.hook_seconds += seconds
+        self.hook_count += len(results)
+        return [(user_key, directory_user, hooked_user, target_groups, records)
+                for user_key, (directory_user, _), (hooked_user, target_groups, records) in zip(keys, chunk, results)]
+
+    def shutdown(self):
+        self.executor.shutdown()
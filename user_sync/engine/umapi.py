@@ -19,10 +19,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib
+import json
 import logging
 import six
+import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from collections import defaultdict
+from pathlib import Path
 
 import user_sync.connector.connector_umapi
 import user_sync.error
@@ -30,18 +35,28 @@ import user_sync.identity_type
 from user_sync.connector.connector_umapi import UmapiConnector
 from user_sync.helper import normalize_string, CSVAdapter, JobStats
 from user_sync.config.common import check_max_limit
+from user_sync.cache.umapi import UmapiCache
 
-from .common import AdobeGroup, PRIMARY_TARGET_NAME
+from .common import AdobeGroup, GroupRegistry, GroupSet, PRIMARY_TARGET_NAME
+from .hook_pool import AfterMappingHookPool
 
 
 class RuleProcessor(object):
+    # the user attributes that an after_mapping_hook can change, through target_attributes
+    hook_target_attribute_names = ('email', 'username', 'domain', 'firstname', 'lastname', 'country')
+
     # rule processing option defaults
     # these are in alphabetical order!  Always add new ones that way!
     default_options = {
         'adobe_group_filter': None,
         'after_mapping_hook': None,
+        'after_mapping_hook_chunk_size': 1000,
+        'after_mapping_hook_is_function': False,
+        'after_mapping_hook_processes': 1,
+        'cache_path': 'cache/umapi',
         'default_country_code': None,
         'delete_strays': False,
+        'delta_sync': False,
         'directory_group_filter': None,
         'disentitle_strays': False,
         'exclude_groups': [],
@@ -54,9 +69,13 @@ class RuleProcessor(object):
         'max_adobe_only_users': 200,
         'new_account_type': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
         'remove_strays': False,
+        'request_concurrency': 1,
+        'skip_unchanged_users': False,
         'strategy': 'sync',
         'stray_list_input_path': None,
         'stray_list_output_path': None,
+        'streaming': False,
+        'streaming_chunk_size': 1000,
         'test_mode': False,
         'update_user_info': False,
         'username_filter_regex': None,
@@ -71,12 +90,21 @@ class RuleProcessor(object):
         self.options = options
         self.directory_user_by_user_key = {}
         self.filtered_directory_user_by_user_key = {}
+        # when streaming, primary users to create are kept as (user_key, groups) until their commands are sent
+        self.pending_primary_creates = []
         self.umapi_info_by_name = {}
+        self.umapi_cache_by_name = {}
+        self.user_key_by_commands = {}
+        # the directory user hashes of each snapshot, as (hash, confirmed) by user key, saved at the end of the run
+        self.user_hashes_by_cache = {}
         self.adobeid_user_by_email = {}
+        # the adobe groups that each member group maps to, by additional_groups rules
+        self.additional_groups_by_member_group = {}
         # counters for action summary log
         self.action_summary = {
             # these are in alphabetical order!  Always add new ones that way!
             'adobe_user_groups_created': 0,
+            'after_mapping_hook_time': 0,
             'directory_users_read': 0,
             'directory_users_selected': 0,
             'excluded_user_count': 0,
@@ -134,6 +162,15 @@ class RuleProcessor(object):
             self.will_manage_strays = False
             self.will_process_strays = False
 
+        # the user snapshot only makes sense when we read every user in each org
+        if options['delta_sync'] and (self.push_umapi or options['adobe_group_filter'] is not None):
+            logger.warning("'delta_sync' is ignored when pushing or when reading only mapped Adobe groups")
+            options['delta_sync'] = False
+        # unchanged users can only be skipped if the snapshot vouches for their Adobe side
+        if options['skip_unchanged_users'] and not options['delta_sync']:
+            logger.warning("'skip_unchanged_users' is ignored without 'delta_sync'")
+            options['skip_unchanged_users'] = False
+
         # in/out variables for per-user after-mapping-hook code
         self.after_mapping_hook_scope = {
             # in: attributes retrieved from customer directory system (eg 'c', 'givenName')
@@ -153,6 +190,15 @@ class RuleProcessor(object):
             # for exclusive use by hook code; persists across calls
             'hook_storage': None,
         }
+        # a function-style hook is run once to define after_mapping(user, groups), which is then called per user
+        self.after_mapping_function = None
+        if options['after_mapping_hook'] is not None and options['after_mapping_hook_is_function']:
+            exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
+            self.after_mapping_function = self.after_mapping_hook_scope.get('after_mapping')
+            if not callable(self.after_mapping_function):
+                raise user_sync.error.AssertionException("after_mapping in after_mapping_hook is not a function")
+        self.after_mapping_hook_count = 0
+        self.after_mapping_hook_seconds = 0.0
 
         # map of username to email address for users that have an email-type username that
         # differs from the user's email address
@@ -200,9 +246,18 @@ class RuleProcessor(object):
                                                                             secondary_command_lists, umapi_connectors)
         # execute secondary commands first so we can safely handle user deletions (if applicable)
         for umapi_name, command_list in secondary_command_lists.items():
-            self.execute_commands(command_list, umapi_connectors.get_secondary_connectors()[umapi_name])
-        self.execute_commands(primary_commands, umapi_connectors.get_primary_connector())
+            self.execute_commands(command_list, umapi_connectors.get_secondary_connectors()[umapi_name],
+                                  self.get_umapi_cache_for_results(umapi_name))
+        primary_connector = umapi_connectors.get_primary_connector()
+        if self.pending_primary_creates:
+            self.execute_commands(chain(primary_commands, self.iter_primary_create_commands(primary_connector)),
+                                  primary_connector, self.get_umapi_cache_for_results(PRIMARY_TARGET_NAME),
+                                  len(primary_commands) + len(self.pending_primary_creates))
+        else:
+            self.execute_commands(primary_commands, primary_connector,
+                                  self.get_umapi_cache_for_results(PRIMARY_TARGET_NAME))
         umapi_connectors.execute_actions()
+        self.save_user_hashes()
         umapi_stats.log_end(logger)
         self.log_action_summary(umapi_connectors)
 
@@ -249,6 +304,10 @@ class RuleProcessor(object):
         # find out the number of users created in the primary and secondary umapis
         self.action_summary['primary_users_created'] = len(self.primary_users_created)
         self.action_summary['secondary_users_created'] = len(self.secondary_users_created)
+        # the hook's cost per user, in milliseconds
+        if self.after_mapping_hook_count:
+            self.action_summary['after_mapping_hook_time'] = '%.3f ms' % (
+                    self.after_mapping_hook_seconds * 1000 / self.after_mapping_hook_count)
 
         # English text description for action summary log.
         # The action summary will be shown the same order as they are defined in this list
@@ -287,6 +346,8 @@ class RuleProcessor(object):
             else:
                 action = 'with groups processed'
             action_summary_description.append(['primary_strays_processed', 'Number of Adobe-only users ' + action])
+        if self.after_mapping_hook_count:
+            action_summary_description.append(['after_mapping_hook_time', 'Average after-mapping hook time per user'])
 
         # prepare the network summary
         umapi_summary_format = 'Number of%s%s UMAPI actions sent (total, success, error)'
@@ -364,21 +425,64 @@ class RuleProcessor(object):
             directory_group_filter = set(directory_group_filter)
         extended_attributes = options.get('extended_attributes')
 
-        directory_user_by_user_key = self.directory_user_by_user_key
-
         directory_groups = set(mappings.keys()) if self.will_process_groups() else set()
         if directory_group_filter is not None:
             directory_groups.update(directory_group_filter)
-        directory_users = directory_connector.load_users_and_groups(groups=directory_groups,
-                                                                    extended_attributes=extended_attributes,
-                                                                    all_users=directory_group_filter is None)
+        # when streaming, users are read one at a time, and only a compact record of each is kept
+        streaming = options['streaming']
+        if streaming:
+            load_users_and_groups = directory_connector.iter_users_and_groups
+        else:
+            load_users_and_groups = directory_connector.load_users_and_groups
+        directory_users = load_users_and_groups(groups=directory_groups,
+                                                extended_attributes=extended_attributes,
+                                                all_users=directory_group_filter is None)
+
+        # a CPU-heavy hook can be run in worker processes, on chunks of users
+        hook_pool = None
+        if options['after_mapping_hook'] is not None and options['after_mapping_hook_processes'] > 1:
+            self.logger.debug('Running after-mapping hook in %d processes', options['after_mapping_hook_processes'])
+            hook_pool = AfterMappingHookPool(options['after_mapping_hook'], options['after_mapping_hook_is_function'],
+                                             options['after_mapping_hook_processes'],
+                                             options['after_mapping_hook_chunk_size'],
+                                             self.hook_target_attribute_names, self.logger.getEffectiveLevel())
+        try:
+            self.read_desired_user_groups_from(directory_users, mappings, hook_pool)
+            if hook_pool is not None:
+                for hook_result in hook_pool.drain():
+                    self.apply_after_mapping_hook_result(*hook_result)
+        finally:
+            if hook_pool is not None:
+                hook_pool.shutdown()
+                self.after_mapping_hook_seconds += hook_pool.hook_seconds
+                self.after_mapping_hook_count += hook_pool.hook_count
+
+        self.logger.debug('Total directory users after filtering: %d', len(self.filtered_directory_user_by_user_key))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Group work list: %s', dict([(umapi_name, umapi_info.get_desired_groups_by_user_key())
+                                                           for umapi_name, umapi_info
+                                                           in self.umapi_info_by_name.items()]))
 
+    def read_desired_user_groups_from(self, directory_users, mappings, hook_pool=None):
+        """
+        :type directory_users: iterable(dict)
+        :type mappings: dict(str, list(AdobeGroup))
+        :type hook_pool: AfterMappingHookPool (if given, the hook is run in its worker processes)
+        """
+        options = self.options
+        directory_group_filter = options['directory_group_filter']
+        if directory_group_filter is not None:
+            directory_group_filter = set(directory_group_filter)
+        directory_user_by_user_key = self.directory_user_by_user_key
+        streaming = options['streaming']
+        log_hook_scope = self.logger.isEnabledFor(logging.DEBUG)
         for directory_user in directory_users:
             user_key = self.get_directory_user_key(directory_user)
             if not user_key:
                 self.logger.warning("Ignoring directory user with empty user key: %s", directory_user)
                 continue
-            directory_user_by_user_key[user_key] = directory_user
+            directory_user_by_user_key[user_key] = (self.get_compact_directory_user(directory_user) if streaming
+                                                    else directory_user)
 
             if not self.is_directory_user_in_groups(directory_user, directory_group_filter):
                 continue
@@ -389,67 +493,124 @@ class RuleProcessor(object):
             self.get_umapi_info(PRIMARY_TARGET_NAME).add_desired_group_for(user_key, None)
 
             # set up groups in hook scope; the target groups will be used whether or not there's customer hook code
-            self.after_mapping_hook_scope['source_groups'] = set()
-            self.after_mapping_hook_scope['target_groups'] = set()
-            for group in directory_user['groups']:
-                self.after_mapping_hook_scope['source_groups'].add(group)  # this is a directory group name
+            self.after_mapping_hook_scope['source_groups'] = source_groups = set(directory_user['groups'])
+            self.after_mapping_hook_scope['target_groups'] = target_groups = set()
+            for group in source_groups:
                 adobe_groups = mappings.get(group)
                 if adobe_groups is not None:
                     for adobe_group in adobe_groups:
-                        self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
+                        target_groups.add(adobe_group.get_qualified_name())
 
             # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
-            if options['after_mapping_hook'] is not None:
-                self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
-
-                target_attributes = dict()
-                target_attributes['email'] = directory_user.get('email')
-                target_attributes['username'] = directory_user.get('username')
-                target_attributes['domain'] = directory_user.get('domain')
-                target_attributes['firstname'] = directory_user.get('firstname')
-                target_attributes['lastname'] = directory_user.get('lastname')
-                target_attributes['country'] = directory_user.get('country')
-                self.after_mapping_hook_scope['target_attributes'] = target_attributes
+            if hook_pool is not None:
+                # the users come back, with the hook's results, in the order they were added
+                for hook_result in hook_pool.add(user_key, directory_user, target_groups):
+                    self.apply_after_mapping_hook_result(*hook_result)
+                continue
+            elif self.after_mapping_function is not None:
+                # a function-style hook changes the user and the target groups in place
+                start_time = time.perf_counter()
+                self.after_mapping_function(directory_user, target_groups)
+                self.after_mapping_hook_seconds += time.perf_counter() - start_time
+                self.after_mapping_hook_count += 1
+            elif options['after_mapping_hook'] is not None:
+                # the hook gets its own copy, so what it writes there doesn't change the directory user
+                self.after_mapping_hook_scope['source_attributes'] = dict(directory_user['source_attributes'])
+                self.after_mapping_hook_scope['target_attributes'] = {
+                    key: directory_user.get(key) for key in self.hook_target_attribute_names}
 
                 # invoke the customer's hook code
-                self.log_after_mapping_hook_scope(before_call=True)
+                if log_hook_scope:
+                    self.log_after_mapping_hook_scope(before_call=True)
+                start_time = time.perf_counter()
                 exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
-                self.log_after_mapping_hook_scope(after_call=True)
+                self.after_mapping_hook_seconds += time.perf_counter() - start_time
+                self.after_mapping_hook_count += 1
+                if log_hook_scope:
+                    self.log_after_mapping_hook_scope(after_call=True)
 
                 # copy modified attributes back to the user object
                 directory_user.update(self.after_mapping_hook_scope['target_attributes'])
 
-            for target_group_qualified_name in self.after_mapping_hook_scope['target_groups']:
-                target_group = AdobeGroup.lookup(target_group_qualified_name)
-                if target_group is not None:
-                    umapi_info = self.get_umapi_info(target_group.get_umapi_name())
-                    umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
-                else:
-                    self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
-
-            additional_groups = self.options.get('additional_groups', [])
-            member_groups = directory_user.get('member_groups', [])
-            for member_group in member_groups:
-                for group_rule in additional_groups:
-                    source = group_rule['source']
-                    target = group_rule['target']
-                    target_name = target.get_group_name()
-                    umapi_info = self.get_umapi_info(target.get_umapi_name())
-                    if not group_rule['source'].match(member_group):
-                        continue
-                    try:
-                        rename_group = source.sub(target_name, member_group)
-                    except Exception as e:
-                        raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
-                    umapi_info.add_mapped_group(rename_group)
-                    umapi_info.add_additional_group(rename_group, member_group)
-                    umapi_info.add_desired_group_for(user_key, rename_group)
+            self.add_target_groups(user_key, directory_user, self.after_mapping_hook_scope['target_groups'])
 
-        self.logger.debug('Total directory users after filtering: %d', len(self.filtered_directory_user_by_user_key))
-        if self.logger.isEnabledFor(logging.DEBUG):
-            self.logger.debug('Group work list: %s', dict([(umapi_name, umapi_info.get_desired_groups_by_user_key())
-                                                           for umapi_name, umapi_info
-                                                           in self.umapi_info_by_name.items()]))
+    def apply_after_mapping_hook_result(self, user_key, directory_user, hooked_user, target_groups, records=()):
+        """
+        Merge the result of a hook run in a worker process back into the user: every change the hook made
+        to the user's copy there is made to the user, and the messages the hook logged there are logged
+        :type user_key: str
+        :type directory_user: dict
+        :type hooked_user: dict
+        :type target_groups: set(str)
+        :type records: list(tuple(int, str)) (level and text of each message)
+        """
+        for level, text in records:
+            self.logger.log(level, '%s', text)
+        for key in [key for key in directory_user if key not in hooked_user]:
+            del directory_user[key]
+        directory_user.update(hooked_user)
+        self.add_target_groups(user_key, directory_user, target_groups)
+
+    def add_target_groups(self, user_key, directory_user, target_groups):
+        """
+        Record the adobe groups that a selected directory user should be in, once the hook (if any) has run
+        :type user_key: str
+        :type directory_user: dict
+        :type target_groups: set(str) (qualified adobe group names)
+        """
+        for target_group_qualified_name in target_groups:
+            target_group = AdobeGroup.lookup(target_group_qualified_name)
+            if target_group is not None:
+                umapi_info = self.get_umapi_info(target_group.get_umapi_name())
+                umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
+            else:
+                self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
+
+        for member_group in directory_user.get('member_groups', []):
+            additional_groups = self.additional_groups_by_member_group.get(member_group)
+            if additional_groups is None:
+                additional_groups = self.resolve_additional_groups(member_group)
+            for umapi_info, rename_group in additional_groups:
+                umapi_info.add_desired_group_for(user_key, rename_group)
+
+        if self.options['streaming']:
+            # the hook may have changed the user's attributes, so the record is made again
+            compact_user = self.get_compact_directory_user(directory_user)
+            self.directory_user_by_user_key[user_key] = self.filtered_directory_user_by_user_key[user_key] = compact_user
+
+    def resolve_additional_groups(self, member_group):
+        """
+        Match a member group against the additional_groups rules, and record the adobe groups it maps to.
+        This is done once per member group, however many users are in it.
+        :type member_group: str
+        :rtype list(tuple(UmapiTargetInfo, str)): the umapi and name of each adobe group
+        """
+        additional_groups = []
+        for group_rule in self.options.get('additional_groups', []):
+            source = group_rule['source']
+            target = group_rule['target']
+            umapi_info = self.get_umapi_info(target.get_umapi_name())
+            if not source.match(member_group):
+                continue
+            try:
+                rename_group = source.sub(target.get_group_name(), member_group)
+            except Exception as e:
+                raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
+            umapi_info.add_mapped_group(rename_group)
+            umapi_info.add_additional_group(rename_group, member_group)
+            additional_groups.append((umapi_info, rename_group))
+        self.additional_groups_by_member_group[member_group] = additional_groups
+        return additional_groups
+
+    @staticmethod
+    def get_compact_directory_user(directory_user):
+        """
+        Keep only the attributes of a directory user that are used once the directory has been read
+        :type directory_user: dict
+        :rtype dict
+        """
+        return {key: directory_user.get(key) for key in ('identity_type', 'username', 'domain', 'email',
+                                                         'firstname', 'lastname', 'country')}
 
     def is_directory_user_in_groups(self, directory_user, groups):
         """
@@ -479,6 +640,10 @@ class RuleProcessor(object):
         else:
             verb = "Sync"
         exclude_unmapped_users = self.will_exclude_unmapped_users()
+        # if requested, fetch the users of all the orgs at once before we diff any of them
+        umapi_users_by_name = {}
+        if not self.push_umapi and self.options['request_concurrency'] > 1:
+            umapi_users_by_name = self.prefetch_umapi_users(umapi_connectors)
         # first sync the primary connector, so the users get created in the primary
         if umapi_connectors.get_secondary_connectors():
             self.logger.debug('Processing %s users for primary umapi...', verb)
@@ -488,7 +653,8 @@ class RuleProcessor(object):
         if self.push_umapi:
             primary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
         else:
-            primary_adds_by_user_key, update_commands = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+            primary_adds_by_user_key, update_commands = self.update_umapi_users_for_connector(
+                umapi_info, umapi_connector, umapi_users_by_name.get(PRIMARY_TARGET_NAME))
             primary_commands.extend(update_commands)
         # save groups for new users
 
@@ -502,6 +668,10 @@ class RuleProcessor(object):
                 continue
             # We always create every user in the primary umapi, because it's believed to own the directories.
             self.primary_users_created.add(user_key)
+            if self.options['streaming']:
+                # the commands are made in chunks as they are sent (see iter_primary_create_commands)
+                self.pending_primary_creates.append((user_key, groups_to_add))
+                continue
             primary_commands.append(self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector.trusted))
 
         # then sync the secondary connectors
@@ -513,7 +683,8 @@ class RuleProcessor(object):
             if self.push_umapi:
                 secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
             else:
-                secondary_adds_by_user_key, update_commands = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+                secondary_adds_by_user_key, update_commands = self.update_umapi_users_for_connector(
+                    umapi_info, umapi_connector, umapi_users_by_name.get(umapi_name))
                 secondary_command_lists[umapi_name].extend(update_commands)
             total_users = len(secondary_adds_by_user_key)
             for user_key, groups_to_add in secondary_adds_by_user_key.items():
@@ -526,38 +697,217 @@ class RuleProcessor(object):
                     secondary_command_lists[umapi_name].append(self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector.trusted))
         return primary_commands, secondary_command_lists
 
-    def execute_commands(self, command_list, connector):
-        # do nothing if we have no commands for this connector
-        if not command_list:
+    def prefetch_umapi_users(self, umapi_connectors):
+        """
+        Read the users of the primary and of every secondary umapi that has mapped groups, using
+        a pool of at most request_concurrency workers so that the orgs are paged through at the same time.
+        Only the fetch is concurrent: the caller still diffs the primary first, so that the secondaries
+        are only evaluated against the included user keys of the primary.
+        :type umapi_connectors: UmapiConnectors
+        :rtype dict(str, list(dict))
+        """
+        connector_by_name = {PRIMARY_TARGET_NAME: umapi_connectors.get_primary_connector()}
+        for umapi_name, umapi_connector in umapi_connectors.get_secondary_connectors().items():
+            if len(self.get_umapi_info(umapi_name).get_mapped_groups()) > 0:
+                connector_by_name[umapi_name] = umapi_connector
+        max_workers = min(self.options['request_concurrency'], len(connector_by_name))
+        self.logger.debug('Fetching users from %d umapi connectors with %d workers...',
+                          len(connector_by_name), max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for umapi_name, umapi_connector in connector_by_name.items():
+                umapi_users = self.get_umapi_users(self.get_umapi_info(umapi_name), umapi_connector)
+                futures[umapi_name] = executor.submit(list, umapi_users)
+            return {umapi_name: future.result() for umapi_name, future in futures.items()}
+
+    def get_umapi_users(self, umapi_info, umapi_connector):
+        """
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :rtype iterable(dict)
+        """
+        if self.options['adobe_group_filter'] is not None:
+            return self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
+        if self.options['delta_sync']:
+            umapi_cache = self.get_umapi_cache(umapi_info)
+            if not umapi_cache.should_refresh:
+                return self.get_umapi_users_from_cache(umapi_cache, umapi_connector)
+            self.logger.info('Reading all users to refresh the snapshot of %s',
+                             umapi_info.get_name() or 'primary org')
+        return umapi_connector.iter_users()
+
+    def get_umapi_cache(self, umapi_info):
+        """
+        :type umapi_info: UmapiTargetInfo
+        :rtype UmapiCache
+        """
+        umapi_name = umapi_info.get_name()
+        umapi_cache = self.umapi_cache_by_name.get(umapi_name)
+        if umapi_cache is None:
+            org_name = 'primary' if umapi_name == PRIMARY_TARGET_NAME else umapi_name
+            umapi_cache = UmapiCache(Path(self.options['cache_path']), org_name)
+            self.umapi_cache_by_name[umapi_name] = umapi_cache
+        return umapi_cache
+
+    def get_umapi_users_from_cache(self, umapi_cache, umapi_connector):
+        """
+        Read the users of an org from its snapshot.  Only the users whose last update failed
+        are read again from the umapi, since they are the only ones we can't vouch for.
+        :type umapi_cache: UmapiCache
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :rtype list(dict)
+        """
+        users_to_refresh = umapi_cache.get_users_to_refresh()
+        for user_key, umapi_user in users_to_refresh:
+            refreshed_user = umapi_connector.get_user(umapi_user['email'])
+            if refreshed_user:
+                umapi_cache.cache_user(user_key, refreshed_user)
+            else:
+                umapi_cache.delete_user(user_key)
+        umapi_users = umapi_cache.get_users()
+        self.logger.info('Read %d users from snapshot (%d refreshed from umapi)',
+                         len(umapi_users), len(users_to_refresh))
+        return umapi_users
+
+    def get_umapi_cache_for_results(self, umapi_name):
+        """
+        Return the snapshot that should record the results of the commands sent to an org, if any.
+        Nothing is recorded in test mode because nothing is changed on the Adobe side.
+        :type umapi_name: str
+        :rtype UmapiCache
+        """
+        if self.options['test_mode']:
+            return None
+        return self.umapi_cache_by_name.get(umapi_name)
+
+    def note_commands_user_key(self, user_key, commands):
+        """
+        Remember which user the commands target, so their results can be recorded in the snapshot
+        :type user_key: str
+        :type commands: user_sync.connector.connector_umapi.Commands
+        """
+        if (self.options['delta_sync'] or self.options['skip_unchanged_users']) and commands is not None:
+            self.user_key_by_commands[commands] = user_key
+
+    def get_umapi_cache_callback(self, umapi_cache, commands):
+        """
+        :type umapi_cache: UmapiCache
+        :type commands: user_sync.connector.connector_umapi.Commands
+        :rtype callable(dict)
+        """
+        user_key = self.user_key_by_commands.get(commands)
+        if umapi_cache is None or user_key is None:
+            return None
+
+        def callback(result):
+            self.update_umapi_cache(umapi_cache, user_key, commands, result['is_success'])
+        return callback
+
+    def update_umapi_cache(self, umapi_cache, user_key, commands, is_success):
+        """
+        Apply the result of the commands sent for a user to the snapshot of the org.
+        Users whose commands failed are flagged, so they are read again from the umapi on the next run.
+        Users that were created are flagged as well, since they might have existed already.
+        Users whose commands succeeded have their directory hash confirmed, once the run is over.
+        :type umapi_cache: UmapiCache
+        :type user_key: str
+        :type commands: user_sync.connector.connector_umapi.Commands
+        :type is_success: bool
+        """
+        user_hashes = self.user_hashes_by_cache.get(umapi_cache)
+        if is_success and user_hashes and user_key in user_hashes:
+            user_hashes[user_key] = (user_hashes[user_key][0], True)
+        if not self.options['delta_sync']:
+            return
+        umapi_user = umapi_cache.get_user(user_key)
+        if not is_success:
+            if umapi_user is not None:
+                umapi_cache.update_user_refresh_status(user_key, needs_refresh=True)
             return
-        
+        attribute_by_param = {'first_name': 'firstname', 'last_name': 'lastname'}
+        needs_refresh = False
+        for command_name, params in commands.do_list:
+            if command_name == 'create':
+                needs_refresh = True
+                if umapi_user is None:
+                    umapi_user = {'type': commands.identity_type, 'email': commands.email,
+                                  'username': commands.username, 'domain': commands.domain, 'groups': []}
+                    for key, value in params.items():
+                        if key != 'on_conflict':
+                            umapi_user[attribute_by_param.get(key, key)] = value
+            elif command_name == 'remove_from_organization':
+                umapi_cache.delete_user(user_key)
+                return
+            elif umapi_user is None:
+                continue
+            elif command_name == 'update':
+                for key, value in params.items():
+                    umapi_user[attribute_by_param.get(key, key)] = value
+            elif command_name == 'add_to_groups':
+                current_groups = self.normalize_groups(umapi_user.get('groups'))
+                umapi_user['groups'] = list(umapi_user.get('groups') or []) + [
+                    group for group in params['groups'] if normalize_string(group) not in current_groups]
+            elif command_name == 'remove_from_groups':
+                if params.get('all_groups'):
+                    umapi_user['groups'] = []
+                else:
+                    groups_to_remove = self.normalize_groups(params['groups'])
+                    umapi_user['groups'] = [group for group in umapi_user.get('groups') or []
+                                            if normalize_string(group) not in groups_to_remove]
+        if umapi_user is not None:
+            umapi_cache.cache_user(user_key, umapi_user, needs_refresh)
+
+    def execute_commands(self, command_list, connector, umapi_cache=None, total_users=None):
+        """
+        :type command_list: list(user_sync.connector.connector_umapi.Commands) or an iterator of them
+        :type connector: user_sync.connector.connector_umapi.UmapiConnector
+        :type umapi_cache: UmapiCache (if given, the result of each command is recorded in it)
+        :type total_users: int (needed for progress when command_list is an iterator)
+        """
         # Instead of a Commands object, some items in the list might be None
         # this can happen if country code is invalid, for instance
-        command_list = [c for c in command_list if c is not None]
+        if total_users is None:
+            command_list = [c for c in command_list if c is not None]
+            total_users = len(command_list)
+        command_iter = (c for c in command_list if c is not None)
 
-        total_users = len(command_list)
+        # do nothing if we have no commands for this connector
+        commands = next(command_iter, None)
+        if commands is None:
+            return
 
-        # split off the last command if we have more than 10, so we can send an end signal
+        # look one command ahead, so if we have more than 10 we can send an end signal before the last one
         connector.start_sync()
-        if len(command_list) > 10:
-            command_list, last_command = command_list[0:-1], command_list[-1]
-        else:
-            last_command = None
-
         count = 0
-        for commands in command_list:
-            connector.send_commands(commands)
+        while commands is not None:
+            next_commands = next(command_iter, None)
+            if next_commands is None and count >= 10:
+                connector.end_sync()
+            connector.send_commands(commands, self.get_umapi_cache_callback(umapi_cache, commands))
             count += 1
-            if count % 10 == 0:
+            if count % 10 == 0 and next_commands is not None:
                 self.logger.progress(count, total_users, 'actions completed')
-
-        if last_command is not None:
-            connector.end_sync()
-            connector.send_commands(last_command)
-            count += 1
+            commands = next_commands
 
         self.logger.progress(count, total_users, 'actions completed')
 
+    def iter_primary_create_commands(self, umapi_connector):
+        """
+        Make the commands for the pending primary users to create, one chunk at a time,
+        so that the commands for all the new users are never held in memory at once.
+        :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :rtype iterable(user_sync.connector.connector_umapi.Commands)
+        """
+        umapi_info = self.get_umapi_info(PRIMARY_TARGET_NAME)
+        chunk_size = self.options['streaming_chunk_size']
+        pending_creates = self.pending_primary_creates
+        for start in range(0, len(pending_creates), chunk_size):
+            chunk = [self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector.trusted)
+                     for user_key, groups_to_add in pending_creates[start:start + chunk_size]]
+            self.logger.debug('Queuing new users %d to %d of %d', start + 1, start + len(chunk), len(pending_creates))
+            for commands in chunk:
+                yield commands
+
     def create_umapi_groups(self, umapi_connectors):
         """
         This is where we create user-groups. If auto_create is enabled,
@@ -667,7 +1017,10 @@ class RuleProcessor(object):
             id_type, username, domain = self.parse_user_key(key)
             if '@' in username and username.lower() in self.email_override:
                 username = self.email_override[username.lower()]
-            return user_sync.connector.connector_umapi.Commands(identity_type=id_type, username=username, domain=domain)
+            commands = user_sync.connector.connector_umapi.Commands(identity_type=id_type, username=username,
+                                                                    domain=domain)
+            self.note_commands_user_key(key, commands)
+            return commands
 
         # do the secondary umapis first, in case we are deleting user accounts from the primary umapi at the end
         for umapi_name in umapi_connectors.get_secondary_connectors():
@@ -813,6 +1166,7 @@ class RuleProcessor(object):
         commands = self.create_umapi_commands_for_directory_user(directory_user, self.will_update_user_info(umapi_info), trusted)
         if not commands:
             return
+        self.note_commands_user_key(user_key, commands)
         if self.will_process_groups():
             if self.push_umapi:
                 groups_to_remove = umapi_info.get_mapped_groups() - groups_to_add
@@ -881,9 +1235,10 @@ class RuleProcessor(object):
         commands.update_user(attributes_to_update)
         commands.remove_groups(groups_to_remove)
         commands.add_groups(groups_to_add)
+        self.note_commands_user_key(user_key, commands)
         return commands
 
-    def update_umapi_users_for_connector(self, umapi_info, umapi_connector: UmapiConnector):
+    def update_umapi_users_for_connector(self, umapi_info, umapi_connector: UmapiConnector, umapi_users=None):
         """
         This is the main function that goes over adobe users and looks for and processes differences.
         It is called with a particular organization that it should manage groups against.
@@ -893,6 +1248,7 @@ class RuleProcessor(object):
         The use of this return value by the caller is to create the user and add him to the right groups.
         :type umapi_info: UmapiTargetInfo
         :type umapi_connector: user_sync.connector.connector_umapi.UmapiConnector
+        :type umapi_users: list(dict) or None (if None, the users are read from the umapi connector)
         :rtype: map(string, set)
         """
         command_list = []
@@ -914,10 +1270,21 @@ class RuleProcessor(object):
         if self.will_process_strays:
             self.add_stray(umapi_info.get_name(), None)
 
-        if self.options['adobe_group_filter'] is not None:
-            umapi_users = self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
-        else:
-            umapi_users = umapi_connector.iter_users()
+        if umapi_users is None:
+            umapi_users = self.get_umapi_users(umapi_info, umapi_connector)
+        umapi_cache = None
+        if self.options['delta_sync'] or self.options['skip_unchanged_users']:
+            umapi_cache = self.get_umapi_cache(umapi_info)
+        # if the snapshot of this umapi is due for a refresh, we are reading all of its users from the umapi
+        snapshot_users = [] if self.options['delta_sync'] and umapi_cache.should_refresh else None
+        # directory users whose hash hasn't changed since they were last confirmed in this umapi are not
+        # compared again, as long as their snapshot hasn't been flagged since, and it's not time for a refresh.
+        user_hashes = None
+        if self.options['skip_unchanged_users']:
+            user_hashes = {} if umapi_cache.should_refresh else umapi_cache.get_user_hashes()
+            hash_salt = self.get_user_hash_salt(umapi_info)
+            new_user_hashes = self.user_hashes_by_cache.setdefault(umapi_cache, {})
+        skipped_user_count = 0
         # Walk all the adobe users, getting their group data, matching them with directory users,
         # and adjusting their attribute and group data accordingly.
         for umapi_user in umapi_users:
@@ -935,8 +1302,10 @@ class RuleProcessor(object):
                 self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
                 continue
             umapi_info.add_umapi_user(user_key, umapi_user)
+            if snapshot_users is not None:
+                snapshot_users.append((user_key, dict(umapi_user)))
             attribute_differences = {}
-            current_groups = self.normalize_groups(umapi_user.get('groups'))
+            current_groups = umapi_info.get_group_set(umapi_user.get('groups'))
             groups_to_add = set()
             groups_to_remove = set()
 
@@ -944,7 +1313,7 @@ class RuleProcessor(object):
             # map because we know they don't need to be created.
             # Also, keep track of the mapped groups for the directory user
             # so we can update the adobe user's groups as needed.
-            desired_groups = user_to_group_map.pop(user_key, None) or set()
+            desired_groups = user_to_group_map.pop(user_key, None) or GroupSet(umapi_info.group_registry)
 
             # check for excluded users
             if self.is_umapi_user_excluded(in_primary_org, user_key, current_groups):
@@ -953,6 +1322,7 @@ class RuleProcessor(object):
             self.map_email_override(umapi_user)
 
             directory_user = filtered_directory_user_by_user_key.get(user_key)
+            user_hash = None
             if directory_user is None:
                 # There's no selected directory user matching this adobe user
                 # so we mark this adobe user as a stray, and we mark him
@@ -965,6 +1335,12 @@ class RuleProcessor(object):
                     self.add_stray(umapi_info.get_name(), user_key,
                                    None if not process_groups else current_groups & umapi_info.get_mapped_groups())
             else:
+                if user_hashes is not None:
+                    user_hash = self.get_directory_user_hash(directory_user, desired_groups, hash_salt)
+                    if user_hashes.get(user_key) == user_hash:
+                        new_user_hashes[user_key] = (user_hash, True)
+                        skipped_user_count += 1
+                        continue
                 # There is a selected directory user who matches this adobe user,
                 # so mark any changed umapi attributes,
                 # and mark him for addition and removal of the appropriate mapped groups
@@ -979,13 +1355,59 @@ class RuleProcessor(object):
             # Finally, execute the attribute and group adjustments
             # if we have nothing to update, omit this user
             if not attribute_differences and not groups_to_add and not groups_to_remove:
+                if user_hash is not None:
+                    new_user_hashes[user_key] = (user_hash, True)
                 continue
+            if user_hash is not None:
+                # confirmed once the update succeeds
+                new_user_hashes[user_key] = (user_hash, False)
             command_list.append(self.update_umapi_user(umapi_info, user_key, attribute_differences,
                                 groups_to_add, groups_to_remove, umapi_user))
+        if snapshot_users is not None:
+            umapi_cache.clear_all()
+            umapi_cache.cache_users(snapshot_users)
+        if user_hashes is not None:
+            self.logger.info('Skipped comparison of %d unchanged directory users', skipped_user_count)
+        if umapi_cache is not None and umapi_cache.should_refresh:
+            umapi_cache.refresh_done()
         # mark the umapi's adobe users as processed and return the remaining ones in the map
         umapi_info.set_umapi_users_loaded()
         return (user_to_group_map, command_list)
 
+    def get_user_hash_salt(self, umapi_info):
+        """
+        The part of the directory user hash that is shared by all the users of a umapi: if the group
+        mapping or the kind of updates we make change, no user can be considered unchanged.
+        :type umapi_info: UmapiTargetInfo
+        :rtype str
+        """
+        return json.dumps([sorted(umapi_info.get_mapped_groups()),
+                           self.will_update_user_info(umapi_info), self.will_process_groups()])
+
+    def save_user_hashes(self):
+        """
+        Replace the directory user hashes of each snapshot with those of this run, along with the
+        confirmations of the updates sent.  Nothing is saved in test mode, since nothing was changed.
+        """
+        if self.options['test_mode']:
+            return
+        for umapi_cache, user_hashes in self.user_hashes_by_cache.items():
+            umapi_cache.replace_user_hashes(user_hashes)
+
+    @staticmethod
+    def get_directory_user_hash(directory_user, desired_groups, salt):
+        """
+        Hash the attributes of a directory user that we sync to a umapi, along with its mapped groups there
+        :type directory_user: dict
+        :type desired_groups: set(str)
+        :type salt: str
+        :rtype str
+        """
+        content = [salt, sorted(desired_groups)]
+        content.extend(directory_user.get(key) for key in ('identity_type', 'username', 'domain', 'email',
+                                                           'firstname', 'lastname', 'country'))
+        return hashlib.sha1(json.dumps(content).encode('utf8')).hexdigest()
+
     def map_email_override(self, umapi_user):
         """
         for users with email-type usernames that don't match the email address, we need to add some
@@ -1248,7 +1670,9 @@ class UmapiTargetInfo(object):
         :type name: str
         """
         self.name = name
-        self.mapped_groups = set()
+        # the groups of this umapi are held as bitsets over this registry (see get_group_set)
+        self.group_registry = GroupRegistry()
+        self.mapped_groups = GroupSet(self.group_registry)
         self.non_normalize_mapped_groups = set()
         self.desired_groups_by_user_key = {}
         self.umapi_user_by_user_key = {}
@@ -1289,6 +1713,13 @@ class UmapiTargetInfo(object):
     def get_desired_groups_by_user_key(self):
         return self.desired_groups_by_user_key
 
+    def get_group_set(self, group_names):
+        """
+        :type group_names: iterable(str) (not normalized)
+        :rtype GroupSet
+        """
+        return GroupSet(self.group_registry, self.group_registry.get_mask(group_names))
+
     def get_desired_groups(self, user_key):
         """
         :type user_key: str
@@ -1303,7 +1734,7 @@ class UmapiTargetInfo(object):
         """
         desired_groups = self.get_desired_groups(user_key)
         if desired_groups is None:
-            self.desired_groups_by_user_key[user_key] = desired_groups = set()
+            self.desired_groups_by_user_key[user_key] = desired_groups = GroupSet(self.group_registry)
         if group is not None:
             normalized_group_name = normalize_string(group)
             desired_groups.add(normalized_group_name)
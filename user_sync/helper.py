@@ -20,6 +20,8 @@
 
 import csv
 import datetime
+import io
+import operator
 import os
 import sys
 
@@ -54,8 +56,11 @@ class CSVAdapter:
     """
     Read and write CSV files to and from lists of dictionaries
     """
-    @staticmethod
-    def open_csv_file(name, mode, encoding=None):
+    # files are read in large blocks, rather than a line at a time
+    read_buffer_size = 1024 * 1024
+
+    @classmethod
+    def open_csv_file(cls, name, mode, encoding=None):
         """
         :type name: str
         :type mode: str
@@ -65,9 +70,9 @@ class CSVAdapter:
         try:
             if mode == 'r':
                 if is_py2():
-                    return open(str(name), 'rb', buffering=1)
+                    return open(str(name), 'rb', buffering=cls.read_buffer_size)
                 else:
-                    kwargs = dict(buffering=1, newline='', encoding=encoding)
+                    kwargs = dict(buffering=cls.read_buffer_size, newline='', encoding=encoding)
                     return open(str(name), 'r', **kwargs)
             elif mode == 'w':
                 if is_py2():
@@ -131,6 +136,173 @@ class CSVAdapter:
             except UnicodeError as e:
                 raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
 
+    @classmethod
+    def read_csv_columns(cls, file_path, column_names, logger=None, encoding='utf8', delimiter=None):
+        """
+        Read the values of some columns, row by row.  This is a faster read_csv_rows for large files:
+        each column is picked from a row by its index in the header row, rather than making a dict of
+        each row.  As with read_csv_rows, blank rows are skipped, and the values missing from short rows
+        are None.
+        :type file_path: str
+        :type column_names: list(str)
+        :type logger: logging.Logger
+        :type encoding: str
+        :type delimiter: str
+        :rtype iterator(tuple): the values of each row, in column_names order (None for columns not in the file)
+        """
+        with cls.open_csv_file(file_path, 'r', encoding) as input_file:
+            if delimiter is None:
+                delimiter = cls.guess_delimiter_from_filename(file_path)
+            try:
+                reader = csv.reader(input_file, delimiter=delimiter)
+                header = next(reader, None)
+                if header is None:
+                    return
+                if is_py2():
+                    header = [name.decode(encoding, 'strict') for name in header]
+                cls.check_column_names(file_path, header, column_names, logger)
+                for values in cls.iter_column_values(reader, header, column_names, encoding):
+                    yield values
+            except UnicodeError as e:
+                raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
+
+    @staticmethod
+    def check_column_names(file_path, header, column_names, logger):
+        """
+        :type file_path: str
+        :type header: list(str)
+        :type column_names: list(str)
+        :type logger: logging.Logger
+        """
+        unrecognized_column_names = [column_name for column_name in header if column_name not in column_names]
+        if len(unrecognized_column_names) > 0 and logger is not None:
+            logger.warn("In file '%s': unrecognized column names: %s", file_path, unrecognized_column_names)
+
+    @staticmethod
+    def iter_column_values(reader, header, column_names, encoding='utf8'):
+        """
+        Pick the values of some columns from each row of a csv reader.
+        :type reader: iterator(list(str))
+        :type header: list(str)
+        :type column_names: list(str)
+        :type encoding: str
+        :rtype iterator(tuple)
+        """
+        # as in a DictReader, the last of several columns with the same name is the one used
+        index_by_name = {column_name: index for index, column_name in enumerate(header)}
+        indexes = [index_by_name.get(column_name) for column_name in column_names]
+        width = max([index + 1 for index in indexes if index is not None] or [0])
+        # columns not in the file are read from a None appended to each row
+        has_missing_columns = None in indexes
+        indexes = [-1 if index is None else index for index in indexes]
+        if len(indexes) == 1:
+            index = indexes[0]
+            get_values = lambda row: (row[index],)
+        elif indexes:
+            get_values = operator.itemgetter(*indexes)
+        else:
+            get_values = lambda row: ()
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                row.extend([None] * (width - len(row)))
+            if has_missing_columns:
+                row.append(None)
+            values = get_values(row)
+            if is_py2():
+                values = tuple(value.decode(encoding, 'strict') if value else value for value in values)
+            yield values
+
+    @classmethod
+    def read_csv_header(cls, file_path, encoding='utf8', delimiter=None):
+        """
+        :type file_path: str
+        :type encoding: str
+        :type delimiter: str
+        :rtype list(str): the column names of the header row, None if the file is empty
+        """
+        with cls.open_csv_file(file_path, 'r', encoding) as input_file:
+            if delimiter is None:
+                delimiter = cls.guess_delimiter_from_filename(file_path)
+            try:
+                return next(csv.reader(input_file, delimiter=delimiter), None)
+            except UnicodeError as e:
+                raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
+
+    @classmethod
+    def find_csv_chunks(cls, file_path, chunk_size):
+        """
+        Split the rows of a CSV file, after its header row, into chunks of about chunk_size bytes.  Each chunk
+        ends with a line break that is not in a quoted value: these are told apart by the number of quotes
+        before them, which is even between rows.  This holds as long as quotes only appear in quoted values
+        (doubled, when they are part of the value), as CSV writers do.  The encoding of the file must write
+        quotes and line breaks as single bytes, as ASCII does.
+        :type file_path: str
+        :type chunk_size: int
+        :rtype list(tuple(int, int)): the start and end offset of each chunk; None if the quotes don't balance
+        """
+        boundaries = []
+        quote_parity = 0
+        counted_to = 0
+        search_from = 0
+        data_start = 0
+        try:
+            with open(str(file_path), 'rb') as input_file:
+                data = input_file.read(cls.read_buffer_size)
+                while data:
+                    data_end = data_start + len(data)
+                    while search_from < data_end:
+                        # a row boundary searched for in the last buffer is searched for from the start of this one
+                        index = data.find(b'\n', max(search_from - data_start, 0))
+                        if index < 0:
+                            break
+                        quote_parity ^= data.count(b'"', counted_to - data_start, index) & 1
+                        counted_to = data_start + index + 1
+                        if quote_parity:
+                            search_from = counted_to
+                        else:
+                            # the first row boundary ends the header row
+                            boundaries.append(counted_to)
+                            search_from = counted_to + chunk_size
+                    quote_parity ^= data.count(b'"', counted_to - data_start) & 1
+                    counted_to = data_start = data_end
+                    data = input_file.read(cls.read_buffer_size)
+        except IOError as e:
+            raise AssertionException("Can't open file '%s': %s" % (file_path, e))
+        if quote_parity:
+            return None
+        ends = boundaries[1:] + [data_start]
+        return [(start, end) for start, end in zip(boundaries, ends) if start < end]
+
+    @classmethod
+    def read_csv_chunk_columns(cls, file_path, start, end, header, column_names, encoding='utf8', delimiter=None):
+        """
+        Read the values of some columns, row by row, from a chunk of a CSV file (as found by find_csv_chunks).
+        :type file_path: str
+        :type start: int
+        :type end: int
+        :type header: list(str)
+        :type column_names: list(str)
+        :type encoding: str
+        :type delimiter: str
+        :rtype iterator(tuple)
+        """
+        if delimiter is None:
+            delimiter = cls.guess_delimiter_from_filename(file_path)
+        try:
+            with open(str(file_path), 'rb') as input_file:
+                input_file.seek(start)
+                data = input_file.read(end - start)
+        except IOError as e:
+            raise AssertionException("Can't open file '%s': %s" % (file_path, e))
+        try:
+            reader = csv.reader(io.StringIO(data.decode(encoding), newline=''), delimiter=delimiter)
+            for values in cls.iter_column_values(reader, header, column_names, encoding):
+                yield values
+        except UnicodeError as e:
+            raise AssertionException("Encoding error in file '%s': %s" % (file_path, e))
+
     @classmethod
     def write_csv_rows(cls, file_path, field_names, rows, encoding='utf8', delimiter=None):
         """